@@ -24,8 +24,19 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': 'dev.db'
-    }
+    },
+    # for trying read-replica routing with two sqlite databases:
+    # uncomment DATABASE_ROUTERS below. sqlite doesn't replicate, so copy
+    # dev.db to replica.db after syncdb and expect replica reads to lag
+    # until you copy it again. the tests use it as a replica that never
+    # catches up.
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'replica.db',
+    },
 }
+# DATABASE_ROUTERS = ['geocamFolder.routers.FolderReplicaRouter']
+# GEOCAM_FOLDER_READ_DATABASES = ('replica',)
 
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
@@ -84,6 +95,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # 'geocamFolder.routers.ReadYourWritesMiddleware',
 )
 
 ROOT_URLCONF = 'example.urls'
@@ -24,6 +24,8 @@ urlpatterns = patterns(
     # Uncomment the next line to enable the admin:
     (r'^admin/', include(admin.site.urls)),
 
+    (r'^folder/', include('geocamFolder.urls')),
+
 )
 
 urlpatterns = urlpatterns + patterns(
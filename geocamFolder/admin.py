@@ -8,6 +8,12 @@ from django.contrib import admin
 
 from geocamFolder.models import Folder, UserPermission, GroupPermission
 
+
+class AgentPermissionAdmin(admin.ModelAdmin):
+    # the change list shows __unicode__(), which follows the folder and
+    # agent foreign keys
+    list_select_related = True
+
 admin.site.register(Folder)
-admin.site.register(UserPermission)
-admin.site.register(GroupPermission)
+admin.site.register(UserPermission, AgentPermissionAdmin)
+admin.site.register(GroupPermission, AgentPermissionAdmin)
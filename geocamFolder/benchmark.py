@@ -0,0 +1,251 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Benchmarks for folder and permission operations.  See the
+geocamfolder_benchmark management command for the usual way to run
+them.
+"""
+
+import time
+import random
+import resource
+import platform
+
+import django
+from django.db import connection, transaction
+from django.contrib.auth.models import User, Group
+from django.test.utils import override_settings
+
+from geocamFolder import stats
+from geocamFolder.models import (Folder, UserPermission, GroupPermission,
+                                 FolderMemberExample, FolderMemberCount,
+                                 PermissionManager,
+                                 Action, Actions, ACTION_CHOICES,
+                                 GROUP_ANYUSER_ID,
+                                 flushCache, getFolderTree, getAllowedFolders,
+                                 allocatePks, _getPickledSize)
+
+BULK_BATCH_SIZE = 500
+BULK_CREATE_MEMBERS = 100
+ACTION_SETS = (Actions.READ, Actions.WRITE, Actions.ALL)
+
+
+class BenchmarkConfig(object):
+    def __init__(self, folders=1000, depth=5, fanout=10, users=100, groups=10,
+                 groupsPerUser=2, aclDensity=0.1, members=1000, repeat=100, seed=0,
+                 operations=None):
+        self.folders = folders
+        self.depth = depth
+        self.fanout = fanout
+        self.users = users
+        self.groups = groups
+        self.groupsPerUser = groupsPerUser
+        self.aclDensity = aclDensity
+        self.members = members
+        self.repeat = repeat
+        self.seed = seed
+        # names of the operations to time, or None for all of them
+        self.operations = operations
+
+
+@transaction.commit_on_success
+def generateDeployment(config):
+    """
+    Fills the db with a synthetic deployment described by @config: a
+    folder tree of about config.folders folders, at most config.depth
+    levels deep with up to config.fanout subfolders per folder, plus
+    users, groups, group memberships, ACL entries and folder members.
+    Returns (users, folderPaths).
+    """
+    rng = random.Random(config.seed)
+
+    User.objects.bulk_create([User(username='bench%d' % i, email='bench%d@example.com' % i)
+                              for i in xrange(config.users)],
+                             batch_size=BULK_BATCH_SIZE)
+    users = list(User.objects.filter(username__startswith='bench'))
+    Group.objects.bulk_create([Group(name='benchGroup%d' % i) for i in xrange(config.groups)])
+    groups = list(Group.objects.filter(name__startswith='benchGroup'))
+    if groups:
+        Membership = User.groups.through
+        memberships = set()
+        for user in users:
+            for group in rng.sample(groups, min(config.groupsPerUser, len(groups))):
+                memberships.add((user.id, group.id))
+        Membership.objects.bulk_create([Membership(user_id=u, group_id=g) for u, g in memberships],
+                                       batch_size=BULK_BATCH_SIZE)
+
+    # breadth-first so every folder gets a parent before its children
+    root = Folder.getRootFolder()
+    pks = iter(allocatePks(Folder, config.folders))
+    newFolders = []
+    folderPaths = ['/']
+    queue = [(root.id, '', 0)]
+    while queue and len(newFolders) < config.folders:
+        parentId, parentPath, depth = queue.pop(0)
+        if depth >= config.depth:
+            continue
+        for i in xrange(config.fanout):
+            if len(newFolders) >= config.folders:
+                break
+            name = 'f%d' % i
+            path = '%s/%s' % (parentPath, name)
+            pk = pks.next()
+            newFolders.append(Folder(id=pk, name=name, parent_id=parentId))
+            folderPaths.append(path)
+            queue.append((pk, path, depth + 1))
+    Folder.objects.bulk_create(newFolders, batch_size=BULK_BATCH_SIZE)
+
+    # everything inherits read access for anyuser from the root, as
+    # with mkdir(), plus random grants at the requested density
+    folderIds = [f.id for f in newFolders]
+    groupPerms = [GroupPermission(folder_id=fid, group_id=GROUP_ANYUSER_ID,
+                                  canRead=True, canList=True)
+                  for fid in folderIds]
+    userPerms = []
+    for fid in folderIds:
+        if rng.random() >= config.aclDensity:
+            continue
+        if groups and rng.random() < 0.5:
+            perm = GroupPermission(folder_id=fid, group_id=rng.choice(groups).id)
+            groupPerms.append(perm)
+        else:
+            perm = UserPermission(folder_id=fid, user_id=rng.choice(users).id)
+            userPerms.append(perm)
+        perm.setActions(rng.choice(ACTION_SETS))
+    GroupPermission.objects.bulk_create(groupPerms, batch_size=BULK_BATCH_SIZE)
+    UserPermission.objects.bulk_create(userPerms, batch_size=BULK_BATCH_SIZE)
+
+    members = [FolderMemberExample(id=pk, name='m%d' % i)
+               for i, pk in enumerate(allocatePks(FolderMemberExample, config.members))]
+    FolderMemberExample.objects.bulk_create(members, batch_size=BULK_BATCH_SIZE)
+    Through = FolderMemberExample.folders.through
+    allFolderIds = [root.id] + folderIds
+    Through.objects.bulk_create([Through(foldermemberexample_id=m.id,
+                                         folder_id=rng.choice(allFolderIds))
+                                 for m in members],
+                                batch_size=BULK_BATCH_SIZE)
+    # bulk_create() skips the signals that maintain the counts
+    FolderMemberCount.recount(FolderMemberExample)
+
+    flushCache()
+    return users, folderPaths
+
+
+def getPeakRssKb():
+    # ru_maxrss is in kilobytes on Linux but bytes on Mac OS X
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == 'Darwin':
+        peak /= 1024
+    return peak
+
+
+def timeOperation(name, func, repeat):
+    """
+    Calls func(i) for i in xrange(@repeat) and returns a dict of
+    timing, query count and memory statistics.
+    """
+    hist = stats.Histogram()
+    queries = 0
+    rssBefore = getPeakRssKb()
+    for i in xrange(repeat):
+        with stats.QueryCounter() as counter:
+            start = time.time()
+            func(i)
+            elapsedMs = (time.time() - start) * 1000
+        hist.observe(elapsedMs)
+        queries += counter.count
+    result = hist.getSummary()
+    result.update({'operation': name,
+                   'totalMs': hist.total,
+                   'queriesPerCall': float(queries) / repeat if repeat else None,
+                   'peakRssKb': getPeakRssKb(),
+                   'peakRssGrowthKb': getPeakRssKb() - rssBefore})
+    return result
+
+
+def _runOperations(config, users, folderPaths):
+    rng = random.Random(config.seed + 1)
+    actions = [name[0] for name in ACTION_CHOICES]
+    folders = getFolderTree().byId.values()
+    groupIds = list(Group.objects.filter(name__startswith='benchGroup').values_list('id', flat=True))
+    results = []
+
+    def add(name, func, repeat=config.repeat):
+        if config.operations is None or name in config.operations:
+            results.append(timeOperation(name, func, repeat))
+
+    add('getFolderTree', lambda i: getFolderTree())
+    add('getPartialFolderTree',
+        lambda i: getFolderTree(rng.choice(folderPaths), depth=2))
+    add('getFolder', lambda i: Folder.getFolder(rng.choice(folderPaths)))
+    add('listdir', lambda i: rng.choice(folders).listdir(rng.choice(users)))
+    add('searchPath', lambda i: Folder.search(rng.choice(folderPaths)[:6], rng.choice(users)))
+    add('searchName', lambda i: Folder.search('f%d' % rng.randrange(config.fanout),
+                                              rng.choice(users)))
+    add('getFolderAssertAllowed',
+        lambda i: Folder.getFolderAssertAllowed(rng.choice(users), rng.choice(folderPaths)))
+    add('getAllowedFolders', lambda i: getAllowedFolders(rng.choice(users), rng.choice(actions)))
+    add('isAllowed', lambda i: rng.choice(folders).isAllowed(rng.choice(users), rng.choice(actions)))
+    add('filterAllowed',
+        lambda i: list(PermissionManager.filterAllowed(FolderMemberExample.objects.all(),
+                                                       rng.choice(users), Action.READ)[:100]))
+    # the raw permission queries behind getAllowedFolders()
+    add('userPermissionQuery',
+        lambda i: list(UserPermission.allowing(rng.choice(actions))
+                       .filter(user=rng.choice(users))
+                       .values_list('folder', flat=True)))
+    if groupIds:
+        add('groupPermissionQuery',
+            lambda i: list(GroupPermission.allowing(rng.choice(actions))
+                           .filter(group__id=rng.choice(groupIds))
+                           .values_list('folder', flat=True)))
+
+    # writes go last since they flush the folder cache
+    mkdirPaths = []
+
+    def mkdir(i):
+        path = '%s/bench%d' % (rng.choice(folderPaths).rstrip('/'), i)
+        Folder.mkdir(path)
+        mkdirPaths.append(path)
+    add('mkdir', mkdir)
+    add('rmdir', lambda i: Folder.rmdir(mkdirPaths[i]), repeat=len(mkdirPaths))
+    add('setPermissions',
+        lambda i: rng.choice(folders).setPermissions(rng.choice(users), rng.choice(ACTION_SETS)))
+    # the permission check is the same for any user, so skip the ACLs
+    superuser = User(username='benchSuperuser', is_superuser=True)
+    add('bulkCreateMembers',
+        lambda i: FolderMemberExample.bulkCreateAssertAllowed(
+            superuser, [FolderMemberExample(name='bulk%d_%d' % (i, j))
+                        for j in xrange(BULK_CREATE_MEMBERS)],
+            [rng.choice(folders)]))
+    return results
+
+
+def runBenchmark(config, cacheModes=(True, False)):
+    """
+    Generates a deployment from @config and times each operation with
+    the folder cache enabled and/or disabled.  Returns a JSON-friendly
+    dict.
+    """
+    users, folderPaths = generateDeployment(config)
+
+    results = []
+    for cacheEnabled in cacheModes:
+        with override_settings(GEOCAM_FOLDER_FOLDER_CACHE_ENABLED=cacheEnabled):
+            flushCache()
+            for result in _runOperations(config, users, folderPaths):
+                result['cacheEnabled'] = cacheEnabled
+                results.append(result)
+
+    return {'config': config.__dict__,
+            'environment': {'python': platform.python_version(),
+                            'django': django.get_version(),
+                            'dbVendor': connection.vendor,
+                            'time': time.time()},
+            'numFolders': len(folderPaths),
+            'folderTreePickledBytes': _getPickledSize(getFolderTree()),
+            'results': results}
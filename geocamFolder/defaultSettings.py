@@ -34,3 +34,78 @@ GEOCAM_FOLDER_ACCESS_CONTROL_ENABLED = True
 # confused.
 GEOCAM_FOLDER_FOLDER_CACHE_ENABLED = True
 GEOCAM_FOLDER_FOLDER_CACHE_TIMEOUT_SECONDS = 30
+
+# when a cached entry times out, one process recomputes it while the
+# others keep serving the previous value for up to this many extra
+# seconds.
+GEOCAM_FOLDER_FOLDER_CACHE_STALE_SECONDS = 30
+
+# a process that finds no cached value while another process is
+# recomputing it polls the cache for up to LOCK_WAIT seconds before
+# computing the value itself. the recompute lock expires after
+# LOCK_TIMEOUT seconds in case its holder dies.
+GEOCAM_FOLDER_FOLDER_CACHE_LOCK_WAIT_SECONDS = 5
+GEOCAM_FOLDER_FOLDER_CACHE_LOCK_POLL_SECONDS = 0.05
+GEOCAM_FOLDER_FOLDER_CACHE_LOCK_TIMEOUT_SECONDS = 60
+
+# refresh-ahead: an entry read at least MIN_HITS times by a process
+# since its last refresh is recomputed on a background thread once it
+# is within REFRESH_AHEAD_SECONDS of going stale. the background
+# threads open their own db connections, so this is off by default.
+GEOCAM_FOLDER_FOLDER_CACHE_REFRESH_AHEAD_ENABLED = False
+GEOCAM_FOLDER_FOLDER_CACHE_REFRESH_AHEAD_SECONDS = 5
+GEOCAM_FOLDER_FOLDER_CACHE_REFRESH_AHEAD_MIN_HITS = 10
+GEOCAM_FOLDER_FOLDER_CACHE_REFRESH_AHEAD_THREADS = 2
+GEOCAM_FOLDER_FOLDER_CACHE_REFRESH_AHEAD_QUEUE_SIZE = 100
+
+# instrumentation of cache lookups, cache rebuilds, permission checks
+# and filterAllowed(). each metric goes to every sink listed in
+# STATS_SINKS. counting db queries forces django's debug cursor on
+# around the instrumented calls, which costs a little extra.
+GEOCAM_FOLDER_STATS_ENABLED = False
+GEOCAM_FOLDER_STATS_SINKS = ('geocamFolder.stats.MemoryStatsSink',)
+GEOCAM_FOLDER_STATS_COUNT_QUERIES = True
+
+# MemoryStatsSink publishes its numbers to the django cache this often,
+# for the geocamfolder_stats management command to collect.
+GEOCAM_FOLDER_STATS_PUBLISH_SECONDS = 10
+GEOCAM_FOLDER_STATS_PUBLISH_TIMEOUT_SECONDS = 24 * 60 * 60
+
+# used by StatsdStatsSink
+GEOCAM_FOLDER_STATS_STATSD_HOST = 'localhost'
+GEOCAM_FOLDER_STATS_STATSD_PORT = 8125
+GEOCAM_FOLDER_STATS_STATSD_PREFIX = 'geocamFolder.'
+
+# read-replica routing, used by geocamFolder.routers.FolderReplicaRouter
+# (see that module for setup). reads of the apps in REPLICA_APPS go to a
+# random database in READ_DATABASES; writes go to WRITE_DATABASE. after
+# writing, a thread (and with ReadYourWritesMiddleware, a user) reads
+# from WRITE_DATABASE for READ_YOUR_WRITES_SECONDS, which should exceed
+# the worst expected replication lag.
+GEOCAM_FOLDER_WRITE_DATABASE = 'default'
+GEOCAM_FOLDER_READ_DATABASES = ()
+GEOCAM_FOLDER_REPLICA_APPS = ('geocamFolder',)
+GEOCAM_FOLDER_READ_YOUR_WRITES_SECONDS = 10
+
+# json api (geocamFolder.urls). serialized responses are cached for up
+# to API_CACHE_TIMEOUT seconds per folder/acl cache generation. tree
+# responses are streamed instead when there are at least
+# API_STREAM_MIN_FOLDERS folders.
+GEOCAM_FOLDER_API_CACHE_TIMEOUT_SECONDS = 60 * 60
+GEOCAM_FOLDER_API_STREAM_MIN_FOLDERS = 5000
+
+# compiled policy snapshot (see geocamFolder.snapshot). when PATH is
+# set, permission checks use the memory-mapped snapshot file at PATH
+# while its generation is current. each process checks whether the
+# file has been replaced at most every CHECK_SECONDS.
+GEOCAM_FOLDER_SNAPSHOT_PATH = None
+GEOCAM_FOLDER_SNAPSHOT_CHECK_SECONDS = 1
+
+# change journal (models.FolderChange). when enabled, every folder, ACL
+# and group membership change appends an entry for consumers that sync
+# with models.changesSince(). entries younger than SETTLE_SECONDS are
+# held back from consumers, since concurrent writers can commit them
+# out of sequence order. compact the journal with the
+# geocamfolder_compact_journal management command.
+GEOCAM_FOLDER_JOURNAL_ENABLED = False
+GEOCAM_FOLDER_JOURNAL_SETTLE_SECONDS = 2
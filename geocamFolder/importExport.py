@@ -0,0 +1,341 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Streaming bulk import and export of folder trees and ACLs.
+
+A dump is a sequence of records in JSON Lines or CSV format.  Folder
+records look like:
+
+  {"type": "folder", "path": "/a/b", "notes": "", "uuid": "..."}
+
+and ACL records like:
+
+  {"type": "acl", "path": "/a/b", "agent": "group:basinFire", "actions": "rlidc"}
+
+The CSV format has the columns in RECORD_FIELDS.  Exports list folders
+breadth-first, each folder's ACL entries following its level's folder
+records, so a parent always appears before its children.  Imports
+rely on that ordering.  On import, an ACL record replaces any existing
+permissions for that agent on that folder, and imported folders do
+not inherit their parent's ACL.
+"""
+
+import csv
+import json
+import time
+import logging
+
+from django.conf import settings
+from django.db import transaction, router
+from django.db.utils import IntegrityError
+from django.contrib.auth.models import User, Group
+
+from geocamFolder.models import (Folder, UserPermission, GroupPermission, FolderChange,
+                                 Actions, flushCache, allocatePks)
+
+RECORD_FIELDS = ('type', 'path', 'agent', 'actions', 'notes', 'uuid')
+DEFAULT_CHUNK_SIZE = 1000
+
+# bound on the number of path -> folder id entries kept while importing.
+# exports are breadth-first, so the working set is about two levels of
+# the tree; parents that fell out of the table are looked up again.
+PATH_TABLE_MAX_SIZE = 200000
+AGENT_TABLE_MAX_SIZE = 100000
+
+
+def _chunks(seq, size):
+    for i in xrange(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def _joinPath(parentPath, name):
+    return parentPath.rstrip('/') + '/' + name
+
+
+ACTION_FIELDS = [UserPermission.getActionField(action) for action in Actions.ALL]
+
+
+def _getActionsFromRow(flags):
+    # @flags are the ACTION_FIELDS values of a permission row
+    return ''.join([action for action, flag in zip(Actions.ALL, flags) if flag])
+
+
+def iterRecords(root='/', chunkSize=DEFAULT_CHUNK_SIZE):
+    """
+    Yields folder and ACL records for the subtree at @root.  Memory use
+    is bounded by the widest level of the tree, not its total size.
+    """
+    rootFolder = Folder.getFolder(root)
+    rootPath = '/' + root.strip('/') if root.strip('/') else '/'
+    level = [(rootFolder.id, rootPath)]
+    yield {'type': 'folder', 'path': rootPath, 'notes': rootFolder.notes, 'uuid': rootFolder.uuid}
+
+    while level:
+        nextLevel = []
+        for chunk in _chunks(level, chunkSize):
+            paths = dict(chunk)
+            ids = paths.keys()
+
+            for fields in (UserPermission.objects.filter(folder__in=ids)
+                           .values_list(*(['folder_id', 'user__username'] + ACTION_FIELDS))
+                           .iterator()):
+                yield {'type': 'acl', 'path': paths[fields[0]], 'agent': fields[1],
+                       'actions': _getActionsFromRow(fields[2:])}
+            for fields in (GroupPermission.objects.filter(folder__in=ids)
+                           .values_list(*(['folder_id', 'group__name'] + ACTION_FIELDS))
+                           .iterator()):
+                yield {'type': 'acl', 'path': paths[fields[0]], 'agent': 'group:' + fields[1],
+                       'actions': _getActionsFromRow(fields[2:])}
+
+            children = (Folder.objects.filter(parent__in=ids)
+                        .order_by('parent', 'name')
+                        .values_list('id', 'parent_id', 'name', 'notes', 'uuid')
+                        .iterator())
+            for folderId, parentId, name, notes, uuid in children:
+                path = _joinPath(paths[parentId], name)
+                nextLevel.append((folderId, path))
+                yield {'type': 'folder', 'path': path, 'notes': notes, 'uuid': uuid}
+        level = nextLevel
+
+
+def writeRecords(records, out, format='jsonl'):
+    """
+    Writes @records to the file-like object @out.  Returns the number
+    of records written.
+    """
+    n = 0
+    if format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(RECORD_FIELDS)
+        for record in records:
+            writer.writerow([unicode(record.get(field, '')).encode('utf-8')
+                             for field in RECORD_FIELDS])
+            n += 1
+    else:
+        for record in records:
+            out.write(json.dumps(record) + '\n')
+            n += 1
+    return n
+
+
+def readRecords(inp, format='jsonl'):
+    """
+    Yields records from the file-like object @inp.
+    """
+    if format == 'csv':
+        reader = csv.reader(inp)
+        header = reader.next()
+        for row in reader:
+            yield dict([(field, value.decode('utf-8')) for field, value in zip(header, row)])
+    else:
+        for line in inp:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+class BoundedTable(dict):
+    """
+    A lookup table that forgets everything when it grows too big.
+    """
+    def __init__(self, maxSize):
+        super(BoundedTable, self).__init__()
+        self.maxSize = maxSize
+
+    def __setitem__(self, key, value):
+        if len(self) >= self.maxSize:
+            self.clear()
+        super(BoundedTable, self).__setitem__(key, value)
+
+
+class FolderImporter(object):
+    """
+    Imports a stream of records in chunked transactions.  Folders and
+    ACL entries are inserted with bulk_create() and replaced ACL entries
+    removed with a raw delete, neither of which sends the signals that
+    flush the cache; the cache is flushed once at the end.
+    """
+    def __init__(self, chunkSize=DEFAULT_CHUNK_SIZE, logger=None):
+        self.chunkSize = chunkSize
+        self.logger = logger or logging.getLogger('geocamFolder.importExport')
+        self.pathIds = BoundedTable(PATH_TABLE_MAX_SIZE)
+        self.userIds = BoundedTable(AGENT_TABLE_MAX_SIZE)
+        self.groupIds = BoundedTable(AGENT_TABLE_MAX_SIZE)
+        # kept outside pathIds, which may be cleared at any time
+        self.rootId = Folder.getRootFolder().id
+        # paths looked up or added in the current chunk's transaction
+        self.chunkPaths = []
+        self.counts = {'folders': 0, 'existingFolders': 0, 'acls': 0, 'errors': 0}
+
+    def error(self, record, message):
+        self.counts['errors'] += 1
+        self.logger.warning('skipping %s record for %s: %s',
+                            record.get('type'), record.get('path'), message)
+
+    def getFolderId(self, path):
+        path = '/' + path.strip('/') if path.strip('/') else '/'
+        if path == '/':
+            return self.rootId
+        if path not in self.pathIds:
+            # fell out of the table, or created before this import
+            parentPath, name = path.rsplit('/', 1)
+            parentId = self.getFolderId(parentPath or '/')
+            if parentId is None:
+                return None
+            try:
+                self.setFolderId(path, Folder.objects.only('id').get(parent=parentId, name=name).id)
+            except Folder.DoesNotExist:
+                return None
+        return self.pathIds[path]
+
+    def setFolderId(self, path, folderId):
+        self.pathIds[path] = folderId
+        self.chunkPaths.append(path)
+
+    def getAgentId(self, agent):
+        if agent.startswith('group:'):
+            table, model, field, name = self.groupIds, Group, 'name', agent[len('group:'):]
+        else:
+            table, model, field, name = self.userIds, User, 'username', agent
+        if name not in table:
+            try:
+                table[name] = model.objects.only('id').get(**{field: name}).id
+            except model.DoesNotExist:
+                return None
+        return table[name]
+
+    def importFolders(self, records):
+        pending = []
+        for record in records:
+            path = '/' + record['path'].strip('/')
+            if path == '/':
+                continue
+            parentPath, name = path.rsplit('/', 1)
+            parentId = self.getFolderId(parentPath or '/')
+            if parentId is None:
+                self.error(record, 'parent folder does not exist')
+                continue
+            pending.append((path, parentId, name, record))
+
+        parentIds = set([parentId for _, parentId, _, _ in pending])
+        names = set([name for _, _, name, _ in pending])
+        existing = dict([((parentId, name), folderId) for folderId, parentId, name
+                         in Folder.objects.filter(parent__in=parentIds, name__in=names)
+                         .values_list('id', 'parent_id', 'name')])
+
+        newFolders = []
+        newPaths = []
+        for path, parentId, name, record in pending:
+            if (parentId, name) in existing:
+                self.setFolderId(path, existing[(parentId, name)])
+                self.counts['existingFolders'] += 1
+            else:
+                newFolders.append(Folder(name=name, parent_id=parentId,
+                                         notes=record.get('notes') or '',
+                                         uuid=record.get('uuid') or ''))
+                newPaths.append(path)
+        for folder, pk in zip(newFolders, allocatePks(Folder, len(newFolders))):
+            folder.id = pk
+        Folder.objects.bulk_create(newFolders)
+        FolderChange.recordFolders(newFolders)
+        for folder, path in zip(newFolders, newPaths):
+            self.setFolderId(path, folder.id)
+        self.counts['folders'] += len(newFolders)
+
+    def importAcls(self, records):
+        entries = {UserPermission: {}, GroupPermission: {}}
+        for record in records:
+            folderId = self.getFolderId(record['path'])
+            if folderId is None:
+                self.error(record, 'folder does not exist')
+                continue
+            agentId = self.getAgentId(record['agent'])
+            if agentId is None:
+                self.error(record, 'no such user or group %s' % record['agent'])
+                continue
+            model = GroupPermission if record['agent'].startswith('group:') else UserPermission
+            entries[model][(folderId, agentId)] = record.get('actions') or ''
+
+        for model, agentField in ((UserPermission, 'user_id'), (GroupPermission, 'group_id')):
+            if not entries[model]:
+                continue
+            folderIds = set([f for f, _ in entries[model]])
+            agentIds = set([a for _, a in entries[model]])
+            stale = [(pk, folderId) for pk, folderId, agentId in
+                     model.objects.filter(folder__in=folderIds, **{agentField + '__in': agentIds})
+                     .values_list('id', 'folder_id', agentField)
+                     if (folderId, agentId) in entries[model]]
+            using = router.db_for_write(model)
+            for rows in _chunks(stale, self.chunkSize):
+                # skips the per-row post_delete cache flush
+                model.objects.filter(id__in=[pk for pk, _ in rows])._raw_delete(using)
+            FolderChange.recordPermissionDeletes(model, stale)
+
+            perms = []
+            for (folderId, agentId), actions in entries[model].iteritems():
+                if actions:
+                    perm = model(folder_id=folderId, **{agentField: agentId})
+                    perm.setActions(actions)
+                    perms.append(perm)
+            model.objects.bulk_create(perms)
+            if perms and settings.GEOCAM_FOLDER_JOURNAL_ENABLED:
+                # read back the ids that bulk_create() doesn't set
+                FolderChange.recordPermissions(
+                    [perm for perm in model.objects.filter(folder__in=folderIds,
+                                                           **{agentField + '__in': agentIds})
+                     if (perm.folder_id, getattr(perm, agentField)) in entries[model]
+                     and entries[model][(perm.folder_id, getattr(perm, agentField))]])
+            self.counts['acls'] += len(perms)
+
+    def importChunk(self, records):
+        # folders first, so ACL records in the same chunk can find them
+        folders = [r for r in records if r.get('type') == 'folder']
+        acls = [r for r in records if r.get('type') == 'acl']
+        for record in records:
+            if record.get('type') not in ('folder', 'acl'):
+                self.error(record, 'unknown record type')
+
+        counts = dict(self.counts)
+        for attempt in xrange(3):
+            self.chunkPaths = []
+            try:
+                with transaction.commit_on_success():
+                    self.importFolders(folders)
+                    self.importAcls(acls)
+                return
+            except IntegrityError:
+                # another writer took the primary keys we allocated;
+                # forget this chunk's folders and try again
+                for path in self.chunkPaths:
+                    self.pathIds.pop(path, None)
+                self.counts = dict(counts)
+                if attempt == 2:
+                    raise
+
+    def run(self, records):
+        """
+        Imports @records and returns a dict of counts and throughput.
+        """
+        start = time.time()
+        chunk = []
+        n = 0
+        for record in records:
+            chunk.append(record)
+            n += 1
+            if len(chunk) >= self.chunkSize:
+                self.importChunk(chunk)
+                chunk = []
+        if chunk:
+            self.importChunk(chunk)
+        flushCache()
+
+        elapsed = time.time() - start
+        result = dict(self.counts)
+        result.update({'records': n,
+                       'seconds': elapsed,
+                       'recordsPerSecond': n / elapsed if elapsed else None})
+        return result
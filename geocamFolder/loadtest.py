@@ -0,0 +1,313 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Multi-process load test for folder and permission operations.  See the
+geocamfolder_loadtest management command for the usual way to run it.
+
+The parent process sets up a scratch folder tree and users in the site
+database, then starts each worker as a fresh python interpreter (like a
+mod_wsgi daemon, it has its own copy of all module state).  The workers
+share a cache stand-in (by default a file-based cache in a scratch
+directory) and run a mixed read/write workload.  Writers append each
+new folder path to a shared log; readers use it to measure how long it
+takes a new folder to become visible through their own cached tree.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import subprocess
+
+from django.db import connection, transaction
+from django.db.utils import DatabaseError
+from django.core.cache import get_cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.contrib.auth.models import User
+
+from geocamFolder import models, stats
+from geocamFolder.models import (Folder, Action, Actions, PermissionManager,
+                                 FolderMemberExample)
+
+FILE_CACHE = 'file'
+ACL_BATCH_SIZE = 20
+
+# relative weights of the operations in the workload. writes are
+# scaled by the writeFraction option.
+READ_OPS = (('getFolderAssertAllowed', 6),
+            ('isAllowed', 3),
+            ('filterAllowed', 1))
+WRITE_OPS = (('mkdir', 3),
+             ('getOrMkdir', 3),
+             ('setPermissions', 2),
+             ('bulkSetPermissions', 1))
+
+
+def setUp(config):
+    """
+    Creates the scratch folders and users and the scratch directory for
+    the cache stand-in and write log.  Fills in the corresponding
+    config entries.
+    """
+    rng = random.Random(config['seed'])
+    config['workDir'] = tempfile.mkdtemp(prefix='geocamFolderLoadtest')
+    config['writeLog'] = os.path.join(config['workDir'], 'writes.log')
+    open(config['writeLog'], 'w').close()
+    if config['cache'] == FILE_CACHE:
+        config['cache'] = 'file://' + os.path.join(config['workDir'], 'cache')
+
+    scratchName = 'loadtest%d' % os.getpid()
+    config['scratchRoot'] = '/' + scratchName
+    config['users'] = []
+    for i in xrange(config['numUsers']):
+        username = '%s_%d' % (scratchName, i)
+        User.objects.create_user(username, '%s@example.com' % username)
+        config['users'].append(username)
+
+    scratch = Folder.getRootFolder().makeSubFolder(scratchName)
+    scratch.setPermissions('group:authuser', Actions.WRITE)
+    paths = [config['scratchRoot']]
+    parents = [scratch]
+    while len(paths) < config['numFolders']:
+        parent = rng.choice(parents)
+        child = parent.makeSubFolder('f%d' % len(paths))
+        paths.append(paths[parents.index(parent)] + '/' + child.name)
+        parents.append(child)
+    config['paths'] = paths
+    return config
+
+
+def tearDown(config):
+    try:
+        Folder.getFolder(config['scratchRoot']).delete()
+    except ObjectDoesNotExist:
+        pass
+    User.objects.filter(username__in=config['users']).delete()
+    models.flushCache()
+    shutil.rmtree(config['workDir'], ignore_errors=True)
+
+
+class Worker(object):
+    def __init__(self, config, workerId):
+        self.config = config
+        self.workerId = workerId
+        self.rng = random.Random(config['seed'] + 1000 * (workerId + 1))
+        self.users = list(User.objects.filter(username__in=config['users']))
+        self.paths = list(config['paths'])
+        self.histograms = {}
+        self.errors = {}
+        self.staleness = []
+        self.unseenWrites = []
+        self.writeLogOffset = 0
+        self.numWrites = 0
+        self.numCreated = 0
+
+        ops = [(name, weight * (1 - config['writeFraction'])) for name, weight in READ_OPS]
+        ops += [(name, weight * config['writeFraction']) for name, weight in WRITE_OPS]
+        total = sum([weight for _, weight in ops])
+        self.ops = []
+        cumulative = 0.0
+        for name, weight in ops:
+            cumulative += weight / total
+            self.ops.append((cumulative, name))
+
+    def chooseOp(self):
+        x = self.rng.random()
+        for cumulative, name in self.ops:
+            if x < cumulative:
+                return name
+        return self.ops[-1][1]
+
+    # reads
+
+    def getFolderAssertAllowed(self):
+        Folder.getFolderAssertAllowed(self.rng.choice(self.users), self.rng.choice(self.paths))
+
+    def isAllowed(self):
+        folder = Folder.getFolder(self.rng.choice(self.paths))
+        folder.isAllowed(self.rng.choice(self.users), Action.INSERT)
+
+    def filterAllowed(self):
+        querySet = PermissionManager.filterAllowed(FolderMemberExample.objects.all(),
+                                                   self.rng.choice(self.users))
+        list(querySet[:100])
+
+    # writes
+
+    def mkdir(self):
+        path = '%s/w%d_%d' % (self.rng.choice(self.paths), self.workerId, self.numWrites)
+        self.numWrites += 1
+        Folder.mkdir(path)
+        with open(self.config['writeLog'], 'a') as log:
+            # one short write per line, so O_APPEND keeps lines intact
+            log.write('%s\t%r\n' % (path, time.time()))
+
+    def getOrMkdir(self):
+        # every worker creates the same few names in the scratch root,
+        # so most calls race with another worker
+        path = '%s/shared%d' % (self.config['scratchRoot'],
+                                self.rng.randrange(self.config['sharedNames']))
+        _, created = Folder.getOrMkdir(path)
+        if created:
+            self.numCreated += 1
+
+    def setPermissions(self):
+        folder = Folder.getFolder(self.rng.choice(self.paths))
+        folder.setPermissions(self.rng.choice(self.users),
+                              self.rng.choice((Actions.READ, Actions.WRITE, Actions.NONE)))
+
+    @transaction.commit_on_success
+    def bulkSetPermissions(self):
+        user = self.rng.choice(self.users)
+        actions = self.rng.choice((Actions.READ, Actions.WRITE, Actions.NONE))
+        for path in self.rng.sample(self.paths, min(ACL_BATCH_SIZE, len(self.paths))):
+            Folder.getFolder(path).setPermissions(user, actions)
+
+    def checkStaleness(self):
+        with open(self.config['writeLog']) as log:
+            log.seek(self.writeLogOffset)
+            while True:
+                line = log.readline()
+                if not line.endswith('\n'):
+                    break
+                self.writeLogOffset += len(line)
+                path, writeTime = line.rstrip('\n').split('\t')
+                if not path.split('/')[-1].startswith('w%d_' % self.workerId):
+                    self.unseenWrites.append((path, float(writeTime)))
+
+        stillUnseen = []
+        for path, writeTime in self.unseenWrites:
+            try:
+                Folder.getFolder(path)
+            except ObjectDoesNotExist:
+                stillUnseen.append((path, writeTime))
+            else:
+                self.staleness.append(time.time() - writeTime)
+        self.unseenWrites = stillUnseen
+
+    def run(self):
+        startTime = self.config['startTime']
+        while time.time() < startTime:
+            time.sleep(0.01)
+        endTime = startTime + self.config['duration']
+        numOps = 0
+        while time.time() < endTime:
+            op = self.chooseOp()
+            start = time.time()
+            try:
+                getattr(self, op)()
+            except (DatabaseError, ObjectDoesNotExist), e:
+                key = '%s: %s' % (op, e.__class__.__name__)
+                self.errors[key] = self.errors.get(key, 0) + 1
+                transaction.rollback_unless_managed()
+            elapsedMs = (time.time() - start) * 1000
+            self.histograms.setdefault(op, stats.Histogram()).observe(elapsedMs)
+            numOps += 1
+            if numOps % self.config['stalenessCheckInterval'] == 0:
+                self.checkStaleness()
+        self.checkStaleness()
+
+        return {'workerId': self.workerId,
+                'histograms': dict([(op, hist.__dict__)
+                                    for op, hist in self.histograms.iteritems()]),
+                'errors': self.errors,
+                'staleness': self.staleness,
+                'unseenWrites': len(self.unseenWrites),
+                'sharedFoldersCreated': self.numCreated}
+
+
+def runWorker(config, workerId):
+    if config['cache'].startswith('file://'):
+        models.cache = get_cache('django.core.cache.backends.filebased.FileBasedCache',
+                                 LOCATION=config['cache'][len('file://'):])
+    else:
+        models.cache = get_cache(config['cache'])
+    return Worker(config, workerId).run()
+
+
+def summarize(config, workerResults):
+    histograms = {}
+    errors = {}
+    staleness = stats.Histogram()
+    unseen = 0
+    created = 0
+    for result in workerResults:
+        created += result['sharedFoldersCreated']
+        for op, histDict in result['histograms'].iteritems():
+            hist = stats.Histogram()
+            hist.__dict__.update(histDict)
+            if op in histograms:
+                histograms[op].merge(hist)
+            else:
+                histograms[op] = hist
+        for key, count in result['errors'].iteritems():
+            errors[key] = errors.get(key, 0) + count
+        for seconds in result['staleness']:
+            staleness.observe(seconds * 1000)
+        unseen += result['unseenWrites']
+
+    totalOps = sum([hist.count for hist in histograms.itervalues()])
+    allOps = stats.Histogram()
+    for hist in histograms.itervalues():
+        allOps.merge(hist)
+
+    def summary(hist):
+        result = hist.getSummary()
+        result['throughput'] = hist.count / float(config['duration'])
+        return result
+
+    return {'config': dict([(k, v) for k, v in config.iteritems()
+                            if k not in ('users', 'paths')]),
+            'workers': len(workerResults),
+            'totalOps': totalOps,
+            'throughput': totalOps / float(config['duration']),
+            'latencyMs': summary(allOps),
+            'operations': dict([(op, summary(hist)) for op, hist in histograms.iteritems()]),
+            'errors': errors,
+            # how long after a mkdir other workers kept missing the new folder
+            'stalenessMs': staleness.getSummary(),
+            'writesNeverSeen': unseen,
+            # getOrMkdir must create each shared name exactly once
+            'sharedFoldersCreated': created}
+
+
+def runLoadTest(config, managePy):
+    """
+    Runs the load test described by @config, using @managePy to start
+    the worker processes.  Returns a JSON-friendly summary.
+    """
+    if connection.vendor == 'sqlite' and connection.settings_dict['NAME'] in ('', ':memory:'):
+        raise ValueError('the load test needs a database that worker processes can share')
+
+    setUp(config)
+    try:
+        # let every worker finish importing django before the clock starts
+        config['startTime'] = time.time() + config['startDelay']
+        configPath = os.path.join(config['workDir'], 'config.json')
+        with open(configPath, 'w') as configFile:
+            json.dump(config, configFile)
+        connection.close()
+
+        procs = []
+        for workerId in xrange(config['workers']):
+            procs.append(subprocess.Popen([sys.executable, managePy, 'geocamfolder_loadtest',
+                                           '--runWorker=%d' % workerId,
+                                           '--config=%s' % configPath],
+                                          stdout=subprocess.PIPE))
+        workerResults = []
+        for proc in procs:
+            out, _ = proc.communicate()
+            if proc.returncode != 0:
+                raise RuntimeError('load test worker failed with status %s' % proc.returncode)
+            workerResults.append(json.loads(out))
+    finally:
+        tearDown(config)
+
+    return summarize(config, workerResults)
@@ -0,0 +1,76 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+import sys
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from geocamFolder.benchmark import BenchmarkConfig, runBenchmark
+
+
+class Command(BaseCommand):
+    help = ('Time folder and permission operations on a synthetic deployment. '
+            'Runs in a scratch test database, so it never touches site data.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--folders', type='int', default=1000,
+                    help='Number of folders to generate [%default]'),
+        make_option('--depth', type='int', default=5,
+                    help='Maximum folder tree depth [%default]'),
+        make_option('--fanout', type='int', default=10,
+                    help='Maximum subfolders per folder [%default]'),
+        make_option('--users', type='int', default=100,
+                    help='Number of users [%default]'),
+        make_option('--groups', type='int', default=10,
+                    help='Number of groups [%default]'),
+        make_option('--groupsPerUser', type='int', default=2,
+                    help='Number of groups each user belongs to [%default]'),
+        make_option('--aclDensity', type='float', default=0.1,
+                    help='Fraction of folders with an extra ACL entry [%default]'),
+        make_option('--members', type='int', default=1000,
+                    help='Number of folder member objects [%default]'),
+        make_option('--repeat', type='int', default=100,
+                    help='Number of calls to time per operation [%default]'),
+        make_option('--seed', type='int', default=0,
+                    help='Random seed [%default]'),
+        make_option('--operations',
+                    help='Comma-separated names of the operations to time [all]'),
+        make_option('--cache', type='choice', choices=('on', 'off', 'both'), default='both',
+                    help='Run with the folder cache on, off or both [%default]'),
+        make_option('-o', '--output',
+                    help='Write JSON results to this file instead of stdout'),
+        )
+
+    def handle(self, *args, **options):
+        if options['operations']:
+            options['operations'] = options['operations'].split(',')
+        config = BenchmarkConfig(**dict([(key, options[key])
+                                         for key in BenchmarkConfig().__dict__.iterkeys()]))
+        cacheModes = {'on': (True,), 'off': (False,), 'both': (True, False)}[options['cache']]
+
+        # with the default sqlite settings the test db lives in memory
+        verbosity = int(options.get('verbosity', 1))
+        oldName = connection.creation.create_test_db(verbosity=verbosity, autoclobber=True)
+        try:
+            result = runBenchmark(config, cacheModes)
+        finally:
+            connection.creation.destroy_test_db(oldName, verbosity=verbosity)
+
+        text = json.dumps(result, indent=4, sort_keys=True) + '\n'
+        if options['output']:
+            with open(options['output'], 'w') as out:
+                out.write(text)
+        else:
+            self.stdout.write(text)
+
+        if verbosity >= 1:
+            for r in result['results']:
+                sys.stderr.write('%-24s cache=%-5s mean=%8.2fms p99=%8.2fms queries/call=%6.1f\n'
+                                 % (r['operation'], r['cacheEnabled'], r['mean'] or 0,
+                                    r['p99'] or 0, r['queriesPerCall'] or 0))
@@ -0,0 +1,36 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from geocamFolder.models import FolderChange, JOURNAL_COMPACT_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = ('Compact the folder change journal by dropping entries superseded by a later '
+            'entry for the same object, and optionally all entries older than --purgeDays')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--purgeDays',
+                    type='float',
+                    default=None,
+                    help=('Also delete every entry older than this many days. Consumers '
+                          'further behind must re-read the full tables')),
+        make_option('--chunkSize',
+                    type='int',
+                    default=JOURNAL_COMPACT_CHUNK_SIZE,
+                    help='Objects to collapse per transaction [%default]'),
+        )
+
+    def handle(self, *args, **options):
+        n = FolderChange.collapse(options['chunkSize'])
+        self.stdout.write('dropped %d superseded entries\n' % n)
+        if options['purgeDays'] is not None:
+            n = FolderChange.purge(time.time() - options['purgeDays'] * 24 * 60 * 60)
+            self.stdout.write('purged %d old entries\n' % n)
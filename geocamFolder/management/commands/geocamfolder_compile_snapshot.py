@@ -0,0 +1,53 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from geocamFolder.models import getCacheGeneration
+from geocamFolder.snapshot import compileSnapshot
+
+
+class Command(BaseCommand):
+    help = 'Compile the folder tree and ACLs into a memory-mapped policy snapshot file'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--path',
+                    default=None,
+                    help='Snapshot file to write [GEOCAM_FOLDER_SNAPSHOT_PATH]'),
+        make_option('--watch',
+                    type='float',
+                    default=None,
+                    help='Keep running, recompiling whenever the folder/ACL generation '
+                    'changes; poll every WATCH seconds'),
+        )
+
+    def compile(self, path):
+        start = time.time()
+        try:
+            generation = compileSnapshot(path)
+        finally:
+            # don't hold a read transaction open between compiles
+            transaction.rollback_unless_managed()
+        self.stdout.write('wrote %s generation %s in %.2f seconds\n'
+                          % (path, generation, time.time() - start))
+        return generation
+
+    def handle(self, *args, **options):
+        path = options['path'] or settings.GEOCAM_FOLDER_SNAPSHOT_PATH
+        if not path:
+            raise CommandError('specify --path or set GEOCAM_FOLDER_SNAPSHOT_PATH')
+        generation = self.compile(path)
+        if options['watch'] is None:
+            return
+        while True:
+            time.sleep(options['watch'])
+            if getCacheGeneration() != generation:
+                generation = self.compile(path)
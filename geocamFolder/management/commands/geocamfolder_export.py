@@ -0,0 +1,41 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from geocamFolder import importExport
+
+
+class Command(BaseCommand):
+    help = 'Stream folders and ACLs to a JSON Lines or CSV file'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', type='choice', choices=('jsonl', 'csv'), default='jsonl',
+                    help='Output format [%default]'),
+        make_option('--root', default='/',
+                    help='Export only the subtree at this path [%default]'),
+        make_option('--chunkSize', type='int', default=importExport.DEFAULT_CHUNK_SIZE,
+                    help='Number of folders to fetch per query [%default]'),
+        make_option('-o', '--output',
+                    help='Write to this file instead of stdout'),
+        )
+
+    def handle(self, *args, **options):
+        start = time.time()
+        records = importExport.iterRecords(options['root'], options['chunkSize'])
+        if options['output']:
+            with open(options['output'], 'wb') as out:
+                n = importExport.writeRecords(records, out, options['format'])
+        else:
+            n = importExport.writeRecords(records, sys.stdout, options['format'])
+        elapsed = time.time() - start
+        if int(options.get('verbosity', 1)) >= 1:
+            sys.stderr.write('exported %d records in %.1f seconds (%.0f records/s)\n'
+                             % (n, elapsed, n / elapsed if elapsed else 0))
@@ -0,0 +1,43 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from geocamFolder import importExport
+
+
+class Command(BaseCommand):
+    help = 'Import folders and ACLs from a file written by geocamfolder_export'
+    args = '<file>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', type='choice', choices=('jsonl', 'csv'), default='jsonl',
+                    help='Input format [%default]'),
+        make_option('--chunkSize', type='int', default=importExport.DEFAULT_CHUNK_SIZE,
+                    help='Number of records per transaction [%default]'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('expected exactly one input file; use - for stdin')
+        if args[0] == '-':
+            inp = sys.stdin
+        else:
+            inp = open(args[0], 'rb')
+        try:
+            importer = importExport.FolderImporter(chunkSize=options['chunkSize'])
+            result = importer.run(importExport.readRecords(inp, options['format']))
+        finally:
+            if inp is not sys.stdin:
+                inp.close()
+
+        self.stdout.write('imported %(folders)d folders and %(acls)d ACL entries '
+                          '(%(existingFolders)d folders already existed, %(errors)d records skipped) '
+                          'from %(records)d records in %(seconds).1f seconds '
+                          '(%(recordsPerSecond).0f records/s)\n' % result)
@@ -0,0 +1,73 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+import sys
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from geocamFolder import loadtest
+
+
+class Command(BaseCommand):
+    help = ('Run a mixed read/write folder workload from several worker processes '
+            'that share a cache, and report throughput, latency and staleness. '
+            'Works on a scratch folder tree in the site database.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=4,
+                    help='Number of worker processes [%default]'),
+        make_option('--duration', type='float', default=30,
+                    help='Seconds to run the workload [%default]'),
+        make_option('--writeFraction', type='float', default=0.05,
+                    help='Fraction of operations that are writes [%default]'),
+        make_option('--folders', type='int', default=200,
+                    help='Number of scratch folders [%default]'),
+        make_option('--users', type='int', default=20,
+                    help='Number of scratch users [%default]'),
+        make_option('--cache', default=loadtest.FILE_CACHE,
+                    help=('Cache shared by the workers: "file" for a file-based cache in a scratch '
+                          'directory, or a cache backend URI such as memcached://127.0.0.1:11211/ '
+                          '[%default]')),
+        make_option('--sharedNames', type='int', default=20,
+                    help='Number of folder names the workers race to create with getOrMkdir '
+                    '[%default]'),
+        make_option('--seed', type='int', default=0,
+                    help='Random seed [%default]'),
+        make_option('-o', '--output',
+                    help='Write JSON results to this file instead of stdout'),
+        # used internally to start the workers
+        make_option('--runWorker', type='int', help='(internal)'),
+        make_option('--config', help='(internal)'),
+        )
+
+    def handle(self, *args, **options):
+        if options['runWorker'] is not None:
+            with open(options['config']) as configFile:
+                config = json.load(configFile)
+            result = loadtest.runWorker(config, options['runWorker'])
+            self.stdout.write(json.dumps(result))
+            return
+
+        config = {'workers': options['workers'],
+                  'duration': options['duration'],
+                  'writeFraction': options['writeFraction'],
+                  'numFolders': options['folders'],
+                  'numUsers': options['users'],
+                  'cache': options['cache'],
+                  'sharedNames': options['sharedNames'],
+                  'seed': options['seed'],
+                  'startDelay': 3.0,
+                  'stalenessCheckInterval': 10}
+        result = loadtest.runLoadTest(config, sys.argv[0])
+
+        text = json.dumps(result, indent=4, sort_keys=True) + '\n'
+        if options['output']:
+            with open(options['output'], 'w') as out:
+                out.write(text)
+        else:
+            self.stdout.write(text)
@@ -0,0 +1,53 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from geocamFolder import stats
+
+
+class Command(BaseCommand):
+    help = 'Print geocamFolder cache and permission-check statistics collected by worker processes'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--json',
+                    action='store_true',
+                    default=False,
+                    help='Print the statistics as JSON'),
+        make_option('--reset',
+                    action='store_true',
+                    default=False,
+                    help='Discard the published statistics after printing them'),
+        )
+
+    def handle(self, *args, **options):
+        snapshots = stats.getPublishedSnapshots()
+        counters, histograms = stats.mergeSnapshots(snapshots)
+
+        if options['json']:
+            result = {'processes': len(snapshots),
+                      'counters': counters,
+                      'histograms': dict([(name, hist.getSummary())
+                                          for name, hist in histograms.iteritems()])}
+            self.stdout.write(json.dumps(result, indent=4, sort_keys=True) + '\n')
+        else:
+            self.stdout.write('statistics published by %d processes\n\n' % len(snapshots))
+            self.stdout.write('%-60s %12s\n' % ('counter', 'value'))
+            for name in sorted(counters.iterkeys()):
+                self.stdout.write('%-60s %12s\n' % (name, counters[name]))
+            self.stdout.write('\n%-60s %8s %10s %10s %10s %10s\n'
+                              % ('histogram', 'count', 'mean', 'p50', 'p99', 'max'))
+            for name in sorted(histograms.iterkeys()):
+                summary = histograms[name].getSummary()
+                self.stdout.write('%-60s %8d %10.2f %10.2f %10.2f %10.2f\n'
+                                  % (name, summary['count'], summary['mean'],
+                                     summary['p50'], summary['p99'], summary['max']))
+
+        if options['reset']:
+            stats.clearPublishedSnapshots()
@@ -0,0 +1,62 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import get_model
+
+from geocamFolder.models import FolderMemberCount, MEMBER_SYNC_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    args = '<app_label.ModelName> ...'
+    help = ('Recompute the denormalized primaryFolder and hasOtherFolders fields and '
+            'the per-folder member counts of FolderMember models, e.g. after setting '
+            'denormalizeFolders or countFolderMembers on a model with existing rows')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunkSize',
+                    type='int',
+                    default=MEMBER_SYNC_CHUNK_SIZE,
+                    help='Members to update per transaction [%default]'),
+        )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('expected at least one model name')
+        for name in args:
+            try:
+                appLabel, modelName = name.split('.')
+            except ValueError:
+                raise CommandError('expected app_label.ModelName, got %s' % name)
+            model = get_model(appLabel, modelName)
+            if model is None:
+                raise CommandError('no such model %s' % name)
+            denormalize = getattr(model, 'denormalizeFolders', False)
+            count = getattr(model, 'countFolderMembers', False)
+            if not (denormalize or count):
+                raise CommandError('%s sets neither denormalizeFolders nor countFolderMembers'
+                                   % name)
+
+            if count:
+                with transaction.commit_on_success():
+                    FolderMemberCount.recount(model)
+                self.stdout.write('%s: recounted folder members\n' % name)
+            if not denormalize:
+                continue
+
+            chunkSize = options['chunkSize']
+            allIds = model.objects.order_by('pk').values_list('pk', flat=True)
+            ids = list(allIds[:chunkSize])
+            n = 0
+            while ids:
+                with transaction.commit_on_success():
+                    model.syncPrimaryFolders(ids, chunkSize)
+                n += len(ids)
+                ids = list(allIds.filter(pk__gt=ids[-1])[:chunkSize])
+            self.stdout.write('%s: synced %d members\n' % (name, n))
@@ -0,0 +1,114 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+import re
+import copy
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.utils import DatabaseError
+from django.db.backends.util import truncate_name
+
+from geocamFolder.models import UserPermission, GroupPermission, Actions
+
+PERMISSION_MODELS = ((UserPermission, 'user'), (GroupPermission, 'group'))
+INDEX_NAME_REGEX = re.compile(r'CREATE INDEX (\S+) ON')
+
+
+def getIndexNames(statements):
+    return [INDEX_NAME_REGEX.search(sql).group(1).strip('"`') for sql in statements]
+
+
+class Command(BaseCommand):
+    help = ('Replace the old single-column indexes on the permission agent and action '
+            'flags with the composite (agent, folder, action flags) index used by new installs')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--database', default=DEFAULT_DB_ALIAS,
+                    help='Database to upgrade [%default]'),
+        make_option('--partial',
+                    action='store_true',
+                    default=False,
+                    help=('On PostgreSQL and SQLite, use an (agent, folder) index plus '
+                          'smaller partial indexes on (agent, folder) WHERE <action flag> '
+                          'instead'),),
+        make_option('--dry-run',
+                    action='store_true',
+                    default=False,
+                    help='Print the SQL without running it'),
+        )
+
+    def getStatements(self, conn, partial):
+        qn = conn.ops.quote_name
+        creation = conn.creation
+        style = no_style()
+        if conn.vendor == 'mysql':
+            dropSql = 'DROP INDEX %s ON %s'
+        else:
+            dropSql = 'DROP INDEX IF EXISTS %s'
+
+        statements = []
+        for model, agentField in PERMISSION_MODELS:
+            table = model._meta.db_table
+            drops = []
+            creates = []
+            oldIndexed = [agentField] + [model.getActionField(action) for action in Actions.ALL]
+            for name in oldIndexed:
+                field = copy.copy(model._meta.get_field(name))
+                field.db_index = True
+                drops += getIndexNames(creation.sql_indexes_for_field(model, field, style))
+
+            composites = []
+            for fieldNames in model._meta.index_together:
+                fields = [model._meta.get_field(name) for name in fieldNames]
+                composites += creation.sql_indexes_for_fields(model, fields, style)
+
+            if partial and conn.vendor in ('postgresql', 'sqlite'):
+                drops += getIndexNames(composites)
+                agentColumn = model._meta.get_field(agentField).column
+                folderColumn = model._meta.get_field('folder').column
+                # still needed for plain filter(<agent>=...) lookups
+                name = truncate_name('%s_%s_folder' % (table, agentColumn.lower()),
+                                     conn.ops.max_name_length())
+                creates.append('CREATE INDEX %s ON %s (%s, %s);'
+                               % (qn(name), qn(table), qn(agentColumn), qn(folderColumn)))
+                for action in Actions.ALL:
+                    flagColumn = model.getActionField(action)
+                    name = truncate_name('%s_%s_partial' % (table, flagColumn.lower()),
+                                         conn.ops.max_name_length())
+                    creates.append('CREATE INDEX %s ON %s (%s, %s) WHERE %s;'
+                                   % (qn(name), qn(table), qn(agentColumn),
+                                      qn(folderColumn), qn(flagColumn)))
+            else:
+                creates += composites
+
+            statements += [dropSql % (qn(name), qn(table)) if conn.vendor == 'mysql'
+                           else dropSql % qn(name)
+                           for name in drops]
+            statements += creates
+        return statements
+
+    def handle(self, *args, **options):
+        using = options['database']
+        conn = connections[using]
+        statements = self.getStatements(conn, options['partial'])
+        if options['dry_run']:
+            for sql in statements:
+                self.stdout.write(sql + '\n')
+            return
+
+        cursor = conn.cursor()
+        for sql in statements:
+            try:
+                cursor.execute(sql)
+                transaction.commit_unless_managed(using=using)
+                self.stdout.write('ok: %s\n' % sql)
+            except DatabaseError, e:
+                # typically an index that is already gone or already exists
+                transaction.rollback_unless_managed(using=using)
+                self.stdout.write('skipped (%s): %s\n' % (e, sql))
@@ -5,19 +5,40 @@
 # __END_LICENSE__
 
 import os
+import time
+import bisect
+import json
+import base64
+import logging
 import operator
+import threading
+import Queue
+import cPickle as pickle
 from cStringIO import StringIO
+from contextlib import contextmanager
 
-from django.db import models
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from django.db import models, connection, connections, transaction, router
+from django.db.models import Q, F, Count, Max
+from django.db.models.signals import m2m_changed, pre_delete, post_save, post_delete
+from django.db.utils import IntegrityError
 from django.contrib.auth.models import User, Group
 from django.core.cache import cache
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
+from django.core.signals import request_finished
 from django.utils.http import urlquote
 
 from geocamUtil.models.UuidField import UuidField
 from geocamUtil.models.ExtrasDotField import ExtrasDotField
 from django.conf import settings
 
+from geocamFolder import stats
+from geocamFolder.routers import readFromPrimary
+
 # pylint: disable=C1001,E1101
 
 ACTION_CHOICES = (
@@ -52,6 +73,27 @@ GROUP_ANYUSER_ID = 1
 GROUP_AUTHUSER_ID = 2
 
 FOLDER_CACHE_VERSION = 1
+FOLDER_GENERATION_KEY = 'geocamFolder.generation'
+FOLDER_FLUSH_GENERATION_KEY = 'geocamFolder.flushGeneration'
+SHARD_GENERATION_PREFIX = 'geocamFolder.shardGeneration.'
+MEMBER_COUNT_GENERATION_KEY = 'geocamFolder.memberCountGeneration'
+FOLDER_GENERATION_TIMEOUT_SECONDS = 30 * 24 * 60 * 60
+
+ROOT_FOLDER_ID = 1
+ROOT_SHARD = 0
+
+# max number of folders per "folder IN (...)" query when fetching ACLs
+ACL_QUERY_CHUNK_SIZE = 500
+MEMBER_SYNC_CHUNK_SIZE = 500
+ITER_ALLOWED_CHUNK_SIZE = 1000
+BULK_CREATE_BATCH_SIZE = 500
+BULK_CREATE_MAX_ATTEMPTS = 3
+MKDIR_MAX_ATTEMPTS = 3
+JOURNAL_PAGE_SIZE = 1000
+JOURNAL_COMPACT_CHUNK_SIZE = 100
+
+# max number of shard search indexes kept in process memory
+SEARCH_INDEX_MEMO_MAX_SIZE = 1000
 
 
 def getCacheKey(resultFunc, args):
@@ -59,61 +101,537 @@ def getCacheKey(resultFunc, args):
     return urlquote(prefix + '.'.join([repr(arg) for arg in args]))
 
 
+def getCacheLockKey(cacheKey):
+    return cacheKey + '.lock'
+
+
+def _getPickledSize(result):
+    try:
+        return len(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+    except (pickle.PicklingError, TypeError):
+        return None
+
+
+def _setCacheEntry(cacheKey, resultFunc, args, timeout):
+    statName = 'rebuild.' + resultFunc.__name__
+    # shared under the current generation, so read from the primary
+    # rather than a replica that may not have the latest write
+    with stats.timer(statName, countQueries=True), readFromPrimary():
+        result = resultFunc(*args)
+    if settings.GEOCAM_FOLDER_STATS_ENABLED:
+        size = _getPickledSize(result)
+        if size is not None:
+            stats.observe(statName + '.bytes', size)
+    # entries are stored as (result, freshUntil) and kept past their
+    # nominal timeout so a stale value can be served while one
+    # process recomputes the fresh one
+    freshUntil = time.time() + timeout
+    cache.set(cacheKey, (result, freshUntil),
+              timeout + settings.GEOCAM_FOLDER_FOLDER_CACHE_STALE_SECONDS)
+    return result
+
+
+def _recomputeWithLock(cacheKey, resultFunc, args, timeout):
+    try:
+        return _setCacheEntry(cacheKey, resultFunc, args, timeout)
+    finally:
+        cache.delete(getCacheLockKey(cacheKey))
+
+
+def _acquireCacheLock(cacheKey):
+    # cache.add() is atomic in the shared cache backends, so only one
+    # process wins the lock
+    return cache.add(getCacheLockKey(cacheKey), os.getpid(),
+                     settings.GEOCAM_FOLDER_FOLDER_CACHE_LOCK_TIMEOUT_SECONDS)
+
+
+# refresh-ahead state. access counts are per-process and reset each
+# time a key is refreshed, so a key is "hot" if it was read at least
+# REFRESH_AHEAD_MIN_HITS times in this process since its last refresh.
+_refreshAccessCounts = {}
+_refreshQueue = None
+_refreshStartLock = threading.Lock()
+REFRESH_ACCESS_COUNTS_MAX_SIZE = 10000
+
+
+def _refreshAheadWorker():
+    while True:
+        cacheKey, resultFunc, args, timeout = _refreshQueue.get()
+        try:
+            _recomputeWithLock(cacheKey, resultFunc, args, timeout)
+        except:  # pylint: disable=W0702
+            logging.exception('geocamFolder: refresh-ahead of %s failed', cacheKey)
+        finally:
+            # worker threads live outside the request cycle, so nothing
+            # else will close their db connections
+            connection.close()
+            _refreshQueue.task_done()
+
+
+def _getRefreshQueue():
+    global _refreshQueue
+    if _refreshQueue is None:
+        with _refreshStartLock:
+            if _refreshQueue is None:
+                queue = Queue.Queue(settings.GEOCAM_FOLDER_FOLDER_CACHE_REFRESH_AHEAD_QUEUE_SIZE)
+                _refreshQueue = queue
+                for _ in xrange(settings.GEOCAM_FOLDER_FOLDER_CACHE_REFRESH_AHEAD_THREADS):
+                    thread = threading.Thread(target=_refreshAheadWorker,
+                                              name='geocamFolderRefreshAhead')
+                    thread.daemon = True
+                    thread.start()
+    return _refreshQueue
+
+
+def waitForRefreshAhead():
+    """
+    Block until all queued refresh-ahead jobs have finished.  Mostly
+    useful for tests.
+    """
+    if _refreshQueue is not None:
+        _refreshQueue.join()
+
+
+def _maybeRefreshAhead(cacheKey, resultFunc, args, timeout, freshUntil):
+    if len(_refreshAccessCounts) > REFRESH_ACCESS_COUNTS_MAX_SIZE:
+        _refreshAccessCounts.clear()
+    count = _refreshAccessCounts.get(cacheKey, 0) + 1
+    _refreshAccessCounts[cacheKey] = count
+
+    if count < settings.GEOCAM_FOLDER_FOLDER_CACHE_REFRESH_AHEAD_MIN_HITS:
+        return
+    if time.time() < freshUntil - settings.GEOCAM_FOLDER_FOLDER_CACHE_REFRESH_AHEAD_SECONDS:
+        return
+    if not _acquireCacheLock(cacheKey):
+        # another process is already refreshing it
+        return
+
+    _refreshAccessCounts.pop(cacheKey, None)
+    try:
+        _getRefreshQueue().put_nowait((cacheKey, resultFunc, args, timeout))
+    except Queue.Full:
+        cache.delete(getCacheLockKey(cacheKey))
+
+
 def getWithCache(resultFunc, args, timeout):
     """
     Memoizes call to resultFunc(*args) using the Django cache.
+
+    Only one process recomputes a given entry at a time.  When the
+    entry is stale, the process holding the entry's lock key recomputes
+    it while other processes keep serving the previous value.  When
+    there is no previous value, other processes wait up to
+    GEOCAM_FOLDER_FOLDER_CACHE_LOCK_WAIT_SECONDS for the lock holder to
+    finish before giving up and computing the result themselves.
+
+    If GEOCAM_FOLDER_FOLDER_CACHE_REFRESH_AHEAD_ENABLED is set, hot
+    entries are recomputed on a background thread shortly before they
+    go stale, so request threads rarely have to compute them inline.
     """
-    if settings.GEOCAM_FOLDER_FOLDER_CACHE_ENABLED:
-        cacheKey = getCacheKey(resultFunc, args)
-        result = cache.get(cacheKey)
-        if result is None:
-            result = resultFunc(*args)
-            cache.set(cacheKey, result, timeout)
-        return result
-    else:
+    if not settings.GEOCAM_FOLDER_FOLDER_CACHE_ENABLED:
         return resultFunc(*args)
 
+    statName = 'cache.' + resultFunc.__name__
+    cacheKey = getCacheKey(resultFunc, args)
+    with stats.timer(statName + '.get'):
+        entry = cache.get(cacheKey)
+    if entry is not None:
+        result, freshUntil = entry
+        if time.time() < freshUntil:
+            stats.incr(statName + '.hit')
+            if settings.GEOCAM_FOLDER_FOLDER_CACHE_REFRESH_AHEAD_ENABLED:
+                _maybeRefreshAhead(cacheKey, resultFunc, args, timeout, freshUntil)
+            return result
+        stats.incr(statName + '.stale')
+        if _acquireCacheLock(cacheKey):
+            return _recomputeWithLock(cacheKey, resultFunc, args, timeout)
+        else:
+            return result
+
+    stats.incr(statName + '.miss')
+    if _acquireCacheLock(cacheKey):
+        return _recomputeWithLock(cacheKey, resultFunc, args, timeout)
+
+    with stats.timer(statName + '.lockWait'):
+        deadline = time.time() + settings.GEOCAM_FOLDER_FOLDER_CACHE_LOCK_WAIT_SECONDS
+        while time.time() < deadline:
+            time.sleep(settings.GEOCAM_FOLDER_FOLDER_CACHE_LOCK_POLL_SECONDS)
+            entry = cache.get(cacheKey)
+            if entry is not None:
+                return entry[0]
+
+    # the lock holder is slow or died; don't keep the request waiting
+    stats.incr(statName + '.lockWaitTimeout')
+    return _setCacheEntry(cacheKey, resultFunc, args, timeout)
+
+
+def getManyWithCache(resultFunc, argsList, timeout):
+    """
+    Like getWithCache() for each args tuple in @argsList, but looks up
+    all the entries in one cache round trip.  Entries that are missing
+    or stale go through getWithCache(), so single-flight recomputation
+    still applies.  Returns the results in the order of @argsList.
+    """
+    if not settings.GEOCAM_FOLDER_FOLDER_CACHE_ENABLED:
+        return [resultFunc(*args) for args in argsList]
+
+    statName = 'cache.' + resultFunc.__name__
+    cacheKeys = [getCacheKey(resultFunc, args) for args in argsList]
+    with stats.timer(statName + '.getMany'):
+        entries = cache.get_many(cacheKeys)
+    now = time.time()
+    results = []
+    for cacheKey, args in zip(cacheKeys, argsList):
+        entry = entries.get(cacheKey)
+        if entry is not None and now < entry[1]:
+            stats.incr(statName + '.hit')
+            if settings.GEOCAM_FOLDER_FOLDER_CACHE_REFRESH_AHEAD_ENABLED:
+                _maybeRefreshAhead(cacheKey, resultFunc, args, timeout, entry[1])
+            results.append(entry[0])
+        else:
+            results.append(getWithCache(resultFunc, args, timeout))
+    return results
+
+
+def _getNewGeneration():
+    # time-based, so a generation lost from the cache is never reused
+    return int(time.time() * 1000)
+
+
+def _getGenerations(keys):
+    """
+    Returns a dict key -> generation for the generation counters
+    @keys, starting any that are missing from the cache.
+    """
+    generations = cache.get_many(keys)
+    for key in keys:
+        if generations.get(key) is None:
+            generation = _getNewGeneration()
+            if not cache.add(key, generation, FOLDER_GENERATION_TIMEOUT_SECONDS):
+                generation = cache.get(key) or generation
+            generations[key] = generation
+    return generations
+
+
+def _incrGeneration(key):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        generation = _getNewGeneration()
+        cache.set(key, generation, FOLDER_GENERATION_TIMEOUT_SECONDS)
+        return generation
+
+
+def getCacheGeneration():
+    """
+    Returns the folder/ACL cache generation shared by all processes
+    through the Django cache.  It changes whenever any process changes
+    a folder or ACL or calls flushCache().
+    """
+    return _getGenerations([FOLDER_GENERATION_KEY])[FOLDER_GENERATION_KEY]
+
+
+def syncCacheGeneration():
+    """
+    Catches this process up with flushCache() calls made by other
+    processes, so cached lookups after this call reflect every change
+    made before it.  Returns the shared generation.
+    """
+    global FOLDER_CACHE_VERSION
+    generations = _getGenerations([FOLDER_GENERATION_KEY, FOLDER_FLUSH_GENERATION_KEY])
+    if generations[FOLDER_FLUSH_GENERATION_KEY] != FOLDER_CACHE_VERSION:
+        FOLDER_CACHE_VERSION = generations[FOLDER_FLUSH_GENERATION_KEY]
+    return generations[FOLDER_GENERATION_KEY]
+
 
 def flushCache():
+    """
+    Invalidates every folder cache entry, in all shards.
+    """
+    _flushAll()
+    _notePendingFlush([None])
+
+
+def _flushAll():
     global FOLDER_CACHE_VERSION
-    FOLDER_CACHE_VERSION += 1
+    _incrGeneration(FOLDER_GENERATION_KEY)
+    generation = _incrGeneration(FOLDER_FLUSH_GENERATION_KEY)
+    FOLDER_CACHE_VERSION = max(FOLDER_CACHE_VERSION + 1, generation)
 
 
-def _addGroupAllowedFolders(allowed, groupId, action):
-    perms = GroupPermission.allowing(action).filter(group__id=groupId).only('folder')
-    for p in perms:
-        allowed[p.folder.id] = p.folder
+# A flush made inside a transaction managed by the caller
+# (TransactionMiddleware, commit_on_success()) runs before the commit,
+# so another process can still cache the old rows under the new
+# generation.  Such flushes are repeated by replayPendingFlushes().
+_pendingFlushes = threading.local()
 
 
-def _getAllowedFoldersNoCache(user, action):
+def _notePendingFlush(shardIds):
+    # @shardIds [None] stands for flushCache(), [] for a bare generation
+    # bump
+    if transaction.is_managed(using=router.db_for_write(Folder)):
+        if getattr(_pendingFlushes, 'shardIds', None) is None:
+            _pendingFlushes.shardIds = set()
+        _pendingFlushes.shardIds.update(shardIds)
+
+
+def replayPendingFlushes(**kwargs):
     """
-    Non-memoized version of getAllowedFolders.
+    Repeats the flushes this thread made inside caller-managed
+    transactions.  Runs when a request finishes, after
+    TransactionMiddleware has committed; code that manages its own
+    transactions outside a request should call it after committing.
     """
-    allowed = dict()
+    shardIds = getattr(_pendingFlushes, 'shardIds', None)
+    if shardIds is None:
+        return
+    _pendingFlushes.shardIds = None
+    if None in shardIds:
+        _flushAll()
+    elif shardIds:
+        for shardId in shardIds:
+            _flushShard(shardId)
+    else:
+        _incrGeneration(FOLDER_GENERATION_KEY)
 
-    _addGroupAllowedFolders(allowed, GROUP_ANYUSER_ID, action)
+request_finished.connect(replayPendingFlushes,
+                         dispatch_uid='geocamFolder.models.replayPendingFlushes')
 
-    if user is not None and user.is_active:
-        _addGroupAllowedFolders(allowed, GROUP_AUTHUSER_ID, action)
 
-        userPerms = UserPermission.allowing(action).filter(user=user).only('folder')
-        for p in userPerms:
-            allowed[p.folder.id] = p.folder
+# Cached folder data is sharded by top-level folder: shard X holds the
+# folders below top-level folder X, and ROOT_SHARD holds the root and
+# the top-level folders themselves.  Each shard has its own generation
+# counter in the cache, which is part of the cache keys of the shard's
+# entries, so a change to one project's folders or ACLs leaves the
+# other projects' cached trees and allowed-folder sets alone.
+
+def getShardGenerations(shardIds):
+    """
+    Returns a dict shard id -> current generation of the shard, in one
+    cache round trip.
+    """
+    keys = [SHARD_GENERATION_PREFIX + str(shardId) for shardId in shardIds]
+    generations = _getGenerations(keys)
+    return dict([(shardId, generations[key]) for shardId, key in zip(shardIds, keys)])
+
+
+def flushShard(shardId):
+    """
+    Invalidates the cache entries of shard @shardId.
+    """
+    _flushShard(shardId)
+    _notePendingFlush([shardId])
+
+
+def _flushShard(shardId):
+    _incrGeneration(SHARD_GENERATION_PREFIX + str(shardId))
+    _incrGeneration(FOLDER_GENERATION_KEY)
+
 
-        userGroups = user.groups.only('id')
-        for g in userGroups:
-            _addGroupAllowedFolders(allowed, g.id, action)
+def _getFolderShardIdNoCache(folderId):
+    """
+    Non-memoized version of getFolderShardId().
+    """
+    current = folderId
+    while True:
+        parents = list(Folder.objects.filter(id=current).values_list('parent', flat=True))
+        if not parents:
+            return None
+        if parents[0] is None:
+            return ROOT_SHARD
+        if parents[0] == ROOT_FOLDER_ID:
+            break
+        current = parents[0]
+    # @current is the top-level ancestor
+    return ROOT_SHARD if current == folderId else current
+
+
+def getFolderShardId(folderId):
+    """
+    Returns the cache shard of folder @folderId, or None if there is no
+    such folder.  Folders don't move between top-level folders, so the
+    answer stays cached until a folder is deleted.
+    """
+    if folderId == ROOT_FOLDER_ID:
+        return ROOT_SHARD
+    return getWithCache(_getFolderShardIdNoCache, (folderId,),
+                        settings.GEOCAM_FOLDER_FOLDER_CACHE_TIMEOUT_SECONDS)
+
+
+def _getChildShardId(folderId, shardId):
+    # the shard of the subfolders of folder @folderId in shard @shardId
+    if folderId == ROOT_FOLDER_ID:
+        return ROOT_SHARD
+    if shardId == ROOT_SHARD:
+        return folderId
+    return shardId
+
+
+def flushFolderShard(folderId, parentId):
+    """
+    Invalidates the shard of folder @folderId with parent @parentId
+    after a change to the folder or its ACL.  Flushes every shard if
+    the folder's shard can't be determined.
+    """
+    if parentId is None:
+        shardId = ROOT_SHARD
+    else:
+        parentShardId = getFolderShardId(parentId)
+        shardId = None if parentShardId is None else _getChildShardId(parentId, parentShardId)
+    if shardId is None:
+        flushCache()
+    else:
+        flushShard(shardId)
+
+
+def _getShardFoldersNoCache(shardId, generation):
+    """
+    Returns the folders in shard @shardId as a list of Folder objects
+    with only id, name and parent loaded.  @generation is the shard's
+    generation, which only serves to make the cache key.
+    """
+    fields = ('id', 'name', 'parent')
+    if shardId == ROOT_SHARD:
+        root = Folder.objects.only(*fields).get(id=ROOT_FOLDER_ID)
+        return [root] + list(Folder.objects.filter(parent=root.id).only(*fields))
+    folders = []
+    level = [shardId]
+    while level:
+        children = []
+        for i in xrange(0, len(level), ACL_QUERY_CHUNK_SIZE):
+            children += list(Folder.objects
+                             .filter(parent__in=level[i:i + ACL_QUERY_CHUNK_SIZE])
+                             .only(*fields))
+        folders += children
+        level = [f.id for f in children]
+    return folders
+
+
+def getShardFolders(shardIds):
+    """
+    Returns the folder lists of shards @shardIds (see
+    _getShardFoldersNoCache()) in the order of @shardIds.
+    """
+    if not settings.GEOCAM_FOLDER_FOLDER_CACHE_ENABLED:
+        return [_getShardFoldersNoCache(shardId, None) for shardId in shardIds]
+    generations = getShardGenerations(shardIds)
+    return getManyWithCache(_getShardFoldersNoCache,
+                            [(shardId, generations[shardId]) for shardId in shardIds],
+                            settings.GEOCAM_FOLDER_FOLDER_CACHE_TIMEOUT_SECONDS)
 
+
+def getShardIds():
+    """
+    Returns the ids of all shards, ROOT_SHARD first.
+    """
+    [rootShard] = getShardFolders([ROOT_SHARD])
+    return [ROOT_SHARD] + [f.id for f in rootShard if f.parent_id is not None]
+
+
+def _getAllowedFoldersNoCache(user, action):
+    """
+    Non-memoized version of getAllowedFolders.
+    """
+    groupIds = [GROUP_ANYUSER_ID]
+    if user is not None and user.is_active:
+        groupIds.append(GROUP_AUTHUSER_ID)
+        groupIds += [g.id for g in user.groups.only('id')]
+
+    allowed = dict()
+    perms = (GroupPermission.allowing(action)
+             .filter(group__in=groupIds)
+             .select_related('folder'))
+    if user is not None and user.is_active:
+        perms = list(perms) + list(UserPermission.allowing(action)
+                                   .filter(user=user)
+                                   .select_related('folder'))
+    for p in perms:
+        allowed[p.folder.id] = p.folder
     return allowed
 
 
+def _getAllowedFoldersInShardNoCache(user, action, shardId, generation):
+    """
+    Non-memoized version of the part of getAllowedFolders() in shard
+    @shardId, with shard generation @generation.
+    """
+    folders = dict([(f.id, f) for f in
+                    getWithCache(_getShardFoldersNoCache, (shardId, generation),
+                                 settings.GEOCAM_FOLDER_FOLDER_CACHE_TIMEOUT_SECONDS)])
+    groupIds = [GROUP_ANYUSER_ID]
+    isActive = user is not None and user.is_active
+    if isActive:
+        groupIds.append(GROUP_AUTHUSER_ID)
+        groupIds += list(user.groups.values_list('id', flat=True))
+
+    allowedIds = set()
+    folderIds = folders.keys()
+    for i in xrange(0, len(folderIds), ACL_QUERY_CHUNK_SIZE):
+        chunk = folderIds[i:i + ACL_QUERY_CHUNK_SIZE]
+        allowedIds.update(GroupPermission.allowing(action)
+                          .filter(group__in=groupIds, folder__in=chunk)
+                          .values_list('folder', flat=True))
+        if isActive:
+            allowedIds.update(UserPermission.allowing(action)
+                              .filter(user=user, folder__in=chunk)
+                              .values_list('folder', flat=True))
+    return dict([(folderId, folders[folderId]) for folderId in allowedIds])
+
+
 def getAllowedFolders(user, action):
     """
     Return folders for which @user has permission to perform @action.
     Folders are returned as a dict of folder.id -> folder object.
     """
-    return getWithCache(_getAllowedFoldersNoCache, (user, action),
-                        settings.GEOCAM_FOLDER_FOLDER_CACHE_TIMEOUT_SECONDS)
+    return getAllowedFoldersMulti(user, (action,))[action]
+
+
+def getAllowedFoldersMulti(user, actions, shardIds=None):
+    """
+    Like getAllowedFolders() for each action in @actions, combining the
+    cached per-shard results in a few cache round trips.  Returns a dict
+    action -> (dict of folder.id -> folder object).  If @shardIds is
+    given, only folders in those shards are included.
+    """
+    actions = list(actions)
+    if not settings.GEOCAM_FOLDER_FOLDER_CACHE_ENABLED:
+        return dict([(action, _getAllowedFoldersNoCache(user, action)) for action in actions])
+
+    if shardIds is None:
+        shardIds = getShardIds()
+    generations = getShardGenerations(shardIds)
+    argsList = [(user, action, shardId, generations[shardId])
+                for action in actions
+                for shardId in shardIds]
+    results = getManyWithCache(_getAllowedFoldersInShardNoCache, argsList,
+                               settings.GEOCAM_FOLDER_FOLDER_CACHE_TIMEOUT_SECONDS)
+    allowed = dict([(action, {}) for action in actions])
+    for (_, action, _, _), shardAllowed in zip(argsList, results):
+        allowed[action].update(shardAllowed)
+    return allowed
+
+
+def isFolderAllowed(folderId, user, action):
+    """
+    Like Folder.isAllowed() for the folder with id @folderId, without
+    needing the Folder object.  Only reads the cache shard the folder
+    is in.
+    """
+    if (not settings.GEOCAM_FOLDER_ACCESS_CONTROL_ENABLED
+            or ((user is not None) and user.is_superuser)):
+        return True
+    if settings.GEOCAM_FOLDER_SNAPSHOT_PATH:
+        # imported here since the snapshot module imports this one
+        from geocamFolder.snapshot import getCurrentSnapshot
+        snapshot = getCurrentSnapshot()
+        if snapshot is not None:
+            return snapshot.isAllowed(folderId, user, action)
+    if not settings.GEOCAM_FOLDER_FOLDER_CACHE_ENABLED:
+        return folderId in _getAllowedFoldersNoCache(user, action)
+    shardId = getFolderShardId(folderId)
+    if shardId is None:
+        return False
+    return folderId in getAllowedFoldersMulti(user, (action,), [shardId])[action]
 
 
 class FolderTree(object):
@@ -121,7 +639,8 @@ class FolderTree(object):
     A data structure that caches relationships in the Folder table.  The
     @root member of FolderTree is the root of a tree of folders; each
     folder has is annotated with a member @subFolders, which is a list
-    of subfolders, and @path, which is the complete path to that folder.
+    of subfolders, @path, which is the complete path to that folder,
+    and @shardId, the cache shard it belongs to.
     The @byId member of FolderTree is a lookup table id -> folder.
     """
     def __init__(self, root, byId):
@@ -129,37 +648,329 @@ class FolderTree(object):
         self.byId = byId
 
 
-def _getFolderTreeNoCache():
-    """
-    Non-memoized version of getFolderTree().
-    """
-    folders = Folder.objects.all().only('id', 'name', 'parent')
+def _buildFolderTree(folders):
     subFolderLookup = {}
     for f in folders:
-        subFolderLookup[f.parent_id] = subFolderLookup.get(f.parent_id, []) + [f]
+        subFolderLookup.setdefault(f.parent_id, []).append(f)
     [root] = subFolderLookup[None]
     tree = FolderTree(root, dict([(f.id, f) for f in folders]))
     root.path = '/'
+    root.shardId = ROOT_SHARD
     queue = [root]
     while queue:
         current = queue.pop()
         current.subFolders = {}
         for subFolder in subFolderLookup.get(current.id, []):
-            subFolder.path = current.path + '/' + subFolder.name
+            subFolder.path = current.path.rstrip('/') + '/' + subFolder.name
+            subFolder.shardId = _getChildShardId(current.id, current.shardId)
             current.subFolders[subFolder.name] = subFolder
             queue.append(subFolder)
     return tree
 
 
-def getFolderTree():
+def _getFolderTreeNoCache():
+    """
+    Non-memoized version of getFolderTree().
+    """
+    return _buildFolderTree(list(Folder.objects.all().only('id', 'name', 'parent')))
+
+
+class FolderNode(object):
+    """
+    A folder in a partial tree returned by getFolderTree(root, depth).
+    Like the Folder objects in a full FolderTree it has @id, @name,
+    @path, @shardId and @subFolders members, but @subFolders is loaded
+    from the cache the first time it is accessed.  Use getFolder() to
+    get the Folder model instance.
+    """
+    def __init__(self, tree, folderId, name, path, shardId):
+        self.tree = tree
+        self.id = folderId
+        self.name = name
+        self.path = path
+        self.shardId = shardId
+        self._subFolders = None
+
+    def __repr__(self):
+        return '<FolderNode: %s>' % self.path
+
+    @property
+    def subFolders(self):
+        if self._subFolders is None:
+            self.tree.loadLevel([self])
+        return self._subFolders
+
+    def isLoaded(self):
+        return self._subFolders is not None
+
+    def isAllowed(self, user, action):
+        return isFolderAllowed(self.id, user, action)
+
+    def getFolder(self):
+        return Folder.objects.get(id=self.id)
+
+
+class PartialFolderTree(FolderTree):
+    """
+    A FolderTree rooted at an arbitrary folder that loads each folder's
+    subfolders on demand.  The subfolder list of each folder is cached
+    separately, so the cost of a request depends on the part of the
+    tree it visits.  @byId holds only the nodes loaded so far.
+    """
+    def __init__(self, rootPath, depth):
+        [rootShard] = getShardFolders([ROOT_SHARD])
+        [top] = [f for f in rootShard if f.parent_id is None]
+        root = FolderNode(self, top.id, top.name, '/', ROOT_SHARD)
+        super(PartialFolderTree, self).__init__(root, {root.id: root})
+
+        for elt in [elt for elt in rootPath.split('/') if elt]:
+            try:
+                root = root.subFolders[elt]
+            except KeyError:
+                raise ObjectDoesNotExist("folder '%s' does not exist" % rootPath)
+        self.root = root
+        self.byId = {root.id: root}
+
+        level = [root]
+        for _ in xrange(depth):
+            if not level:
+                break
+            self.loadLevel(level)
+            level = [child for node in level for child in node._subFolders.itervalues()]
+
+    def loadLevel(self, nodes):
+        """
+        Loads the subfolders of @nodes in two cache round trips.
+        """
+        nodes = [node for node in nodes if not node.isLoaded()]
+        childShardIds = [_getChildShardId(node.id, node.shardId) for node in nodes]
+        if settings.GEOCAM_FOLDER_FOLDER_CACHE_ENABLED:
+            generations = getShardGenerations(list(set(childShardIds)))
+        else:
+            generations = dict.fromkeys(childShardIds)
+        subFolderLists = getManyWithCache(_getSubFolderListNoCache,
+                                          [(node.id, generations[shardId])
+                                           for node, shardId in zip(nodes, childShardIds)],
+                                          settings.GEOCAM_FOLDER_FOLDER_CACHE_TIMEOUT_SECONDS)
+        for node, shardId, subFolderList in zip(nodes, childShardIds, subFolderLists):
+            node._subFolders = {}
+            for folderId, name in subFolderList:
+                child = FolderNode(self, folderId, name, node.path.rstrip('/') + '/' + name,
+                                   shardId)
+                node._subFolders[name] = child
+                self.byId[folderId] = child
+
+
+def _getSubFolderListNoCache(folderId, generation):
+    """
+    Returns a list of (id, name) of the subfolders of folder @folderId.
+    @generation is the generation of the subfolders' shard.
+    """
+    return list(Folder.objects.filter(parent=folderId).values_list('id', 'name'))
+
+
+def getFolderTree(root=None, depth=None):
     """
     Returns a tree data structure for all folders in the system.  See
-    FolderTree class for details.
+    FolderTree class for details.  The tree is put together from the
+    cached folder lists of each shard.
+
+    If @root (a path) or @depth is given, returns a PartialFolderTree
+    rooted at @root instead, with @depth levels below it (default 1)
+    loaded up front and the rest loaded on demand.
+    """
+    if root is None and depth is None:
+        if not settings.GEOCAM_FOLDER_FOLDER_CACHE_ENABLED:
+            return _getFolderTreeNoCache()
+        [rootShard] = getShardFolders([ROOT_SHARD])
+        folders = list(rootShard)
+        for shardFolders in getShardFolders([f.id for f in rootShard if f.parent_id is not None]):
+            folders += shardFolders
+        return _buildFolderTree(folders)
+    rootPath = '/' + (root or '').strip('/')
+    return PartialFolderTree(rootPath, 1 if depth is None else depth)
+
+
+def _getSearchIndexNoCache(shardId, generation):
+    """
+    Returns the search index of shard @shardId as a dict with sorted
+    lists 'paths' of (path key, path, folder id, parent id) and 'names'
+    of (name key, path, folder id, parent id), and 'parents' mapping
+    folder ids to parent ids.  Paths in the root shard
+    are absolute; paths in other shards are relative to the shard's
+    top-level folder, so renaming that folder doesn't invalidate them.
+    Keys are lower case.  @generation is the shard's generation, which
+    only serves to make the cache key.
     """
-    return getWithCache(_getFolderTreeNoCache, (),
+    folders = _getShardFoldersNoCache(shardId, generation)
+    children = {}
+    for f in folders:
+        children.setdefault(f.parent_id, []).append(f)
+    if shardId == ROOT_SHARD:
+        [root] = children[None]
+        queue = [(root, '/')]
+    else:
+        queue = [(f, '/' + f.name) for f in children.get(shardId, [])]
+    paths = []
+    names = []
+    while queue:
+        f, path = queue.pop()
+        paths.append((path.lower(), path, f.id, f.parent_id))
+        names.append((f.name.lower(), path, f.id, f.parent_id))
+        # the root shard holds only the root and its children
+        if shardId != ROOT_SHARD or f.parent_id is None:
+            queue += [(child, path.rstrip('/') + '/' + child.name)
+                      for child in children.get(f.id, [])]
+    paths.sort()
+    names.sort()
+    parents = dict([(folderId, parentId) for _, _, folderId, parentId in paths])
+    return {'paths': paths, 'names': names, 'parents': parents}
+
+
+_searchIndexMemo = {}
+
+
+def getSearchIndexes(shardIds):
+    """
+    Returns the search indexes of shards @shardIds (see
+    _getSearchIndexNoCache()) in the order of @shardIds.  Besides the
+    Django cache, indexes are kept in process memory for as long as
+    their shard's generation stays current, since they are too big to
+    unpickle for every search.
+    """
+    if not settings.GEOCAM_FOLDER_FOLDER_CACHE_ENABLED:
+        return [_getSearchIndexNoCache(shardId, None) for shardId in shardIds]
+    generations = getShardGenerations(shardIds)
+    keys = [(FOLDER_CACHE_VERSION, shardId, generations[shardId]) for shardId in shardIds]
+    missing = [key for key in keys if key not in _searchIndexMemo]
+    if missing:
+        indexes = getManyWithCache(_getSearchIndexNoCache,
+                                   [(shardId, generation) for _, shardId, generation in missing],
+                                   settings.GEOCAM_FOLDER_FOLDER_CACHE_TIMEOUT_SECONDS)
+        if len(_searchIndexMemo) + len(missing) > SEARCH_INDEX_MEMO_MAX_SIZE:
+            _searchIndexMemo.clear()
+        _searchIndexMemo.update(zip(missing, indexes))
+    return [_searchIndexMemo[key] for key in keys]
+
+
+def _iterPrefixMatches(entries, prefixKey):
+    i = bisect.bisect_left(entries, (prefixKey,))
+    while i < len(entries) and entries[i][0].startswith(prefixKey):
+        yield entries[i]
+        i += 1
+
+
+def searchFolders(prefix, user, limit=20):
+    """
+    Returns up to @limit folders matching @prefix that @user may LIST
+    along with all their ancestors, so search only finds folders that
+    getFolder() and listdir() would.  A @prefix starting with
+    '/' matches the start of folder paths, sorted by path; any other
+    @prefix matches the start of folder names, sorted by name and then
+    path.  Matching ignores case.  The folders have @path set.
+    """
+    prefixKey = prefix.lower()
+    rootIndex = getSearchIndexes([ROOT_SHARD])[0]
+    topPaths = dict([(folderId, path) for _, path, folderId, parentId in rootIndex['paths']
+                     if parentId is not None])
+
+    if prefixKey.startswith('/'):
+        # shards whose paths can start with the prefix, and the prefix
+        # of their relative paths
+        shardPrefixes = []
+        for folderId, topPath in topPaths.iteritems():
+            topKey = topPath.lower() + '/'
+            if topKey.startswith(prefixKey):
+                shardPrefixes.append((folderId, ''))
+            elif prefixKey.startswith(topKey):
+                shardPrefixes.append((folderId, prefixKey[len(topKey) - 1:]))
+        field = 'paths'
+    else:
+        shardPrefixes = [(folderId, prefixKey) for folderId in topPaths]
+        field = 'names'
+    shardIds = [ROOT_SHARD] + [shardId for shardId, _ in shardPrefixes]
+    indexes = getSearchIndexes(shardIds)
+    shardPrefixes = [(ROOT_SHARD, prefixKey)] + shardPrefixes
+
+    if (not settings.GEOCAM_FOLDER_ACCESS_CONTROL_ENABLED
+            or ((user is not None) and user.is_superuser)):
+        listable = None
+    else:
+        listable = getAllowedFoldersMulti(user, (Action.LIST,), shardIds)[Action.LIST]
+    rootParents = indexes[0]['parents']
+    visible = {None: True}
+
+    def isVisible(folderId, parents):
+        # walk up to the nearest ancestor already known, then mark the
+        # folders on the way down
+        chain = []
+        while folderId not in visible:
+            chain.append(folderId)
+            folderId = parents.get(folderId, rootParents.get(folderId))
+        result = visible[folderId]
+        for f in reversed(chain):
+            result = result and f in listable
+            visible[f] = result
+        return result
+
+    # the first @limit matches overall are among the first @limit
+    # matches of each shard
+    matches = []
+    for (shardId, shardPrefix), index in zip(shardPrefixes, indexes):
+        n = 0
+        for key, path, folderId, _ in _iterPrefixMatches(index[field], shardPrefix):
+            if n >= limit:
+                break
+            if listable is not None and not isVisible(folderId, index['parents']):
+                continue
+            if shardId != ROOT_SHARD:
+                path = topPaths[shardId] + path
+            matches.append((key if field == 'names' else path.lower(), path.lower(), path, folderId))
+            n += 1
+    matches.sort()
+    matches = matches[:limit]
+
+    folders = Folder.objects.only('id', 'name', 'parent').in_bulk([m[3] for m in matches])
+    result = []
+    for _, _, path, folderId in matches:
+        folder = folders.get(folderId)
+        if folder is not None:
+            folder.path = path
+            result.append(folder)
+    return result
+
+
+def _getMemberCountsNoCache(generation):
+    """
+    Non-memoized version of getMemberCounts().  @generation is the
+    member count generation, which only serves to make the cache key.
+    """
+    counts = {}
+    for folderId, count in FolderMemberCount.objects.values_list('folder', 'count'):
+        counts[folderId] = counts.get(folderId, 0) + count
+    return counts
+
+
+def getMemberCounts():
+    """
+    Returns a dict folder.id -> number of objects in the folder, summed
+    over the FolderMember models that set countFolderMembers.  Folders
+    with no members may be missing.
+    """
+    if not settings.GEOCAM_FOLDER_FOLDER_CACHE_ENABLED:
+        return _getMemberCountsNoCache(None)
+    generation = _getGenerations([MEMBER_COUNT_GENERATION_KEY])[MEMBER_COUNT_GENERATION_KEY]
+    return getWithCache(_getMemberCountsNoCache, (generation,),
                         settings.GEOCAM_FOLDER_FOLDER_CACHE_TIMEOUT_SECONDS)
 
 
+def flushMemberCounts():
+    """
+    Invalidates the cached result of getMemberCounts().
+    """
+    _incrGeneration(MEMBER_COUNT_GENERATION_KEY)
+
+
 def getAgentByName(agentString):
     if agentString.startswith('group:'):
         groupName = agentString[len('group:'):]
@@ -168,6 +979,78 @@ def getAgentByName(agentString):
         return User.objects.get(username=agentString)
 
 
+@contextmanager
+def _transactionUnlessManaged(using=None):
+    """
+    Runs the block in its own transaction unless the caller is already
+    managing one (commit_on_success(), TransactionMiddleware), whose
+    commit or rollback then covers the block.  A nested
+    commit_on_success() would commit the caller's whole transaction when
+    it exits.
+    """
+    if transaction.is_managed(using=using):
+        yield
+    else:
+        with transaction.commit_on_success(using=using):
+            yield
+
+
+@contextmanager
+def _atomic(using=None):
+    """
+    Like _transactionUnlessManaged(), but if the block raises inside the
+    caller's transaction, rolls back to a savepoint taken at its start,
+    so the caller's own earlier writes survive if it handles the error.
+    """
+    with _transactionUnlessManaged(using):
+        sid = transaction.savepoint(using=using)
+        try:
+            yield
+        except:  # pylint: disable=W0702
+            transaction.savepoint_rollback(sid, using=using)
+            raise
+        transaction.savepoint_commit(sid, using=using)
+
+
+@contextmanager
+def _journaledSave(obj, using=None):
+    """
+    Wraps the save of @obj so that with the journal on, the row and the
+    journal entry written by its post_save handler commit together.
+    """
+    if not settings.GEOCAM_FOLDER_JOURNAL_ENABLED:
+        yield
+        return
+    with _transactionUnlessManaged(using or router.db_for_write(obj.__class__, instance=obj)):
+        yield
+
+
+def allocatePks(model, n, using='default'):
+    """
+    Returns @n unused primary key values for @model so callers can
+    bulk_create() rows and refer to them without reading them back.
+    Call it inside the transaction that inserts the rows.  On backends
+    without sequences two concurrent callers can get the same keys, in
+    which case one of the inserts fails with an IntegrityError and
+    should be retried.
+    """
+    if n == 0:
+        return []
+    conn = connections[using]
+    table = model._meta.db_table
+    pkColumn = model._meta.pk.column
+    cursor = conn.cursor()
+    if conn.vendor == 'postgresql':
+        cursor.execute('SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+                       [table, pkColumn, n])
+        return [row[0] for row in cursor.fetchall()]
+    else:
+        qn = conn.ops.quote_name
+        cursor.execute('SELECT MAX(%s) FROM %s' % (qn(pkColumn), qn(table)))
+        start = (cursor.fetchone()[0] or 0) + 1
+        return range(start, start + n)
+
+
 class Folder(models.Model):
     name = models.CharField(max_length=32, db_index=True)
     parent = models.ForeignKey('self', null=True, db_index=True)
@@ -186,23 +1069,61 @@ class Folder(models.Model):
         return result
 
     def save(self, *args, **kwargs):
-        # folder change invalidates permission cache
-        flushCache()
-        super(Folder, self).save(*args, **kwargs)
+        created = self.id is None
+        with _journaledSave(self, kwargs.get('using')):
+            super(Folder, self).save(*args, **kwargs)
+        # folder change invalidates its cache shard
+        flushFolderShard(self.id, self.parent_id)
+        if created:
+            # the id may have belonged to a folder in a rolled-back transaction
+            cache.delete(getCacheKey(_getFolderShardIdNoCache, (self.id,)))
 
     def isAllowed(self, user, action):
-        return (not settings.GEOCAM_FOLDER_ACCESS_CONTROL_ENABLED
-                or (((user is not None) and user.is_superuser)
-                    or (self.id in getAllowedFolders(user, action))))
+        with stats.timer('permission.folderIsAllowed', countQueries=True):
+            return isFolderAllowed(self.id, user, action)
 
     def getAcl(self):
-        aclDict = {}
-        for perm in UserPermission.objects.filter(folder=self):
-            aclDict[perm.user.username] = perm.getActions()
-        for perm in GroupPermission.objects.filter(folder=self):
-            agentName = 'group:' + perm.group.name
-            aclDict[agentName] = perm.getActions()
-        return aclDict
+        return Folder.getAcls([self])[self.id]
+
+    @classmethod
+    def getAcls(cls, folders):
+        """
+        Returns the ACLs of @folders (Folder objects or ids) as a dict
+        folder id -> {agentName: actions}, in the format of getAcl().
+        Issues two queries per ACL_QUERY_CHUNK_SIZE folders.
+        """
+        folderIds = [getattr(f, 'id', f) for f in folders]
+        acls = dict([(folderId, {}) for folderId in folderIds])
+        for i in xrange(0, len(folderIds), ACL_QUERY_CHUNK_SIZE):
+            chunk = folderIds[i:i + ACL_QUERY_CHUNK_SIZE]
+            for perm in UserPermission.objects.filter(folder__in=chunk).select_related('user'):
+                acls[perm.folder_id][perm.user.username] = perm.getActions()
+            for perm in GroupPermission.objects.filter(folder__in=chunk).select_related('group'):
+                acls[perm.folder_id]['group:' + perm.group.name] = perm.getActions()
+        return acls
+
+    @classmethod
+    def iterAcls(cls, querySet=None, chunkSize=ACL_QUERY_CHUNK_SIZE):
+        """
+        Yields (folder, acl) pairs for the folders in @querySet (default:
+        all folders) in primary key order.  Folders are fetched
+        @chunkSize at a time by primary key range, so memory use stays
+        bounded and each chunk costs three queries.
+        """
+        if querySet is None:
+            querySet = cls.objects.all()
+        lastId = None
+        while True:
+            page = querySet.order_by('pk')
+            if lastId is not None:
+                page = page.filter(pk__gt=lastId)
+            folders = list(page[:chunkSize])
+            if not folders:
+                return
+            acls = cls.getAcls(folders)
+            for folder in folders:
+                yield folder, acls[folder.id]
+            lastId = folders[-1].id
 
     def getAclText(self):
         acl = self.getAcl().items()
@@ -212,6 +1133,57 @@ class Folder(models.Model):
             print >> out, '  %s %s' % (agentName, actions)
         return out.getvalue()
 
+    def getAllowedActions(self, user, actions=Actions.ALL):
+        """
+        Returns the subset of @actions that @user may perform on this
+        folder, as an action string.  Checks all the actions with one
+        cache round trip instead of one per isAllowed() call.
+        """
+        if (not settings.GEOCAM_FOLDER_ACCESS_CONTROL_ENABLED
+                or ((user is not None) and user.is_superuser)):
+            return actions
+        shardId = getFolderShardId(self.id)
+        if shardId is None:
+            return ''
+        allowed = getAllowedFoldersMulti(user, actions, [shardId])
+        return ''.join([action for action in actions if self.id in allowed[action]])
+
+    def getAllowedGroups(self, action):
+        """
+        Returns a query set of the groups that the ACL of this folder
+        allows to perform @action, including the special anyuser and
+        authuser groups.
+        """
+        return Group.objects.filter(id__in=(GroupPermission.allowing(action)
+                                            .filter(folder=self)
+                                            .values('group')))
+
+    def getAllowedUsers(self, action):
+        """
+        Returns a query set of the users who are allowed to perform
+        @action on this folder, following the same rules as isAllowed().
+        The anonymous user is not a User; check isAllowed(None, action)
+        for that case.
+        """
+        if not settings.GEOCAM_FOLDER_ACCESS_CONTROL_ENABLED:
+            return User.objects.all()
+        groupIds = set(GroupPermission.allowing(action)
+                       .filter(folder=self)
+                       .values_list('group', flat=True))
+        if GROUP_ANYUSER_ID in groupIds:
+            return User.objects.all()
+        if GROUP_AUTHUSER_ID in groupIds:
+            return User.objects.filter(Q(is_active=True) | Q(is_superuser=True))
+        # subqueries rather than joins, so no user is listed twice
+        granted = Q(id__in=(UserPermission.allowing(action)
+                            .filter(folder=self)
+                            .values('user')))
+        if groupIds:
+            granted |= Q(id__in=(User.groups.through.objects
+                                 .filter(group__in=groupIds)
+                                 .values('user')))
+        return User.objects.filter(Q(is_superuser=True) | (Q(is_active=True) & granted))
+
     def assertAllowed(self, user, action):
         if not self.isAllowed(user, action):
             if user is None:
@@ -253,29 +1225,83 @@ class Folder(models.Model):
     def copyAcl(self, folder):
         self.clearAcl()
         for perm in UserPermission.objects.filter(folder=folder):
-            newPerm = UserPermission(user=perm.user, folder=self)
+            newPerm = UserPermission(user_id=perm.user_id, folder=self)
             newPerm.setActions(perm.getActions())
             newPerm.save()
         for perm in GroupPermission.objects.filter(folder=folder):
-            newPerm = GroupPermission(group=perm.group, folder=self)
+            newPerm = GroupPermission(group_id=perm.group_id, folder=self)
             newPerm.setActions(perm.getActions())
             newPerm.save()
 
-    def makeSubFolder(self, name, admin=None):
-        # note: db-level uniqueness check will fail if the subdir already exists
+    def _createSubFolder(self, name, admin):
+        # the folder and its ACL, in the caller's transaction. the ACL
+        # rows are bulk inserted, so the caller flushes the cache.
         subFolder = Folder(name=name, parent=self)
         subFolder.save()
-
-        subFolder.copyAcl(self)
+        for model, agentField in ((UserPermission, 'user_id'), (GroupPermission, 'group_id')):
+            perms = []
+            for perm in model.objects.filter(folder=self):
+                newPerm = model(folder=subFolder, **{agentField: getattr(perm, agentField)})
+                newPerm.setActions(perm.getActions())
+                perms.append(newPerm)
+            model.objects.bulk_create(perms)
+            if perms and settings.GEOCAM_FOLDER_JOURNAL_ENABLED:
+                # bulk_create() doesn't set the ids the journal needs
+                FolderChange.recordPermissions(model.objects.filter(folder=subFolder))
         if admin:
             subFolder.setPermissions(admin, Actions.ALL)
+        return subFolder
 
+    def makeSubFolder(self, name, admin=None):
+        """
+        Creates subfolder @name with a copy of this folder's ACL, plus
+        all permissions for @admin if given, in one transaction, or in
+        the caller's transaction if there is one.  Raises IntegrityError
+        if the subfolder already exists; see getOrMakeSubFolder().
+        """
+        with _atomic(router.db_for_write(Folder)):
+            subFolder = self._createSubFolder(name, admin)
+        # Folder.save() flushed before the ACL rows were committed
+        flushFolderShard(subFolder.id, self.id)
         return subFolder
 
+    def getOrMakeSubFolder(self, name, admin=None):
+        """
+        Returns (subFolder, created).  Like makeSubFolder(), but returns
+        the existing subfolder @name if there is one, including one
+        created concurrently by another process.  A new folder never
+        exists without its ACL.
+        """
+        for attempt in xrange(MKDIR_MAX_ATTEMPTS):
+            existing = list(Folder.objects.filter(parent=self, name=name))
+            if existing:
+                return existing[0], False
+            try:
+                with _atomic(router.db_for_write(Folder)):
+                    subFolder = self._createSubFolder(name, admin)
+            except IntegrityError:
+                # another writer created it first
+                subFolder = None
+            if subFolder is None:
+                stats.incr('folder.getOrMakeSubFolder.conflicts')
+                continue
+            flushFolderShard(subFolder.id, self.id)
+            return subFolder, True
+        # the conflicting folder keeps vanishing; let the caller see it
+        return self.makeSubFolder(name, admin), True
+
     def makeSubFolderAssertAllowed(self, requestingUser, name):
         self.assertAllowed(requestingUser, Action.INSERT)
         return self.makeSubFolder(name, admin=requestingUser)
 
+    def getOrMakeSubFolderAssertAllowed(self, requestingUser, name):
+        self.assertAllowed(requestingUser, Action.LIST)
+        existing = list(Folder.objects.filter(parent=self, name=name))
+        if existing:
+            return existing[0], False
+        self.assertAllowed(requestingUser, Action.INSERT)
+        return self.getOrMakeSubFolder(name, admin=requestingUser)
+
     def removeSubFolder(self, name):
         Folder.objects.get(name=name, parent=self).delete()
 
@@ -285,7 +1311,7 @@ class Folder(models.Model):
 
     @classmethod
     def getRootFolder(cls):
-        return cls.objects.get(pk=1)
+        return cls.objects.get(pk=ROOT_FOLDER_ID)
 
     @classmethod
     def getFolder(cls, path, workingFolder='/', requestingUser=None):
@@ -312,6 +1338,46 @@ class Folder(models.Model):
     def getFolderAssertAllowed(cls, requestingUser, path, workingFolder='/'):
         return cls.getFolder(path, workingFolder, requestingUser=requestingUser)
 
+    @classmethod
+    def search(cls, prefix, user, limit=20):
+        """
+        Path autocomplete and folder name search.  See searchFolders().
+        """
+        with stats.timer('folder.search', countQueries=True):
+            return searchFolders(prefix, user, limit)
+
+    def listdir(self, user, withCounts=True):
+        """
+        Returns a list of (subFolder, memberCount) pairs for the
+        subfolders of this folder that @user is allowed to LIST, sorted
+        by name.  memberCount comes from getMemberCounts(); it is None
+        if @withCounts is False or @user is not allowed to READ the
+        subfolder.  Uses only cached data when the caches are warm.
+        """
+        with stats.timer('folder.listdir', countQueries=True):
+            node = getFolderTree().byId[self.id]
+            subFolders = node.subFolders
+            if (not settings.GEOCAM_FOLDER_ACCESS_CONTROL_ENABLED
+                    or ((user is not None) and user.is_superuser)):
+                listable = readable = None
+            else:
+                allowed = getAllowedFoldersMulti(user, (Action.LIST, Action.READ),
+                                                 [_getChildShardId(self.id, node.shardId)])
+                listable, readable = allowed[Action.LIST], allowed[Action.READ]
+            counts = getMemberCounts() if withCounts else None
+
+            result = []
+            for name in sorted(subFolders.iterkeys()):
+                subFolder = subFolders[name]
+                if listable is not None and subFolder.id not in listable:
+                    continue
+                if counts is None or (readable is not None and subFolder.id not in readable):
+                    count = None
+                else:
+                    count = counts.get(subFolder.id, 0)
+                result.append((subFolder, count))
+            return result
+
     @classmethod
     def mkdir(cls, path, workingFolder='/'):
         dirname, basename = os.path.split(path)
@@ -324,6 +1390,18 @@ class Folder(models.Model):
         parent = cls.getFolderAssertAllowed(requestingUser, dirname, workingFolder)
         return parent.makeSubFolderAssertAllowed(requestingUser, basename)
 
+    @classmethod
+    def getOrMkdir(cls, path, workingFolder='/'):
+        dirname, basename = os.path.split(path)
+        parent = cls.getFolder(dirname, workingFolder)
+        return parent.getOrMakeSubFolder(basename)
+
+    @classmethod
+    def getOrMkdirAssertAllowed(cls, requestingUser, path, workingFolder='/'):
+        dirname, basename = os.path.split(path)
+        parent = cls.getFolderAssertAllowed(requestingUser, dirname, workingFolder)
+        return parent.getOrMakeSubFolderAssertAllowed(requestingUser, basename)
+
     @classmethod
     def rmdir(cls, path, workingFolder='/'):
         dirname, basename = os.path.split(path)
@@ -337,18 +1415,37 @@ class Folder(models.Model):
         return parent.removeSubFolderAssertAllowed(requestingUser, basename)
 
 
+def getPermissionIndexes(agentField):
+    """
+    Returns the index_together entries for a permission model.  The
+    hot queries are allowing(action).filter(<agent>=...) and
+    filter(<agent>=...); one (agent, folder, action flags...) index
+    answers all of them from the index alone, and replaces both the
+    agent foreign key index and single-column indexes on the
+    low-cardinality flags, which were nearly useless and slowed down
+    every write.
+    """
+    return [tuple([agentField, 'folder'] +
+                  [AgentPermission.getActionField(action) for action in Actions.ALL])]
+
+
 class AgentPermission(models.Model):
     folder = models.ForeignKey(Folder, db_index=True)
-    canRead = models.BooleanField(db_index=True, default=True)
-    canList = models.BooleanField(db_index=True, default=True)
-    canInsert = models.BooleanField(db_index=True, default=False)
-    canDelete = models.BooleanField(db_index=True, default=False)
-    canChange = models.BooleanField(db_index=True, default=False)
-    canAdmin = models.BooleanField(db_index=True, default=False)
+    canRead = models.BooleanField(default=True)
+    canList = models.BooleanField(default=True)
+    canInsert = models.BooleanField(default=False)
+    canDelete = models.BooleanField(default=False)
+    canChange = models.BooleanField(default=False)
+    canAdmin = models.BooleanField(default=False)
 
     class Meta:
         abstract = True
 
+    def save(self, *args, **kwargs):
+        with _journaledSave(self, kwargs.get('using')):
+            super(AgentPermission, self).save(*args, **kwargs)
+        flushAclShard(self.folder_id)
+
     @staticmethod
     def getActionField(action):
         return 'can' + ACTION_LOOKUP[action].capitalize()
@@ -373,7 +1470,11 @@ class AgentPermission(models.Model):
 
 
 class UserPermission(AgentPermission):
-    user = models.ForeignKey(User, db_index=True)
+    # indexed by the composite index in Meta.index_together
+    user = models.ForeignKey(User, db_index=False)
+
+    class Meta:
+        index_together = getPermissionIndexes('user')
 
     def __unicode__(self):
         return ('folder %s allows user %s the actions: %s' %
@@ -383,7 +1484,11 @@ class UserPermission(AgentPermission):
 
 
 class GroupPermission(AgentPermission):
-    group = models.ForeignKey(Group, db_index=True)
+    # indexed by the composite index in Meta.index_together
+    group = models.ForeignKey(Group, db_index=False)
+
+    class Meta:
+        index_together = getPermissionIndexes('group')
 
     def __unicode__(self):
         return ('folder %s allows group %s the actions: %s' %
@@ -392,6 +1497,345 @@ class GroupPermission(AgentPermission):
                  self.getActions()))
 
 
+def flushAclShard(folderId):
+    """
+    Invalidates the cache shard of folder @folderId after a change to
+    its ACL.
+    """
+    shardId = getFolderShardId(folderId)
+    if shardId is None:
+        flushCache()
+    else:
+        flushShard(shardId)
+
+
+def _flushCacheOnAclDelete(sender, instance, **kwargs):
+    # AgentPermission.save() flushes for saves.  bulk_create() callers
+    # flush for themselves.
+    flushAclShard(instance.folder_id)
+
+for _model in (UserPermission, GroupPermission):
+    post_delete.connect(_flushCacheOnAclDelete, sender=_model,
+                        dispatch_uid='geocamFolder.models._flushCacheOnAclDelete')
+
+
+def _flushCacheOnFolderDelete(sender, instance, **kwargs):
+    # also forgets the deleted folders' cached shard ids
+    flushCache()
+
+post_delete.connect(_flushCacheOnFolderDelete, sender=Folder,
+                    dispatch_uid='geocamFolder.models._flushCacheOnFolderDelete')
+
+
+def _bumpGenerationOnMembershipChange(sender, action, **kwargs):
+    # cached allowed-folder sets catch up with group membership changes
+    # when they time out, but policy snapshots and api etags are kept
+    # per generation
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        _incrGeneration(FOLDER_GENERATION_KEY)
+        _notePendingFlush([])
+
+m2m_changed.connect(_bumpGenerationOnMembershipChange, sender=User.groups.through,
+                    dispatch_uid='geocamFolder.models._bumpGenerationOnMembershipChange')
+
+
+class FolderChange(models.Model):
+    """
+    An entry in the append-only journal of folder, ACL and group
+    membership changes, for consumers that sync incrementally with
+    changesSince().  Entries are written when
+    GEOCAM_FOLDER_JOURNAL_ENABLED is set, by signal handlers that run
+    in the transaction of the change they record.  @data holds the
+    object's new state as JSON; it is empty for deletes.
+    """
+    seq = models.AutoField(primary_key=True)
+    timestamp = models.FloatField(default=time.time)
+    # folder, userPermission, groupPermission, membership or journal
+    kind = models.CharField(max_length=16)
+    # save, delete, or purge for kind journal
+    op = models.CharField(max_length=8)
+    # the folder, permission or user id
+    objectId = models.IntegerField(null=True)
+    # not a foreign key, so entries outlive deleted folders
+    folderId = models.IntegerField(null=True)
+    data = models.TextField(blank=True)
+
+    class Meta:
+        index_together = [('kind', 'objectId')]
+
+    def __unicode__(self):
+        return '%s %s %s %s' % (self.seq, self.kind, self.op, self.objectId)
+
+    def getDict(self):
+        return {'seq': self.seq,
+                'timestamp': self.timestamp,
+                'kind': self.kind,
+                'op': self.op,
+                'objectId': self.objectId,
+                'folderId': self.folderId,
+                'data': json.loads(self.data) if self.data else None}
+
+    @classmethod
+    def record(cls, kind, op, objectId, folderId=None, data=None):
+        if settings.GEOCAM_FOLDER_JOURNAL_ENABLED:
+            cls.objects.create(kind=kind, op=op, objectId=objectId, folderId=folderId,
+                               data=json.dumps(data) if data is not None else '')
+
+    @classmethod
+    def recordPermissions(cls, perms):
+        """
+        Records the saves of permissions @perms, which were inserted
+        with bulk_create() and so sent no signals.
+        """
+        if settings.GEOCAM_FOLDER_JOURNAL_ENABLED:
+            cls.objects.bulk_create([cls(kind=_getPermissionKind(perm), op='save',
+                                         objectId=perm.id, folderId=perm.folder_id,
+                                         data=json.dumps(_getPermissionData(perm)))
+                                     for perm in perms])
+
+    @classmethod
+    def recordPermissionDeletes(cls, model, rows):
+        """
+        Records the deletes of @model permissions listed in @rows as (id,
+        folder id) pairs, which were made with a raw delete and so sent
+        no signals.
+        """
+        if settings.GEOCAM_FOLDER_JOURNAL_ENABLED:
+            kind = 'userPermission' if model is UserPermission else 'groupPermission'
+            cls.objects.bulk_create([cls(kind=kind, op='delete', objectId=pk, folderId=folderId)
+                                     for pk, folderId in rows])
+
+    @classmethod
+    def recordFolders(cls, folders):
+        """
+        Like recordPermissions() for @folders.
+        """
+        if settings.GEOCAM_FOLDER_JOURNAL_ENABLED:
+            cls.objects.bulk_create([cls(kind='folder', op='save', objectId=f.id, folderId=f.id,
+                                         data=json.dumps(_getFolderData(f)))
+                                     for f in folders])
+
+    @classmethod
+    def getPurgedSeq(cls):
+        """
+        Returns the highest sequence number dropped by purge(), or 0.
+        """
+        purges = cls.objects.filter(kind='journal', op='purge').order_by('-seq')[:1]
+        return max([json.loads(p.data)['throughSeq'] for p in purges] or [0])
+
+    @classmethod
+    def collapse(cls, chunkSize=JOURNAL_COMPACT_CHUNK_SIZE):
+        """
+        Deletes entries superseded by a later entry for the same object.
+        Consumers at any position still reach the same final state,
+        since the latest entry for each object, including deletes, is
+        kept.  Returns the number of entries deleted.
+        """
+        settled = time.time() - settings.GEOCAM_FOLDER_JOURNAL_SETTLE_SECONDS
+        groups = (cls.objects.filter(timestamp__lte=settled)
+                  .exclude(kind='journal')
+                  .values('kind', 'objectId')
+                  .annotate(n=Count('seq'), latest=Max('seq'))
+                  .filter(n__gt=1)
+                  .values_list('kind', 'objectId', 'latest'))
+        n = 0
+        chunk = []
+        for group in groups.iterator():
+            chunk.append(group)
+            if len(chunk) >= chunkSize:
+                n += cls._collapseChunk(chunk)
+                chunk = []
+        if chunk:
+            n += cls._collapseChunk(chunk)
+        return n
+
+    @classmethod
+    @transaction.commit_on_success
+    def _collapseChunk(cls, groups):
+        q = Q()
+        for kind, objectId, latest in groups:
+            q |= Q(kind=kind, objectId=objectId, seq__lt=latest)
+        stale = cls.objects.filter(q)
+        n = stale.count()
+        stale.delete()
+        return n
+
+    @classmethod
+    @transaction.commit_on_success
+    def purge(cls, before):
+        """
+        Deletes all entries older than time @before, including deletes.
+        Consumers behind the purged entries can no longer sync
+        incrementally; changesSince() raises ValueError for them.
+        Returns the number of entries deleted.
+        """
+        old = cls.objects.filter(timestamp__lt=before).exclude(kind='journal')
+        throughSeq = old.aggregate(Max('seq'))['seq__max']
+        if throughSeq is None:
+            return 0
+        n = old.count()
+        old.delete()
+        if throughSeq > cls.getPurgedSeq():
+            cls.objects.create(kind='journal', op='purge',
+                               data=json.dumps({'throughSeq': throughSeq}))
+        return n
+
+
+def changesSince(seq, limit=JOURNAL_PAGE_SIZE):
+    """
+    Returns up to @limit journal entries (see FolderChange.getDict())
+    with sequence numbers greater than @seq, oldest first.  Pass the
+    last returned seq to the next call; start from 0.
+
+    Sequence numbers are handed out when an entry is written, but
+    concurrent transactions can commit out of order, so entries
+    younger than GEOCAM_FOLDER_JOURNAL_SETTLE_SECONDS are held back
+    to avoid skipping a late commit.  Raises ValueError if entries
+    after @seq have been purged; the consumer must then re-read the
+    full tables.
+    """
+    if seq < FolderChange.getPurgedSeq():
+        raise ValueError('journal entries after seq %s have been purged' % seq)
+    settled = time.time() - settings.GEOCAM_FOLDER_JOURNAL_SETTLE_SECONDS
+    result = []
+    for change in (FolderChange.objects.filter(seq__gt=seq)
+                   .exclude(kind='journal')
+                   .order_by('seq')[:limit]):
+        if change.timestamp > settled:
+            break
+        result.append(change.getDict())
+    return result
+
+
+def _getFolderData(folder):
+    return {'name': folder.name, 'parent': folder.parent_id}
+
+
+def _getPermissionKind(perm):
+    return 'userPermission' if isinstance(perm, UserPermission) else 'groupPermission'
+
+
+def _getPermissionData(perm):
+    data = {'folder': perm.folder_id, 'actions': perm.getActions()}
+    if isinstance(perm, UserPermission):
+        data['user'] = perm.user_id
+    else:
+        data['group'] = perm.group_id
+    return data
+
+
+def _journalFolderSave(sender, instance, raw=False, **kwargs):
+    if not raw:
+        FolderChange.record('folder', 'save', instance.id, instance.id, _getFolderData(instance))
+
+
+def _journalFolderDelete(sender, instance, **kwargs):
+    FolderChange.record('folder', 'delete', instance.id, instance.id)
+
+
+def _journalPermissionSave(sender, instance, raw=False, **kwargs):
+    if not raw:
+        FolderChange.record(_getPermissionKind(instance), 'save', instance.id,
+                            instance.folder_id, _getPermissionData(instance))
+
+
+def _journalPermissionDelete(sender, instance, **kwargs):
+    FolderChange.record(_getPermissionKind(instance), 'delete', instance.id, instance.folder_id)
+
+
+def _journalMembershipChange(sender, instance, action, reverse, pk_set, **kwargs):
+    if not settings.GEOCAM_FOLDER_JOURNAL_ENABLED:
+        return
+    if not reverse:
+        userIds = [instance.id]
+    elif action == 'pre_clear':
+        # the group's users are gone by post_clear
+        instance._journalClearedUserIds = list(instance.user_set.values_list('id', flat=True))
+        return
+    elif action == 'post_clear':
+        userIds = getattr(instance, '_journalClearedUserIds', [])
+    else:
+        userIds = pk_set or []
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    Membership = User.groups.through
+    for userId in userIds:
+        groupIds = sorted(Membership.objects.filter(user=userId).values_list('group_id', flat=True))
+        FolderChange.record('membership', 'save', userId, data={'groups': groupIds})
+
+post_save.connect(_journalFolderSave, sender=Folder,
+                  dispatch_uid='geocamFolder.models._journalFolderSave')
+post_delete.connect(_journalFolderDelete, sender=Folder,
+                    dispatch_uid='geocamFolder.models._journalFolderDelete')
+for _model in (UserPermission, GroupPermission):
+    post_save.connect(_journalPermissionSave, sender=_model,
+                      dispatch_uid='geocamFolder.models._journalPermissionSave')
+    post_delete.connect(_journalPermissionDelete, sender=_model,
+                        dispatch_uid='geocamFolder.models._journalPermissionDelete')
+m2m_changed.connect(_journalMembershipChange, sender=User.groups.through,
+                    dispatch_uid='geocamFolder.models._journalMembershipChange')
+
+
+def getPermissionMatrix(users, folders, action):
+    """
+    Returns a numpy bool array with one row per user in @users and one
+    column per folder in @folders (lists of objects or ids).  Entry
+    [i, j] is True if users[i] may perform @action on folders[j],
+    following the same rules as Folder.isAllowed().  Needs numpy.
+    """
+    if numpy is None:
+        raise ImportError('getPermissionMatrix() requires numpy')
+
+    userIds = [getattr(u, 'id', u) for u in users]
+    folderIds = [getattr(f, 'id', f) for f in folders]
+    matrix = numpy.zeros((len(userIds), len(folderIds)), dtype=bool)
+    if not settings.GEOCAM_FOLDER_ACCESS_CONTROL_ENABLED:
+        matrix[:, :] = True
+        return matrix
+
+    row = dict([(userId, i) for i, userId in enumerate(userIds)])
+    col = dict([(folderId, j) for j, folderId in enumerate(folderIds)])
+    userFlags = dict([(userId, (isActive, isSuperuser))
+                      for userId, isActive, isSuperuser
+                      in User.objects.values_list('id', 'is_active', 'is_superuser')
+                      if userId in row])
+    activeRows = numpy.array([row[u] for u, (isActive, _) in userFlags.iteritems() if isActive],
+                             dtype=int)
+
+    groupCols = {}
+    for i in xrange(0, len(folderIds), ACL_QUERY_CHUNK_SIZE):
+        chunk = folderIds[i:i + ACL_QUERY_CHUNK_SIZE]
+        for groupId, folderId in (GroupPermission.allowing(action)
+                                  .filter(folder__in=chunk)
+                                  .values_list('group', 'folder')):
+            groupCols.setdefault(groupId, []).append(col[folderId])
+        for userId, folderId in (UserPermission.allowing(action)
+                                 .filter(folder__in=chunk)
+                                 .values_list('user', 'folder')):
+            if userId in row and userFlags[userId][0]:
+                matrix[row[userId], col[folderId]] = True
+
+    groupRows = {}
+    memberships = (User.groups.through.objects
+                   .filter(group__in=[g for g in groupCols
+                                      if g not in (GROUP_ANYUSER_ID, GROUP_AUTHUSER_ID)])
+                   .values_list('group', 'user'))
+    for groupId, userId in memberships:
+        if userId in row and userFlags[userId][0]:
+            groupRows.setdefault(groupId, []).append(row[userId])
+    groupRows[GROUP_AUTHUSER_ID] = activeRows
+    groupRows[GROUP_ANYUSER_ID] = numpy.arange(len(userIds))
+
+    for groupId, cols in groupCols.iteritems():
+        rows = groupRows.get(groupId)
+        if rows is not None and len(rows):
+            matrix[numpy.ix_(rows, cols)] = True
+
+    superRows = [row[u] for u, (_, isSuperuser) in userFlags.iteritems() if isSuperuser]
+    matrix[superRows, :] = True
+    return matrix
+
+
 class PermissionManager(object):
     @classmethod
     def isAllowedByAnyFolder(cls, folders, user, action):
@@ -412,8 +1856,14 @@ class PermissionManager(object):
     def isAllowed(cls, obj, user, action):
         if isinstance(obj, Folder):
             return obj.isAllowed(user, action)
+        elif getattr(obj, 'denormalizeFolders', False) and not obj.hasOtherFolders:
+            # the object is in at most one folder, no need for the join
+            with stats.timer('permission.memberIsAllowed', countQueries=True):
+                return (obj.primaryFolder_id is not None
+                        and isFolderAllowed(obj.primaryFolder_id, user, action))
         elif hasattr(obj, 'folders'):
-            return cls.isAllowedByAnyFolder(obj.folders.all(), user, action)
+            with stats.timer('permission.memberIsAllowed', countQueries=True):
+                return cls.isAllowedByAnyFolder(obj.folders.all(), user, action)
         else:
             raise TypeError('expected a Folder or a model with a folders field')
 
@@ -426,14 +1876,68 @@ class PermissionManager(object):
         else:
             raise TypeError('expected a Folder or a model with a folders field')
 
+    @classmethod
+    def getAllowedActionsMulti(cls, objects, user, actions=Actions.ALL):
+        """
+        Returns a list with the subset of @actions that @user may
+        perform on each object in @objects (Folders or FolderMember
+        instances), as action strings.  Same answers as isAllowed() for
+        each object and action, but costs one cache round trip plus one
+        folders query per FolderMember model, however many objects.
+        """
+        objects = list(objects)
+        if (not settings.GEOCAM_FOLDER_ACCESS_CONTROL_ENABLED
+                or ((user is not None) and user.is_superuser)):
+            return [actions] * len(objects)
+
+        with stats.timer('permission.getAllowedActionsMulti', countQueries=True):
+            allowed = getAllowedFoldersMulti(user, actions)
+            objectFolders = [None] * len(objects)
+            pending = {}
+            for i, obj in enumerate(objects):
+                if isinstance(obj, Folder):
+                    objectFolders[i] = [obj.id]
+                elif getattr(obj, 'denormalizeFolders', False) and not obj.hasOtherFolders:
+                    objectFolders[i] = [obj.primaryFolder_id]
+                elif hasattr(obj, 'folders'):
+                    pending.setdefault(obj._meta.concrete_model, []).append(i)
+                else:
+                    raise TypeError('expected a Folder or a model with a folders field')
+
+            for model, indexes in pending.iteritems():
+                through, memberField, folderField = getFolderThrough(model)
+                memberIds = list(set([objects[i].pk for i in indexes]))
+                folderLists = {}
+                for j in xrange(0, len(memberIds), ACL_QUERY_CHUNK_SIZE):
+                    chunk = memberIds[j:j + ACL_QUERY_CHUNK_SIZE]
+                    for memberId, folderId in (through.objects
+                                               .filter(**{memberField + '__in': chunk})
+                                               .values_list(memberField, folderField)):
+                        folderLists.setdefault(memberId, []).append(folderId)
+                for i in indexes:
+                    objectFolders[i] = folderLists.get(objects[i].pk, [])
+
+            return [''.join([action for action in actions
+                             if [f for f in folderIds if f in allowed[action]]])
+                    for folderIds in objectFolders]
+
     @classmethod
     def filterAllowed(cls, querySet, requestingUser, action=Action.READ):
         if (not settings.GEOCAM_FOLDER_ACCESS_CONTROL_ENABLED or
                 ((requestingUser is not None) and requestingUser.is_superuser)):
             return querySet
         else:
-            allowedFolderIds = getAllowedFolders(requestingUser, action).iterkeys()
-            return querySet.filter(folders__in=allowedFolderIds)
+            with stats.timer('permission.filterAllowed', countQueries=True):
+                allowedFolderIds = getAllowedFolders(requestingUser, action).keys()
+                if getattr(querySet.model, 'denormalizeFolders', False):
+                    # only objects in several folders need the through table
+                    through, memberField, folderField = getFolderThrough(querySet.model)
+                    inOtherFolders = (through.objects
+                                      .filter(**{folderField + '__in': allowedFolderIds})
+                                      .values(memberField))
+                    return querySet.filter(Q(primaryFolder__in=allowedFolderIds)
+                                           | Q(hasOtherFolders=True, pk__in=inOtherFolders))
+                return querySet.filter(folders__in=allowedFolderIds)
 
     @classmethod
     def saveAssertAllowed(cls, obj, requestingUser, checkFolders=None, *args, **kwargs):
@@ -487,6 +1991,28 @@ class FolderMember(object):
     PermissionManager functions directly.
     """
 
+    # Models with many members in one or two folders each can set
+    # denormalizeFolders and define the fields
+    #
+    #   primaryFolder = models.ForeignKey(Folder, null=True, blank=True,
+    #                                     related_name='+',
+    #                                     on_delete=models.SET_NULL)
+    #   hasOtherFolders = models.BooleanField(default=False, db_index=True)
+    #
+    # primaryFolder is the member's folder with the lowest id and
+    # hasOtherFolders is set if it is in more than one folder.  They
+    # are kept up to date when the folders field changes, and let
+    # allowed() and isAllowed() skip the folders through table for
+    # members in a single folder.  Run the geocamfolder_sync_members
+    # command after turning this on for a model with existing rows.
+    denormalizeFolders = False
+
+    # Set countFolderMembers to keep a FolderMemberCount row per folder
+    # up to date as members of this model are added to and removed
+    # from folders, for Folder.listdir().  Run geocamfolder_sync_members
+    # after turning it on for a model with existing rows.
+    countFolderMembers = False
+
     def isAllowed(self, requestingUser, action):
         return PermissionManager.isAllowed(self, requestingUser, action)
 
@@ -503,6 +2029,319 @@ class FolderMember(object):
     def deleteAssertAllowed(self, requestingUser, *args, **kwargs):
         PermissionManager.deleteAssertAllowed(self, requestingUser, *args, **kwargs)
 
+    @classmethod
+    def getAllowedPage(cls, requestingUser, action=Action.READ, orderBy='pk',
+                       limit=ITER_ALLOWED_CHUNK_SIZE, cursor=None):
+        """
+        Returns (members, nextCursor) for one page of the members
+        @requestingUser is allowed to perform @action on, ordered by
+        field @orderBy (prefix '-' for descending) and then by primary
+        key.  Pass the opaque string @nextCursor back as @cursor to get
+        the next page; it is None on the last page.  Pages are found by
+        key rather than by offset, so deep pages cost no more than the
+        first.  The @orderBy field should not be null.
+        """
+        descending = orderBy.startswith('-')
+        fieldName = orderBy.lstrip('-')
+        if fieldName == 'pk':
+            fieldName = cls._meta.pk.name
+        field = cls._meta.get_field(fieldName)
+        pkName = cls._meta.pk.name
+        pkField = cls._meta.pk
+
+        querySet = PermissionManager.filterAllowed(cls.objects.all(), requestingUser, action)
+        if not getattr(cls, 'denormalizeFolders', False):
+            # the folders join can return a member once per allowed folder
+            querySet = cls.objects.filter(pk__in=querySet.values('pk'))
+
+        if cursor is not None:
+            try:
+                valueString, pkString = json.loads(base64.urlsafe_b64decode(str(cursor)))
+                value = field.to_python(valueString)
+                lastPk = pkField.to_python(pkString)
+            except Exception:
+                raise ValueError('invalid cursor %r' % cursor)
+            op = 'lt' if descending else 'gt'
+            if field is pkField:
+                querySet = querySet.filter(**{'%s__%s' % (pkName, op): lastPk})
+            else:
+                querySet = querySet.filter(Q(**{'%s__%s' % (fieldName, op): value})
+                                           | Q(**{fieldName: value,
+                                                  '%s__%s' % (pkName, op): lastPk}))
+
+        sign = '-' if descending else ''
+        if field is pkField:
+            ordering = [sign + pkName]
+        else:
+            ordering = [sign + fieldName, sign + pkName]
+        members = list(querySet.order_by(*ordering)[:limit])
+
+        nextCursor = None
+        if len(members) == limit:
+            last = members[-1]
+            nextCursor = base64.urlsafe_b64encode(json.dumps([field.value_to_string(last),
+                                                              pkField.value_to_string(last)]))
+        return members, nextCursor
+
+    @classmethod
+    def iterAllowed(cls, requestingUser, action=Action.READ, orderBy='pk',
+                    chunkSize=ITER_ALLOWED_CHUNK_SIZE, cursor=None):
+        """
+        Yields every member @requestingUser is allowed to perform @action
+        on, once each, in the order of getAllowedPage(), fetching
+        @chunkSize at a time.  Starts after @cursor if given.
+        """
+        while True:
+            members, cursor = cls.getAllowedPage(requestingUser, action, orderBy,
+                                                 chunkSize, cursor)
+            for member in members:
+                yield member
+            if cursor is None:
+                break
+
+    @classmethod
+    def syncPrimaryFolders(cls, ids=None, chunkSize=MEMBER_SYNC_CHUNK_SIZE):
+        """
+        Recomputes primaryFolder and hasOtherFolders for the members
+        with primary keys @ids, or for all members if @ids is None.
+        """
+        if ids is None:
+            ids = cls.objects.order_by('pk').values_list('pk', flat=True).iterator()
+        through, memberField, folderField = getFolderThrough(cls)
+        chunk = []
+        for memberId in ids:
+            chunk.append(memberId)
+            if len(chunk) >= chunkSize:
+                cls._syncPrimaryFoldersChunk(chunk, through, memberField, folderField)
+                chunk = []
+        if chunk:
+            cls._syncPrimaryFoldersChunk(chunk, through, memberField, folderField)
+
+    @classmethod
+    def _syncPrimaryFoldersChunk(cls, ids, through, memberField, folderField):
+        """
+        Returns a dict member id -> (primaryFolder id, hasOtherFolders)
+        of the values written.
+        """
+        folderLists = dict([(memberId, []) for memberId in ids])
+        for memberId, folderId in (through.objects
+                                   .filter(**{memberField + '__in': ids})
+                                   .values_list(memberField, folderField)):
+            folderLists[memberId].append(folderId)
+
+        # one UPDATE per distinct (primaryFolder, hasOtherFolders) value
+        updates = {}
+        values = {}
+        for memberId, folderIds in folderLists.iteritems():
+            key = (min(folderIds) if folderIds else None, len(folderIds) > 1)
+            updates.setdefault(key, []).append(memberId)
+            values[memberId] = key
+        for (primaryFolderId, hasOtherFolders), memberIds in updates.iteritems():
+            (cls.objects.filter(pk__in=memberIds)
+             .update(primaryFolder=primaryFolderId, hasOtherFolders=hasOtherFolders))
+        return values
+
+    @classmethod
+    def bulkCreateAssertAllowed(cls, requestingUser, objects, folders,
+                                batchSize=BULK_CREATE_BATCH_SIZE):
+        """
+        Inserts the unsaved members @objects, all in @folders, after
+        checking once that @requestingUser may INSERT into @folders.
+        Rows and folder links are written with bulk_create() in one
+        transaction, or in the caller's transaction if there is one,
+        retried if another writer takes the primary keys allocated for
+        them.  Keeps the denormalized folder fields and
+        member counts up to date, but like bulk_create() doesn't call
+        save() or send the model's save signals.  Returns @objects.
+        """
+        objects = list(objects)
+        folders = list(folders)
+        PermissionManager.assertFolderChangeAllowed(requestingUser, [], folders)
+        folderIds = sorted(set([f.id for f in folders]))
+        through, memberField, folderField = getFolderThrough(cls)
+        if cls.denormalizeFolders:
+            for obj in objects:
+                obj.primaryFolder_id = folderIds[0] if folderIds else None
+                obj.hasOtherFolders = len(folderIds) > 1
+
+        for attempt in xrange(BULK_CREATE_MAX_ATTEMPTS):
+            try:
+                with _atomic(router.db_for_write(cls)):
+                    for obj, pk in zip(objects, allocatePks(cls, len(objects))):
+                        obj.pk = pk
+                    cls.objects.bulk_create(objects, batch_size=batchSize)
+                    through.objects.bulk_create([through(**{memberField + '_id': obj.pk,
+                                                            folderField + '_id': folderId})
+                                                 for obj in objects
+                                                 for folderId in folderIds],
+                                                batch_size=batchSize)
+                    if cls.countFolderMembers:
+                        FolderMemberCount.addCounts(cls, dict.fromkeys(folderIds, len(objects)))
+                return objects
+            except IntegrityError:
+                for obj in objects:
+                    obj.pk = None
+                if attempt == BULK_CREATE_MAX_ATTEMPTS - 1:
+                    raise
+
+
+def getModelLabel(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+
+class FolderMemberCount(models.Model):
+    """
+    The number of objects of FolderMember model @model in @folder.
+    Maintained by signal handlers for models that set
+    countFolderMembers.
+    """
+    folder = models.ForeignKey(Folder)
+    model = models.CharField(max_length=128)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('folder', 'model')
+
+    def __unicode__(self):
+        return '%s objects of %s in folder %s' % (self.count, self.model, self.folder_id)
+
+    @classmethod
+    def addCounts(cls, memberModel, deltas):
+        """
+        Adds the counts in @deltas, a dict folder.id -> change, to the
+        counts for @memberModel.
+        """
+        label = getModelLabel(memberModel)
+        deltas = dict([(folderId, delta) for folderId, delta in deltas.iteritems() if delta])
+        if not deltas:
+            return
+        for folderId, delta in deltas.iteritems():
+            counts = cls.objects.filter(folder=folderId, model=label)
+            if counts.update(count=F('count') + delta):
+                continue
+            sid = transaction.savepoint()
+            try:
+                cls.objects.create(folder_id=folderId, model=label, count=delta)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # another writer created the row first
+                transaction.savepoint_rollback(sid)
+                counts.update(count=F('count') + delta)
+        flushMemberCounts()
+
+    @classmethod
+    def recount(cls, memberModel):
+        """
+        Recomputes the counts for @memberModel from scratch.
+        """
+        label = getModelLabel(memberModel)
+        through, memberField, folderField = getFolderThrough(memberModel)
+        cls.objects.filter(model=label).delete()
+        rows = (through.objects.values(folderField)
+                .annotate(n=Count(memberField))
+                .values_list(folderField, 'n'))
+        cls.objects.bulk_create([cls(folder_id=folderId, model=label, count=n)
+                                 for folderId, n in rows])
+        flushMemberCounts()
+
+
+def getFolderThrough(model):
+    """
+    Returns (through model, member field name, folder field name) for
+    the folders field of FolderMember @model.
+    """
+    field = model._meta.get_field('folders')
+    return field.rel.through, field.m2m_field_name(), field.m2m_reverse_field_name()
+
+
+def _syncPrimaryFoldersOnChange(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """
+    m2m_changed handler that keeps the primaryFolder and hasOtherFolders
+    fields of FolderMember models with denormalizeFolders set in sync
+    with their folders field.
+    """
+    memberModel = model if reverse else instance.__class__
+    if not getattr(memberModel, 'denormalizeFolders', False):
+        return
+    through, memberField, folderField = getFolderThrough(memberModel)
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            values = memberModel._syncPrimaryFoldersChunk([instance.pk], through,
+                                                          memberField, folderField)
+            # update @instance too, or its next save() would write the
+            # old values back
+            instance.primaryFolder_id, instance.hasOtherFolders = values[instance.pk]
+            instance.__dict__.pop(memberModel._meta.get_field('primaryFolder').get_cache_name(), None)
+        return
+
+    # @instance is a folder whose members changed
+    if action == 'pre_clear':
+        instance._clearedMemberIds = list(through.objects
+                                          .filter(**{folderField: instance.pk})
+                                          .values_list(memberField, flat=True))
+    elif action == 'post_clear':
+        memberModel.syncPrimaryFolders(getattr(instance, '_clearedMemberIds', []))
+        instance._clearedMemberIds = []
+    elif action in ('post_add', 'post_remove'):
+        memberModel.syncPrimaryFolders(pk_set)
+
+m2m_changed.connect(_syncPrimaryFoldersOnChange,
+                    dispatch_uid='geocamFolder.models._syncPrimaryFoldersOnChange')
+
+
+def _countMembersOnChange(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """
+    m2m_changed handler that keeps FolderMemberCount up to date for
+    FolderMember models with countFolderMembers set.  Removals are
+    counted in the pre_ signal, when we can still see which of the
+    requested rows exist, and applied in the post_ signal.
+    """
+    memberModel = model if reverse else instance.__class__
+    if not getattr(memberModel, 'countFolderMembers', False):
+        return
+    through, memberField, folderField = getFolderThrough(memberModel)
+
+    if action == 'post_add':
+        if reverse:
+            deltas = {instance.pk: len(pk_set)}
+        else:
+            deltas = dict.fromkeys(pk_set, 1)
+        FolderMemberCount.addCounts(memberModel, deltas)
+    elif action in ('pre_remove', 'pre_clear'):
+        if reverse:
+            rows = through.objects.filter(**{folderField: instance.pk})
+            if action == 'pre_remove':
+                rows = rows.filter(**{memberField + '__in': pk_set})
+            deltas = {instance.pk: -rows.count()}
+        else:
+            rows = through.objects.filter(**{memberField: instance.pk})
+            if action == 'pre_remove':
+                rows = rows.filter(**{folderField + '__in': pk_set})
+            deltas = dict.fromkeys(rows.values_list(folderField, flat=True), -1)
+        instance._memberCountDeltas = deltas
+    elif action in ('post_remove', 'post_clear'):
+        FolderMemberCount.addCounts(memberModel, getattr(instance, '_memberCountDeltas', {}))
+        instance._memberCountDeltas = {}
+
+m2m_changed.connect(_countMembersOnChange,
+                    dispatch_uid='geocamFolder.models._countMembersOnChange')
+
+
+def _countMembersOnDelete(sender, instance, **kwargs):
+    """
+    pre_delete handler; deleting a member removes its through rows
+    without sending m2m_changed.
+    """
+    if not getattr(sender, 'countFolderMembers', False):
+        return
+    through, memberField, folderField = getFolderThrough(sender)
+    folderIds = (through.objects.filter(**{memberField: instance.pk})
+                 .values_list(folderField, flat=True))
+    FolderMemberCount.addCounts(sender, dict.fromkeys(folderIds, -1))
+
+pre_delete.connect(_countMembersOnDelete,
+                   dispatch_uid='geocamFolder.models._countMembersOnDelete')
+
 
 class FolderMemberExample(models.Model, FolderMember):
     """
@@ -511,6 +2350,8 @@ class FolderMemberExample(models.Model, FolderMember):
     name = models.CharField(max_length=32)
     folders = models.ManyToManyField(Folder, db_index=True)
 
+    countFolderMembers = True
+
 
 class FolderAwarePosition(models.Model, FolderMember):
     """
@@ -521,6 +2362,11 @@ class FolderAwarePosition(models.Model, FolderMember):
     x = models.FloatField()
     y = models.FloatField()
     folders = models.ManyToManyField(Folder, db_index=True)
+    primaryFolder = models.ForeignKey(Folder, null=True, blank=True,
+                                      related_name='+', on_delete=models.SET_NULL)
+    hasOtherFolders = models.BooleanField(default=False, db_index=True)
+
+    denormalizeFolders = True
 
     def __unicode__(self):
         return 'x=%s y=%s' % (self.x, self.y)
@@ -0,0 +1,155 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Read-replica routing for geocamFolder.
+
+To send folder and permission reads to replicas, list the replica
+aliases in GEOCAM_FOLDER_READ_DATABASES and add the router and
+middleware to the site settings:
+
+  DATABASE_ROUTERS = ['geocamFolder.routers.FolderReplicaRouter']
+  MIDDLEWARE_CLASSES = (
+      ...
+      'django.contrib.auth.middleware.AuthenticationMiddleware',
+      'geocamFolder.routers.ReadYourWritesMiddleware',
+  )
+
+Writes always go to GEOCAM_FOLDER_WRITE_DATABASE.  After a thread
+writes, its reads go to the primary for
+GEOCAM_FOLDER_READ_YOUR_WRITES_SECONDS, and with the middleware
+installed the same holds for the user's next requests, whichever
+worker process serves them.
+
+Results stored in the shared folder cache are always computed from
+the primary (see readFromPrimary()).  They are keyed on the current
+cache generation, so one computed from a lagging replica would hide
+a write from every reader until it timed out.
+"""
+
+import time
+import random
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+PIN_CACHE_PREFIX = 'geocamFolder.primaryPin.'
+
+_state = threading.local()
+
+
+def _getPinKey(userId):
+    return PIN_CACHE_PREFIX + str(userId)
+
+
+def pinToPrimary():
+    """
+    Sends this thread's reads (and, within a request handled by
+    ReadYourWritesMiddleware, the current user's reads) to the primary
+    database for the read-your-writes window.
+    """
+    window = settings.GEOCAM_FOLDER_READ_YOUR_WRITES_SECONDS
+    until = time.time() + window
+    _state.pinnedUntil = until
+    userId = getattr(_state, 'userId', None)
+    if (settings.GEOCAM_FOLDER_READ_DATABASES
+            and userId is not None
+            and not getattr(_state, 'userPinSaved', False)):
+        cache.set(_getPinKey(userId), until, window)
+        # one cache write per request is enough
+        _state.userPinSaved = True
+
+
+def isPinnedToPrimary():
+    return time.time() < getattr(_state, 'pinnedUntil', 0)
+
+
+def clearPin():
+    _state.pinnedUntil = 0
+
+
+@contextmanager
+def readFromPrimary():
+    """
+    Sends this thread's reads to the primary database inside the
+    block.
+    """
+    depth = getattr(_state, 'primaryDepth', 0)
+    _state.primaryDepth = depth + 1
+    try:
+        yield
+    finally:
+        _state.primaryDepth = depth
+
+
+def isReadingFromPrimary():
+    return isPinnedToPrimary() or getattr(_state, 'primaryDepth', 0) > 0
+
+
+class FolderReplicaRouter(object):
+    """
+    Routes reads of the apps in GEOCAM_FOLDER_REPLICA_APPS to a random
+    database in GEOCAM_FOLDER_READ_DATABASES, unless the current thread
+    is pinned to the primary or inside readFromPrimary().  Routes their
+    writes to GEOCAM_FOLDER_WRITE_DATABASE and pins the thread.
+    """
+
+    def isRouted(self, model):
+        return model._meta.app_label in settings.GEOCAM_FOLDER_REPLICA_APPS
+
+    def db_for_read(self, model, **hints):
+        if not self.isRouted(model):
+            return None
+        replicas = settings.GEOCAM_FOLDER_READ_DATABASES
+        if not replicas or isReadingFromPrimary():
+            return settings.GEOCAM_FOLDER_WRITE_DATABASE
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        if not self.isRouted(model):
+            return None
+        pinToPrimary()
+        return settings.GEOCAM_FOLDER_WRITE_DATABASE
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold copies of the primary's rows
+        dbs = set((settings.GEOCAM_FOLDER_WRITE_DATABASE,) +
+                  tuple(settings.GEOCAM_FOLDER_READ_DATABASES))
+        if obj1._state.db in dbs and obj2._state.db in dbs:
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        return None
+
+
+class ReadYourWritesMiddleware(object):
+    """
+    Pins a user's reads to the primary for the read-your-writes window
+    after any request in which they wrote, across worker processes.
+    Must come after AuthenticationMiddleware.
+    """
+
+    def process_request(self, request):
+        clearPin()
+        _state.userPinSaved = False
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated():
+            _state.userId = user.id
+            if settings.GEOCAM_FOLDER_READ_DATABASES:
+                until = cache.get(_getPinKey(user.id))
+                if until is not None:
+                    _state.pinnedUntil = until
+        else:
+            _state.userId = None
+        return None
+
+    def process_response(self, request, response):
+        _state.userId = None
+        clearPin()
+        return response
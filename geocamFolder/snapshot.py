@@ -0,0 +1,323 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Compiled policy snapshots.
+
+compileSnapshot() writes the folder tree, every ACL entry and every
+group membership into one compact binary file, stamped with the shared
+folder/ACL cache generation (see models.getCacheGeneration()).  Worker
+processes memory-map the file read-only, so they share one copy of the
+pages and a permission check is a few binary searches with no
+unpickling and no db queries.
+
+Set GEOCAM_FOLDER_SNAPSHOT_PATH to turn snapshots on, and keep the file
+fresh with the geocamfolder_compile_snapshot management command (its
+--watch option recompiles whenever the generation changes).  A new
+snapshot is written next to the old one and renamed over it, so
+readers see either the old file or the new one.  A snapshot is only
+used while its generation matches the shared generation; otherwise
+permission checks go through the folder cache as before.
+
+File layout (little-endian):
+
+  header (HEADER_FORMAT)
+  folderIds    uint32[numFolders], sorted
+  parents      int32[numFolders], index of the parent folder or -1
+  nameOffsets  uint32[numFolders + 1], into the name blob
+  names        utf-8 blob, padded to 4 bytes
+  agentKeys    int32[numAgents], sorted: user id, or -group id
+  agentOffsets uint32[numAgents + 1], into the entries
+  entryFolders uint32[numEntries], folder index, sorted per agent
+  entryMasks   uint8[numEntries], bit i set if Actions.ALL[i] is allowed,
+               padded to 4 bytes
+  memberUsers  uint32[numMembers], sorted user ids
+  memberOffsets uint32[numMembers + 1], into memberGroups
+  memberGroups uint32[numMemberships]
+
+Permissions are stored as sparse sorted (folder, action mask) entries
+per agent rather than dense bitsets over all folders, which would take
+numFolders / 8 bytes per agent.
+"""
+
+import os
+import mmap
+import time
+import struct
+import bisect
+import threading
+
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from geocamFolder.models import (Folder, UserPermission, GroupPermission, Actions,
+                                 GROUP_ANYUSER_ID, GROUP_AUTHUSER_ID, getCacheGeneration)
+from geocamFolder.routers import readFromPrimary
+
+MAGIC = 'GFSN'
+FORMAT_VERSION = 1
+HEADER_FORMAT = '<4sIqIIIIII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+ACTION_FIELDS = [UserPermission.getActionField(action) for action in Actions.ALL]
+ACTION_BITS = dict([(action, 1 << i) for i, action in enumerate(Actions.ALL)])
+
+
+def _pad(data):
+    return data + '\0' * (-len(data) % 4)
+
+
+def _pack(fmt, values):
+    return struct.pack('<%d%s' % (len(values), fmt), *values)
+
+
+def _getMask(flags):
+    mask = 0
+    for i, flag in enumerate(flags):
+        if flag:
+            mask |= 1 << i
+    return mask
+
+
+def compileSnapshot(path):
+    """
+    Writes a snapshot of the current folders, ACLs and group
+    memberships to @path, replacing any previous snapshot atomically.
+    Returns the snapshot's generation.
+    """
+    with readFromPrimary():
+        return _compileSnapshot(path)
+
+
+def _compileSnapshot(path):
+    # read the generation first: a change made while compiling bumps
+    # it, so the snapshot is never taken for newer than it is
+    generation = getCacheGeneration()
+
+    folders = sorted(Folder.objects.values_list('id', 'parent_id', 'name'))
+    folderIds = [folderId for folderId, _, _ in folders]
+    folderIndex = dict([(folderId, i) for i, folderId in enumerate(folderIds)])
+    parents = [folderIndex.get(parentId, -1) for _, parentId, _ in folders]
+    nameOffsets = [0]
+    names = []
+    for _, _, name in folders:
+        encoded = name.encode('utf-8')
+        names.append(encoded)
+        nameOffsets.append(nameOffsets[-1] + len(encoded))
+
+    entries = {}
+    for model, agentField, sign in ((UserPermission, 'user_id', 1),
+                                    (GroupPermission, 'group_id', -1)):
+        for row in model.objects.values_list(*(['folder_id', agentField] + ACTION_FIELDS)).iterator():
+            mask = _getMask(row[2:])
+            if mask and row[0] in folderIndex:
+                entries.setdefault(sign * row[1], []).append((folderIndex[row[0]], mask))
+    agentKeys = sorted(entries.iterkeys())
+    agentOffsets = [0]
+    entryFolders = []
+    entryMasks = []
+    for agentKey in agentKeys:
+        for index, mask in sorted(entries[agentKey]):
+            entryFolders.append(index)
+            entryMasks.append(mask)
+        agentOffsets.append(len(entryFolders))
+
+    memberships = {}
+    for userId, groupId in User.groups.through.objects.values_list('user_id', 'group_id').iterator():
+        memberships.setdefault(userId, []).append(groupId)
+    memberUsers = sorted(memberships.iterkeys())
+    memberOffsets = [0]
+    memberGroups = []
+    for userId in memberUsers:
+        memberGroups += sorted(memberships[userId])
+        memberOffsets.append(len(memberGroups))
+
+    header = struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION, generation,
+                         len(folderIds), nameOffsets[-1], len(agentKeys), len(entryFolders),
+                         len(memberUsers), len(memberGroups))
+    tmpPath = '%s.tmp%d' % (path, os.getpid())
+    with open(tmpPath, 'wb') as out:
+        out.write(header)
+        out.write(_pack('I', folderIds))
+        out.write(_pack('i', parents))
+        out.write(_pack('I', nameOffsets))
+        out.write(_pad(''.join(names)))
+        out.write(_pack('i', agentKeys))
+        out.write(_pack('I', agentOffsets))
+        out.write(_pack('I', entryFolders))
+        out.write(_pad(_pack('B', entryMasks)))
+        out.write(_pack('I', memberUsers))
+        out.write(_pack('I', memberOffsets))
+        out.write(_pack('I', memberGroups))
+    os.rename(tmpPath, path)
+    return generation
+
+
+class _Array(object):
+    """
+    A read-only view of a packed array in a buffer, usable with bisect.
+    """
+    def __init__(self, buf, offset, fmt, length):
+        self.buf = buf
+        self.offset = offset
+        self.fmt = '<' + fmt
+        self.itemSize = struct.calcsize(self.fmt)
+        self.length = length
+        self.end = offset + self.itemSize * length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        return struct.unpack_from(self.fmt, self.buf, self.offset + i * self.itemSize)[0]
+
+
+class PolicySnapshot(object):
+    """
+    A memory-mapped snapshot written by compileSnapshot().  Permission
+    checks follow the same rules as models.isFolderAllowed() for users
+    that aren't superusers.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.fileId = (stat.st_ino, stat.st_mtime, stat.st_size)
+        (magic, version, self.generation, numFolders, namesBytes, numAgents,
+         numEntries, numMembers, numMemberships) = struct.unpack_from(HEADER_FORMAT, self.buf)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError('%s is not a version %d policy snapshot' % (path, FORMAT_VERSION))
+
+        self.folderIds = _Array(self.buf, HEADER_SIZE, 'I', numFolders)
+        self.parents = _Array(self.buf, self.folderIds.end, 'i', numFolders)
+        self.nameOffsets = _Array(self.buf, self.parents.end, 'I', numFolders + 1)
+        self.namesOffset = self.nameOffsets.end
+        agentsOffset = self.namesOffset + namesBytes + (-namesBytes % 4)
+        self.agentKeys = _Array(self.buf, agentsOffset, 'i', numAgents)
+        self.agentOffsets = _Array(self.buf, self.agentKeys.end, 'I', numAgents + 1)
+        self.entryFolders = _Array(self.buf, self.agentOffsets.end, 'I', numEntries)
+        self.entryMasks = _Array(self.buf, self.entryFolders.end, 'B', numEntries)
+        membersOffset = self.entryMasks.end + (-numEntries % 4)
+        self.memberUsers = _Array(self.buf, membersOffset, 'I', numMembers)
+        self.memberOffsets = _Array(self.buf, self.memberUsers.end, 'I', numMembers + 1)
+        self.memberGroups = _Array(self.buf, self.memberOffsets.end, 'I', numMemberships)
+
+    def close(self):
+        self.buf.close()
+
+    def _find(self, array, value, lo=0, hi=None):
+        if hi is None:
+            hi = len(array)
+        i = bisect.bisect_left(array, value, lo, hi)
+        if i < hi and array[i] == value:
+            return i
+        return None
+
+    def getFolderIndex(self, folderId):
+        return self._find(self.folderIds, folderId)
+
+    def getName(self, index):
+        start = self.namesOffset + self.nameOffsets[index]
+        end = self.namesOffset + self.nameOffsets[index + 1]
+        return self.buf[start:end].decode('utf-8')
+
+    def getPath(self, folderId):
+        """
+        Returns the path of folder @folderId, or None if the snapshot
+        has no such folder.
+        """
+        index = self.getFolderIndex(folderId)
+        if index is None:
+            return None
+        names = []
+        while self.parents[index] != -1:
+            names.append(self.getName(index))
+            index = self.parents[index]
+        return '/' + '/'.join(reversed(names))
+
+    def getAgentKeys(self, user):
+        keys = [-GROUP_ANYUSER_ID]
+        if user is not None and user.is_active:
+            keys.append(-GROUP_AUTHUSER_ID)
+            i = self._find(self.memberUsers, user.id)
+            if i is not None:
+                keys += [-self.memberGroups[j] for j in
+                         xrange(self.memberOffsets[i], self.memberOffsets[i + 1])]
+            keys.append(user.id)
+        return keys
+
+    def _iterEntryRanges(self, user):
+        for key in self.getAgentKeys(user):
+            i = self._find(self.agentKeys, key)
+            if i is not None:
+                yield self.agentOffsets[i], self.agentOffsets[i + 1]
+
+    def isAllowed(self, folderId, user, action):
+        index = self.getFolderIndex(folderId)
+        if index is None:
+            return False
+        bit = ACTION_BITS[action]
+        for start, end in self._iterEntryRanges(user):
+            j = self._find(self.entryFolders, index, start, end)
+            if j is not None and self.entryMasks[j] & bit:
+                return True
+        return False
+
+    def getAllowedFolderIds(self, user, action):
+        """
+        Returns the set of ids of folders on which @user may perform
+        @action.
+        """
+        bit = ACTION_BITS[action]
+        result = set()
+        for start, end in self._iterEntryRanges(user):
+            for j in xrange(start, end):
+                if self.entryMasks[j] & bit:
+                    result.add(self.folderIds[self.entryFolders[j]])
+        return result
+
+
+_state = {'snapshot': None, 'checkedAt': 0}
+_lock = threading.Lock()
+
+
+def getSnapshot():
+    """
+    Returns the PolicySnapshot at GEOCAM_FOLDER_SNAPSHOT_PATH, reopening
+    it if the file has been replaced, or None if snapshots are off or
+    there is no snapshot file.  The file is checked for replacement at
+    most every GEOCAM_FOLDER_SNAPSHOT_CHECK_SECONDS.
+    """
+    path = settings.GEOCAM_FOLDER_SNAPSHOT_PATH
+    if not path:
+        return None
+    now = time.time()
+    if now - _state['checkedAt'] < settings.GEOCAM_FOLDER_SNAPSHOT_CHECK_SECONDS:
+        return _state['snapshot']
+    with _lock:
+        _state['checkedAt'] = now
+        try:
+            stat = os.stat(path)
+        except OSError:
+            _state['snapshot'] = None
+            return None
+        snapshot = _state['snapshot']
+        if snapshot is None or snapshot.fileId != (stat.st_ino, stat.st_mtime, stat.st_size):
+            # the old map stays valid for threads still using it
+            _state['snapshot'] = PolicySnapshot(path)
+        return _state['snapshot']
+
+
+def getCurrentSnapshot():
+    """
+    Like getSnapshot(), but returns None unless the snapshot's
+    generation matches the shared folder/ACL cache generation.
+    """
+    snapshot = getSnapshot()
+    if snapshot is None or snapshot.generation != getCacheGeneration():
+        return None
+    return snapshot
@@ -0,0 +1,332 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Instrumentation for the geocamFolder hot paths.
+
+Code records two kinds of metrics: counters (incr) and histograms of
+observed values (observe), including latencies from timer().  Each
+metric is passed to every sink named in GEOCAM_FOLDER_STATS_SINKS.
+Nothing is recorded unless GEOCAM_FOLDER_STATS_ENABLED is set.
+"""
+
+import os
+import time
+import socket
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.utils.importlib import import_module
+
+STATS_CACHE_PREFIX = 'geocamFolder.stats.'
+STATS_INDEX_KEY = STATS_CACHE_PREFIX + 'index'
+
+# upper bounds of histogram buckets. the last bucket catches the rest.
+HISTOGRAM_BUCKETS = tuple([0.1 * 2 ** i for i in xrange(32)])
+
+
+class Histogram(object):
+    """
+    A fixed-bucket histogram.  Buckets grow by a factor of 2, so
+    percentiles are accurate to within a factor of 2, which is plenty
+    to spot a slow rebuild.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        i = 0
+        while i < len(HISTOGRAM_BUCKETS) and value > HISTOGRAM_BUCKETS[i]:
+            i += 1
+        self.buckets[i] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        for attr, pick in (('min', min), ('max', max)):
+            mine, theirs = getattr(self, attr), getattr(other, attr)
+            if mine is None:
+                setattr(self, attr, theirs)
+            elif theirs is not None:
+                setattr(self, attr, pick(mine, theirs))
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        target = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                if i < len(HISTOGRAM_BUCKETS):
+                    return min(HISTOGRAM_BUCKETS[i], self.max)
+                return self.max
+        return self.max
+
+    def getSummary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+class MemoryStatsSink(object):
+    """
+    Aggregates metrics in process memory.  Every
+    GEOCAM_FOLDER_STATS_PUBLISH_SECONDS it publishes a snapshot to the
+    Django cache so the geocamfolder_stats management command can
+    combine the numbers from all worker processes.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.lastPublished = time.time()
+
+    def incr(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        self.maybePublish()
+
+    def observe(self, name, value):
+        with self.lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = Histogram()
+            hist.observe(value)
+        self.maybePublish()
+
+    def getSnapshot(self):
+        with self.lock:
+            return {'pid': os.getpid(),
+                    'host': socket.gethostname(),
+                    'time': time.time(),
+                    'counters': dict(self.counters),
+                    'histograms': dict([(name, hist.__dict__.copy())
+                                        for name, hist in self.histograms.iteritems()])}
+
+    def maybePublish(self):
+        if time.time() - self.lastPublished >= settings.GEOCAM_FOLDER_STATS_PUBLISH_SECONDS:
+            self.publish()
+
+    def publish(self):
+        self.lastPublished = time.time()
+        key = '%s%s.%s' % (STATS_CACHE_PREFIX, socket.gethostname(), os.getpid())
+        timeout = settings.GEOCAM_FOLDER_STATS_PUBLISH_TIMEOUT_SECONDS
+        cache.set(key, self.getSnapshot(), timeout)
+        index = cache.get(STATS_INDEX_KEY) or []
+        if key not in index:
+            cache.set(STATS_INDEX_KEY, index + [key], timeout)
+
+
+class LoggingStatsSink(object):
+    """
+    Logs every metric at DEBUG level to the 'geocamFolder.stats' logger.
+    """
+    def __init__(self):
+        self.logger = logging.getLogger('geocamFolder.stats')
+
+    def incr(self, name, value):
+        self.logger.debug('%s += %s', name, value)
+
+    def observe(self, name, value):
+        self.logger.debug('%s = %s', name, value)
+
+
+class StatsdStatsSink(object):
+    """
+    Sends metrics to a statsd-compatible daemon over UDP.  Latencies
+    (names ending in '.ms') are sent as timers, other observed values
+    as histograms.
+    """
+    def __init__(self):
+        self.address = (settings.GEOCAM_FOLDER_STATS_STATSD_HOST,
+                        settings.GEOCAM_FOLDER_STATS_STATSD_PORT)
+        self.prefix = settings.GEOCAM_FOLDER_STATS_STATSD_PREFIX
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, text):
+        try:
+            self.sock.sendto(text, self.address)
+        except socket.error:
+            # metrics are best-effort; never fail the request over them
+            pass
+
+    def incr(self, name, value):
+        self.send('%s%s:%s|c' % (self.prefix, name, value))
+
+    def observe(self, name, value):
+        kind = 'ms' if name.endswith('.ms') else 'h'
+        self.send('%s%s:%s|%s' % (self.prefix, name, value, kind))
+
+
+_sinks = None
+_sinksLock = threading.Lock()
+
+
+def getSinks():
+    global _sinks
+    if _sinks is None:
+        with _sinksLock:
+            if _sinks is None:
+                sinks = []
+                for path in settings.GEOCAM_FOLDER_STATS_SINKS:
+                    moduleName, className = path.rsplit('.', 1)
+                    sinks.append(getattr(import_module(moduleName), className)())
+                _sinks = sinks
+    return _sinks
+
+
+def getMemorySink():
+    for sink in getSinks():
+        if isinstance(sink, MemoryStatsSink):
+            return sink
+    return None
+
+
+def incr(name, value=1):
+    if settings.GEOCAM_FOLDER_STATS_ENABLED:
+        for sink in getSinks():
+            sink.incr(name, value)
+
+
+def observe(name, value):
+    if settings.GEOCAM_FOLDER_STATS_ENABLED:
+        for sink in getSinks():
+            sink.observe(name, value)
+
+
+def getQueryCount():
+    return sum([len(conn.queries) for conn in connections.all()])
+
+
+class QueryCounter(object):
+    """
+    Context manager that counts the db queries issued inside it on all
+    connections, even when DEBUG is off.  The count is available as
+    the @count member after the block exits.
+    """
+    def __init__(self):
+        self.count = None
+
+    def __enter__(self):
+        self.conns = connections.all()
+        self.saved = []
+        for conn in self.conns:
+            self.saved.append((conn.use_debug_cursor, len(conn.queries)))
+            conn.use_debug_cursor = True
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self.count = 0
+        for conn, (useDebugCursor, start) in zip(self.conns, self.saved):
+            self.count += len(conn.queries) - start
+            conn.use_debug_cursor = useDebugCursor
+            if not (useDebugCursor or settings.DEBUG):
+                # don't let the query log grow outside of DEBUG mode
+                del conn.queries[start:]
+        return False
+
+
+class Timer(object):
+    def __init__(self, name, countQueries):
+        self.name = name
+        self.queryCounter = QueryCounter() if countQueries else None
+
+    def __enter__(self):
+        if self.queryCounter:
+            self.queryCounter.__enter__()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        elapsedMs = (time.time() - self.start) * 1000
+        observe(self.name + '.ms', elapsedMs)
+        if self.queryCounter:
+            self.queryCounter.__exit__(excType, excValue, tb)
+            observe(self.name + '.queries', self.queryCounter.count)
+        incr(self.name + '.calls')
+        return False
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        return False
+
+NULL_TIMER = NullTimer()
+
+
+def timer(name, countQueries=False):
+    """
+    Returns a context manager that records the latency of its block as
+    @name.ms and, if @countQueries is set, the number of db queries it
+    issued as @name.queries.
+    """
+    if settings.GEOCAM_FOLDER_STATS_ENABLED:
+        return Timer(name, countQueries and settings.GEOCAM_FOLDER_STATS_COUNT_QUERIES)
+    else:
+        return NULL_TIMER
+
+
+def getPublishedSnapshots():
+    index = cache.get(STATS_INDEX_KEY) or []
+    snapshots = cache.get_many(index)
+    return [snapshots[key] for key in index if key in snapshots]
+
+
+def mergeSnapshots(snapshots):
+    """
+    Combines snapshots published by several processes.  Returns
+    (counters, histograms) where histograms maps names to Histogram
+    objects.
+    """
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, value in snapshot['counters'].iteritems():
+            counters[name] = counters.get(name, 0) + value
+        for name, histDict in snapshot['histograms'].iteritems():
+            hist = Histogram()
+            hist.__dict__.update(histDict)
+            if name in histograms:
+                histograms[name].merge(hist)
+            else:
+                histograms[name] = hist
+    return counters, histograms
+
+
+def clearPublishedSnapshots():
+    index = cache.get(STATS_INDEX_KEY) or []
+    cache.delete_many(index + [STATS_INDEX_KEY])
+    sink = getMemorySink()
+    if sink is not None:
+        sink.reset()
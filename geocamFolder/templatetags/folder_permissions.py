@@ -0,0 +1,102 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Template tags for checking permissions on many objects at once.
+
+  {% load folder_permissions %}
+  {% folder_permissions rows request.user as perms %}
+  {% for row in rows %}
+    {% with p=perms|permissions_for:row %}
+      {% if p.change %}<a href="...">edit</a>{% endif %}
+      {% if p.delete %}<a href="...">delete</a>{% endif %}
+    {% endwith %}
+  {% endfor %}
+
+The folder_permissions tag works out every allowed action for every
+object in one batched pass (see
+PermissionManager.getAllowedActionsMulti()), so the loop itself makes no
+queries.  Pass an action string such as "cd" as an extra argument to
+limit the actions checked.
+"""
+
+from django import template
+
+from geocamFolder.models import Actions, ACTION_CHOICES, PermissionManager, getModelLabel
+
+register = template.Library()
+
+
+def _getKey(obj):
+    return (getModelLabel(obj._meta.concrete_model), obj.pk)
+
+
+class AllowedActions(object):
+    """
+    The actions allowed on one object.  Has a boolean attribute per
+    action name (read, list, insert, delete, change, admin) and
+    supports "'c' in p".
+    """
+    def __init__(self, actions):
+        self.actions = actions
+        for name in ACTION_CHOICES:
+            setattr(self, name, name[0] in actions)
+
+    def __contains__(self, action):
+        return action in self.actions
+
+    def __unicode__(self):
+        return self.actions
+
+
+class PermissionTable(object):
+    def __init__(self, objects, user, actions):
+        objects = list(objects)
+        allowed = PermissionManager.getAllowedActionsMulti(objects, user, actions)
+        self.table = dict([(_getKey(obj), AllowedActions(objActions))
+                           for obj, objActions in zip(objects, allowed)])
+
+    def get(self, obj):
+        return self.table.get(_getKey(obj), AllowedActions(''))
+
+
+class FolderPermissionsNode(template.Node):
+    def __init__(self, objects, user, actions, varName):
+        self.objects = objects
+        self.user = user
+        self.actions = actions
+        self.varName = varName
+
+    def render(self, context):
+        user = self.user.resolve(context)
+        if not getattr(user, 'is_authenticated', lambda: False)():
+            user = None
+        actions = self.actions.resolve(context) if self.actions else Actions.ALL
+        context[self.varName] = PermissionTable(self.objects.resolve(context), user, actions)
+        return ''
+
+
+@register.tag('folder_permissions')
+def folderPermissions(parser, token):
+    """
+    {% folder_permissions objects user [actions] as varName %}
+    """
+    bits = token.split_contents()
+    if len(bits) not in (5, 6) or bits[-2] != 'as':
+        raise template.TemplateSyntaxError('usage: {%% %s objects user [actions] as varName %%}'
+                                           % bits[0])
+    actions = parser.compile_filter(bits[3]) if len(bits) == 6 else None
+    return FolderPermissionsNode(parser.compile_filter(bits[1]), parser.compile_filter(bits[2]),
+                                 actions, bits[-1])
+
+
+@register.filter('permissions_for')
+def permissionsFor(table, obj):
+    """
+    {{ perms|permissions_for:obj }} looks up the AllowedActions of
+    @obj in a table made by the folder_permissions tag.
+    """
+    return table.get(obj)
@@ -4,16 +4,36 @@
 # All Rights Reserved.
 # __END_LICENSE__
 
+import os
 import re
-# import time
+import copy
+import json
+import time
+import shutil
+import tempfile
+from cStringIO import StringIO
 
-from django.test import TestCase
-from django.contrib.auth.models import User
-from django.core.exceptions import PermissionDenied
+from django.db import connection, router, transaction
+from django.db.utils import IntegrityError
+from django.template import Template, Context
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.contrib.auth.models import User, Group
+from django.core.cache import get_cache
+from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
+from django.core.management import call_command
+from django.core.management.color import no_style
+from django.core.signals import request_finished
 
-from geocamFolder.models import getCacheKey, Folder, Action, Actions
+from geocamFolder import models, stats
+from geocamFolder.benchmark import BenchmarkConfig, runBenchmark
+from geocamFolder import importExport, loadtest, routers, snapshot
+from geocamFolder.models import getCacheKey, getCacheLockKey, getWithCache, getManyWithCache
+from geocamFolder.models import waitForRefreshAhead
+from geocamFolder.models import Folder, Action, Actions, getPermissionMatrix
 from geocamFolder.models import FolderMemberExample as Member
-# from geocamFolder.models import getWithCache
+from geocamFolder.models import FolderAwarePosition
+from geocamFolder.management.commands.geocamfolder_upgrade_indexes import getIndexNames
 
 
 class CacheTest(TestCase):
@@ -47,6 +67,360 @@ class CacheTest(TestCase):
     #     self.assertEquals(1, getWithCache(getX, (), timeout=0.01))
 
 
+@override_settings(GEOCAM_FOLDER_FOLDER_CACHE_ENABLED=True,
+                   GEOCAM_FOLDER_FOLDER_CACHE_STALE_SECONDS=30,
+                   GEOCAM_FOLDER_FOLDER_CACHE_LOCK_WAIT_SECONDS=0.1,
+                   GEOCAM_FOLDER_FOLDER_CACHE_LOCK_POLL_SECONDS=0.01,
+                   GEOCAM_FOLDER_FOLDER_CACHE_LOCK_TIMEOUT_SECONDS=60,
+                   GEOCAM_FOLDER_FOLDER_CACHE_REFRESH_AHEAD_ENABLED=False)
+class SingleFlightCacheTest(TestCase):
+    # use a private local-memory cache so the test doesn't depend on
+    # how the site cache is configured
+    def setUp(self):
+        self.siteCache = models.cache
+        models.cache = get_cache('django.core.cache.backends.locmem.LocMemCache',
+                                 LOCATION='geocamFolderTest')
+        models.cache.clear()
+        self.x = 0
+        self.calls = 0
+
+    def tearDown(self):
+        models.cache = self.siteCache
+
+    def getX(self):
+        self.calls += 1
+        return self.x
+
+    def test_servesStaleWhileLocked(self):
+        self.assertEquals(0, getWithCache(self.getX, (), timeout=0))
+        self.x = 1
+
+        # another process holds the lock: serve the stale value
+        lockKey = getCacheLockKey(getCacheKey(self.getX, ()))
+        models.cache.add(lockKey, 1)
+        self.assertEquals(0, getWithCache(self.getX, (), timeout=0))
+        self.assertEquals(1, self.calls)
+
+        # lock released: this process recomputes
+        models.cache.delete(lockKey)
+        self.assertEquals(1, getWithCache(self.getX, (), timeout=60))
+        self.assertEquals(2, self.calls)
+        self.assertEquals(1, getWithCache(self.getX, (), timeout=60))
+        self.assertEquals(2, self.calls)
+
+    def test_boundedWaitForMissingValue(self):
+        lockKey = getCacheLockKey(getCacheKey(self.getX, ()))
+        models.cache.add(lockKey, 1)
+        self.x = 5
+        # lock holder never finishes, so we compute it after the wait
+        self.assertEquals(5, getWithCache(self.getX, (), timeout=60))
+        self.assertEquals(1, self.calls)
+
+    def test_getManyWithCache(self):
+        def double(x):
+            self.calls += 1
+            return 2 * x
+
+        self.assertEquals([2, 4], getManyWithCache(double, [(1,), (2,)], timeout=60))
+        self.assertEquals([2, 4, 6], getManyWithCache(double, [(1,), (2,), (3,)], timeout=60))
+        self.assertEquals(3, self.calls)
+
+    @override_settings(GEOCAM_FOLDER_FOLDER_CACHE_REFRESH_AHEAD_ENABLED=True,
+                       GEOCAM_FOLDER_FOLDER_CACHE_REFRESH_AHEAD_SECONDS=60,
+                       GEOCAM_FOLDER_FOLDER_CACHE_REFRESH_AHEAD_MIN_HITS=2)
+    def test_refreshAhead(self):
+        self.assertEquals(0, getWithCache(self.getX, (), timeout=30))
+        self.x = 1
+
+        # the second hit makes the key hot; it's within 60 seconds of
+        # going stale, so it gets refreshed in the background
+        self.assertEquals(0, getWithCache(self.getX, (), timeout=30))
+        self.assertEquals(0, getWithCache(self.getX, (), timeout=30))
+        waitForRefreshAhead()
+        self.assertEquals(2, self.calls)
+        self.assertEquals(1, getWithCache(self.getX, (), timeout=30))
+        self.assertEquals(2, self.calls)
+
+
+@override_settings(GEOCAM_FOLDER_STATS_ENABLED=True,
+                   GEOCAM_FOLDER_STATS_SINKS=('geocamFolder.stats.MemoryStatsSink',),
+                   GEOCAM_FOLDER_STATS_COUNT_QUERIES=True,
+                   GEOCAM_FOLDER_FOLDER_CACHE_ENABLED=False)
+class StatsTest(TestCase):
+    def setUp(self):
+        # pick up the overridden sink list
+        stats._sinks = None
+        self.sink = stats.getMemorySink()
+
+    def tearDown(self):
+        stats._sinks = None
+
+    def test_histogram(self):
+        hist = stats.Histogram()
+        for i in xrange(100):
+            hist.observe(i)
+        self.assertEquals(100, hist.count)
+        self.assertEquals(99, hist.max)
+        self.assert_(25 <= hist.percentile(50) <= 100)
+
+    def test_isAllowedStats(self):
+        alice = User.objects.create_user('alice', 'alice@example.com')
+        Folder.getRootFolder().isAllowed(alice, Action.READ)
+        self.assertEquals(1, self.sink.counters['permission.folderIsAllowed.calls'])
+        self.assert_(self.sink.histograms['permission.folderIsAllowed.queries'].max > 0)
+
+    def test_statsCommand(self):
+        # private caches for the published statistics and the folder cache
+        siteCaches = (stats.cache, models.cache)
+        stats.cache = models.cache = get_cache('django.core.cache.backends.locmem.LocMemCache',
+                                               LOCATION='geocamFolderStatsTest')
+        stats.cache.clear()
+        try:
+            alice = User.objects.create_user('alice', 'alice@example.com')
+            root = Folder.getRootFolder()
+            # one uncached check, then a cold and two warm cached checks
+            root.isAllowed(alice, Action.READ)
+            with override_settings(GEOCAM_FOLDER_FOLDER_CACHE_ENABLED=True):
+                for _ in xrange(3):
+                    root.isAllowed(alice, Action.READ)
+            self.sink.publish()
+            out = StringIO()
+            call_command('geocamfolder_stats', json=True, stdout=out)
+            result = json.loads(out.getvalue())
+        finally:
+            stats.cache, models.cache = siteCaches
+        counters = result['counters']
+        self.assertEquals(1, result['processes'])
+        self.assertEquals(4, counters['permission.folderIsAllowed.calls'])
+        self.assertEquals(1, counters['cache._getAllowedFoldersInShardNoCache.miss'])
+        self.assertEquals(2, counters['cache._getAllowedFoldersInShardNoCache.hit'])
+        self.assertEquals(1, counters['rebuild._getAllowedFoldersInShardNoCache.calls'])
+
+
+class BenchmarkTest(TestCase):
+    def setUp(self):
+        # the benchmark flushes the folder cache; don't let that leak
+        # into tests that check cache keys
+        self.cacheVersion = models.FOLDER_CACHE_VERSION
+
+    def tearDown(self):
+        models.FOLDER_CACHE_VERSION = self.cacheVersion
+
+    def test_runBenchmark(self):
+        config = BenchmarkConfig(folders=20, depth=3, fanout=3, users=5, groups=2,
+                                 members=10, repeat=2)
+        result = runBenchmark(config, cacheModes=(False,))
+        self.assertEquals(21, result['numFolders'])
+        operations = set([r['operation'] for r in result['results']])
+        self.assert_(set(['getFolderTree', 'filterAllowed', 'mkdir', 'setPermissions']) <= operations)
+        json.dumps(result)
+
+
+class LoadTestTest(TestCase):
+    def setUp(self):
+        # workers swap in a file-based cache and the load test flushes
+        # the folder cache
+        self.siteCache = models.cache
+        self.cacheVersion = models.FOLDER_CACHE_VERSION
+
+    def tearDown(self):
+        models.cache = self.siteCache
+        models.FOLDER_CACHE_VERSION = self.cacheVersion
+
+    def test_loadtest(self):
+        # worker processes can't share the in-memory test database
+        self.assertRaises(ValueError, call_command, 'geocamfolder_loadtest',
+                          workers=1, duration=0.1, stdout=StringIO())
+
+        # run one worker in this process instead
+        config = loadtest.setUp({'workers': 1, 'duration': 0.3, 'writeFraction': 0.5,
+                                 'numFolders': 5, 'numUsers': 2, 'cache': loadtest.FILE_CACHE,
+                                 'sharedNames': 2, 'seed': 0, 'stalenessCheckInterval': 2})
+        try:
+            config['startTime'] = time.time()
+            configPath = os.path.join(config['workDir'], 'config.json')
+            with open(configPath, 'w') as configFile:
+                json.dump(config, configFile)
+            out = StringIO()
+            call_command('geocamfolder_loadtest', runWorker=0, config=configPath, stdout=out)
+            result = loadtest.summarize(config, [json.loads(out.getvalue())])
+        finally:
+            models.cache = self.siteCache
+            loadtest.tearDown(config)
+        self.assert_(result['totalOps'] > 0)
+        self.assertEquals({}, result['errors'])
+        self.assert_(result['sharedFoldersCreated'] <= 2)
+        json.dumps(result)
+
+
+@override_settings(GEOCAM_FOLDER_FOLDER_CACHE_ENABLED=True)
+class FolderTreeTest(TestCase):
+    def setUp(self):
+        # shards hold deferred Folders and tuples, which a local-memory cache can pickle
+        self.siteCache = models.cache
+        models.cache = get_cache('django.core.cache.backends.locmem.LocMemCache',
+                                 LOCATION='geocamFolderTreeTest')
+        models.cache.clear()
+        Folder.mkdir('/a')
+        Folder.mkdir('/a/b')
+        Folder.mkdir('/a/b/c')
+        Folder.mkdir('/a/x')
+        Folder.mkdir('/other')
+
+    def tearDown(self):
+        models.cache = self.siteCache
+
+    def test_partialTree(self):
+        tree = models.getFolderTree('/a', depth=1)
+        self.assertEquals('/a', tree.root.path)
+        self.assertEquals(['b', 'x'], sorted(tree.root.subFolders.keys()))
+        b = tree.root.subFolders['b']
+        self.assertFalse(b.isLoaded())
+        self.assertEquals(['/a', '/a/b', '/a/x'], sorted([n.path for n in tree.byId.values()]))
+
+        # first access loads the branch
+        self.assertEquals('/a/b/c', b.subFolders['c'].path)
+        self.assertEquals(Folder.getFolder('/a/b/c').id, b.subFolders['c'].id)
+
+        # branches visited before come from the cache
+        with self.assertNumQueries(0):
+            tree = models.getFolderTree('/a', depth=1)
+            self.assertEquals(['c'], tree.root.subFolders['b'].subFolders.keys())
+
+        self.assertRaises(ObjectDoesNotExist, models.getFolderTree, '/nope')
+
+    def test_shards(self):
+        a = Folder.getFolder('/a')
+        other = Folder.getFolder('/other')
+        self.assertEquals(a.id, models.getFolderShardId(Folder.getFolder('/a/b/c').id))
+        self.assertEquals(models.ROOT_SHARD, models.getFolderShardId(a.id))
+        self.assertEquals('/a/b/c', models.getFolderTree().byId[Folder.getFolder('/a/b/c').id].path)
+        models.getAllowedFolders(None, Action.READ)
+        before = models.getShardGenerations([a.id, other.id])
+
+        # a change below /a leaves the other shard's entries alone
+        Folder.mkdir('/a/y')
+        after = models.getShardGenerations([a.id, other.id])
+        self.assertNotEquals(before[a.id], after[a.id])
+        self.assertEquals(before[other.id], after[other.id])
+        with self.assertNumQueries(0):
+            models.getShardFolders([other.id])
+
+        y = Folder.getFolder('/a/y')
+        self.assertEquals('/a/y', y.path)
+        self.assert_(y.id in models.getAllowedFolders(None, Action.READ))
+        self.assert_(y.isAllowed(None, Action.READ))
+
+    def test_search(self):
+        def search(prefix, limit=20):
+            return [f.path for f in Folder.search(prefix, None, limit)]
+
+        self.assertEquals(['/a/b', '/a/b/c', '/a/x'], search('/a/'))
+        self.assertEquals(['/a', '/a/b'], search('/A', limit=2))
+        self.assertEquals(['/a/x'], search('x'))
+        with self.assertNumQueries(1):
+            search('/a/')
+
+        # unlistable folders are hidden, as in listdir(), and so are
+        # their subfolders, which getFolder() can't reach
+        Folder.getFolder('/a/b').setPermissions('group:anyuser', Actions.NONE)
+        self.assertEquals(['/a/x'], search('/a/'))
+        self.assertEquals([], search('c'))
+        self.assertEquals(['x'], [f.name for f, _ in Folder.getFolder('/a').listdir(None)])
+        Folder.mkdir('/a/xy')
+        self.assertEquals(['/a/x', '/a/xy'], search('/a/x'))
+        self.assertEquals(['/a/b/c'], [f.path for f in Folder.search('c', User(is_superuser=True))])
+
+
+class ImportExportTest(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', 'alice@example.com')
+        exp = Folder.mkdir('/exp')
+        exp.setPermissions(self.alice, Actions.WRITE)
+        Folder.mkdir('/exp/a').setPermissions('group:authuser', Actions.READ)
+        Folder.mkdir('/exp/a/b')
+        Folder.mkdir('/exp/c')
+
+    def roundTrip(self, format):
+        acls = dict([(path, Folder.getFolder(path).getAcl())
+                     for path in ('/exp', '/exp/a', '/exp/a/b', '/exp/c')])
+        out = StringIO()
+        importExport.writeRecords(importExport.iterRecords('/exp'), out, format)
+        Folder.getFolder('/exp').delete()
+        models.flushCache()
+
+        importer = importExport.FolderImporter(chunkSize=2)
+        result = importer.run(importExport.readRecords(StringIO(out.getvalue()), format))
+        self.assertEquals(4, result['folders'])
+        self.assertEquals(0, result['errors'])
+        for path, acl in acls.iteritems():
+            self.assertEquals(acl, Folder.getFolder(path).getAcl())
+
+    def test_jsonl(self):
+        self.roundTrip('jsonl')
+
+    def test_csv(self):
+        self.roundTrip('csv')
+
+    def test_existingFoldersAreKept(self):
+        acl = Folder.getFolder('/exp/a').getAcl()
+        out = StringIO()
+        importExport.writeRecords(importExport.iterRecords('/exp'), out)
+        # replacing the existing ACL entries doesn't flush per row
+        flushes = []
+        flushAclShard = models.flushAclShard
+        models.flushAclShard = flushes.append
+        try:
+            result = importExport.FolderImporter().run(importExport.readRecords(StringIO(out.getvalue())))
+        finally:
+            models.flushAclShard = flushAclShard
+        self.assertEquals([], flushes)
+        self.assertEquals(0, result['folders'])
+        self.assertEquals(4, result['existingFolders'])
+        self.assertEquals(acl, Folder.getFolder('/exp/a').getAcl())
+
+
+@override_settings(GEOCAM_FOLDER_WRITE_DATABASE='default',
+                   GEOCAM_FOLDER_READ_DATABASES=('replica',),
+                   GEOCAM_FOLDER_REPLICA_APPS=('geocamFolder',),
+                   GEOCAM_FOLDER_READ_YOUR_WRITES_SECONDS=10,
+                   GEOCAM_FOLDER_FOLDER_CACHE_ENABLED=True)
+class ReplicaRouterTest(TestCase):
+    # the example project's 'replica' database is a replica that never
+    # catches up with 'default'
+    multi_db = True
+
+    def setUp(self):
+        self.siteRouters = router.routers
+        router.routers = [routers.FolderReplicaRouter()]
+        self.siteCache = models.cache
+        models.cache = get_cache('django.core.cache.backends.locmem.LocMemCache',
+                                 LOCATION='geocamReplicaRouterTest')
+        models.cache.clear()
+        routers.clearPin()
+
+    def tearDown(self):
+        routers.clearPin()
+        models.cache = self.siteCache
+        router.routers = self.siteRouters
+
+    def test_readYourWrites(self):
+        Folder.mkdir('/a')
+        # pinned to the primary after a write
+        self.assert_(Folder.objects.filter(name='a').exists())
+        routers.clearPin()
+        self.assertFalse(Folder.objects.filter(name='a').exists())
+        self.assertEquals(None, router.routers[0].db_for_read(User))
+
+    def test_cacheRebuildsReadFromPrimary(self):
+        Folder.mkdir('/a')
+        # another request, not pinned, rebuilds the cache after the write
+        routers.clearPin()
+        [rootShard] = models.getShardFolders([models.ROOT_SHARD])
+        self.assert_('a' in [f.name for f in rootShard])
+        self.assertEquals('/a', Folder.getFolder('/a').path)
+
+
 class FolderTest(TestCase):
     def makeFolderWithPerms(self, agent, actionsName):
         root = Folder.getRootFolder()
@@ -65,6 +439,7 @@ class FolderTest(TestCase):
         return folder
 
     def setUp(self):
+        self.siteCache = models.cache
         self.admin = User.objects.create_superuser('admin', 'admin@example.com', password='12345')
         self.alice = User.objects.create_user('alice', 'alice@example.com')
         self.bob = User.objects.create_user('bob', 'bob@example.com')
@@ -88,6 +463,16 @@ class FolderTest(TestCase):
         for level in levels:
             self.authuserDir[level] = self.makeFolderWithPerms('group:authuser', level)
 
+    def tearDown(self):
+        models.cache = self.siteCache
+
+    def usePrivateCache(self):
+        # a private, empty cache, so entries a test warms aren't culled
+        # to make room for entries left by other tests
+        models.cache = get_cache('django.core.cache.backends.locmem.LocMemCache',
+                                 LOCATION='geocamFolderTest')
+        models.cache.clear()
+
     def test_insertObject(self):
         # admin, alice and bob have write privileges
         m = Member(name='byAdmin')
@@ -153,6 +538,166 @@ class FolderTest(TestCase):
         # dave has no privileges, denied
         self.assertFalse(containsX(Member.allowed(self.dave)))
 
+    def test_denormalizedFolders(self):
+        p = FolderAwarePosition.objects.create(x=0, y=1)
+        p.folders = [self.f1]
+        p = FolderAwarePosition.objects.get(pk=p.pk)
+        self.assertEquals((self.f1.id, False), (p.primaryFolder_id, p.hasOtherFolders))
+        self.assert_(p.isAllowed(self.clara, Action.READ))
+        self.assertFalse(p.isAllowed(self.dave, Action.READ))
+        self.assertEquals([p], list(FolderAwarePosition.allowed(self.clara)))
+        self.assertEquals([], list(FolderAwarePosition.allowed(self.dave)))
+
+        # dave can read the second folder, which goes through the join
+        readDir = self.anyuserDir['read']
+        readDir.folderawareposition_set.add(p)
+        p = FolderAwarePosition.objects.get(pk=p.pk)
+        self.assertEquals((min(self.f1.id, readDir.id), True),
+                          (p.primaryFolder_id, p.hasOtherFolders))
+        self.assert_(p.isAllowed(self.dave, Action.READ))
+        self.assertEquals([p], list(FolderAwarePosition.allowed(self.dave)))
+
+        readDir.folderawareposition_set.clear()
+        p = FolderAwarePosition.objects.get(pk=p.pk)
+        self.assertEquals((self.f1.id, False), (p.primaryFolder_id, p.hasOtherFolders))
+        self.assertEquals([], list(FolderAwarePosition.allowed(self.dave)))
+
+        # backfill for rows that predate the denormalized fields
+        FolderAwarePosition.objects.update(primaryFolder=None)
+        call_command('geocamfolder_sync_members', 'geocamFolder.FolderAwarePosition',
+                     stdout=StringIO())
+        self.assertEquals(self.f1.id, FolderAwarePosition.objects.get(pk=p.pk).primaryFolder_id)
+
+    def test_denormalizedFoldersSurviveSave(self):
+        # the documented pattern saves the object again after setting
+        # its folders
+        p = FolderAwarePosition(x=0, y=1)
+        p.saveAssertAllowed(self.alice, checkFolders=[self.f1])
+        p.folders = [self.f1]
+        p.save()
+        p = FolderAwarePosition.objects.get(pk=p.pk)
+        self.assertEquals((self.f1.id, False), (p.primaryFolder_id, p.hasOtherFolders))
+        self.assert_(p.isAllowed(self.clara, Action.READ))
+        self.assertEquals([p], list(FolderAwarePosition.allowed(self.clara)))
+
+    def test_bulkCreateAssertAllowed(self):
+        readDir = self.anyuserDir['read']
+        positions = [FolderAwarePosition(x=i, y=0) for i in xrange(5)]
+        self.assertRaises(PermissionDenied, FolderAwarePosition.bulkCreateAssertAllowed,
+                          self.clara, positions, [self.f1])
+        self.assertEquals(0, FolderAwarePosition.objects.count())
+
+        # the query count doesn't depend on the number of rows.  the
+        # first call warms the caches for bob and f1, so both measured
+        # calls are warm
+        self.usePrivateCache()
+        FolderAwarePosition.bulkCreateAssertAllowed(self.bob, positions[:1], [self.f1])
+        with stats.QueryCounter() as one:
+            FolderAwarePosition.bulkCreateAssertAllowed(self.bob, positions[1:2], [self.f1])
+        with stats.QueryCounter() as many:
+            FolderAwarePosition.bulkCreateAssertAllowed(self.bob, positions[2:], [self.f1])
+        self.assertEquals(one.count, many.count)
+        self.assertEquals(5, len(FolderAwarePosition.allowed(self.clara)))
+        p = FolderAwarePosition.objects.get(pk=positions[0].pk)
+        self.assertEquals((self.f1.id, False), (p.primaryFolder_id, p.hasOtherFolders))
+        self.assertEquals([self.f1], list(p.folders.all()))
+
+        Member.bulkCreateAssertAllowed(self.admin, [Member(name='bulk%d' % i) for i in xrange(3)],
+                                       [self.f1, readDir])
+        self.assertEquals(3, models.getMemberCounts()[self.f1.id])
+        self.assertEquals(4, models.getMemberCounts()[readDir.id])
+
+    def test_getOrMakeSubFolder(self):
+        sub, created = self.f1.getOrMakeSubFolder('sub')
+        self.assert_(created)
+        self.assertEquals(self.f1.getAcl(), sub.getAcl())
+        self.assertEquals((sub, False), self.f1.getOrMakeSubFolder('sub'))
+        self.assertEquals((sub, False), Folder.getOrMkdir('/f1/sub'))
+
+        # another process creates the folder between our lookup and insert
+        createSubFolder = self.f1._createSubFolder
+
+        def racingCreate(name, admin):
+            self.f1._createSubFolder = createSubFolder
+            Folder(name=name, parent=self.f1).save()
+            return createSubFolder(name, admin)
+        self.f1._createSubFolder = racingCreate
+        raced, _ = self.f1.getOrMakeSubFolder('raced')
+        self.assertEquals([raced], list(Folder.objects.filter(parent=self.f1, name='raced')))
+
+        self.assertRaises(PermissionDenied, self.f1.getOrMakeSubFolderAssertAllowed,
+                          self.clara, 'byClara')
+        self.assertEquals((sub, False), self.f1.getOrMakeSubFolderAssertAllowed(self.clara, 'sub'))
+        bobs, created = Folder.getOrMkdirAssertAllowed(self.bob, '/f1/byBob')
+        self.assert_(created)
+        self.assert_(bobs.isAllowed(self.bob, Action.ADMIN))
+
+    def test_iterAllowed(self):
+        # a member in two folders that clara can read must come out once
+        readDir = self.authuserDir['read']
+        names = ['n%d' % i for i in xrange(7)]
+        for name in names:
+            m = Member.objects.create(name=name)
+            m.folders = [self.f1, readDir]
+        allowed = set(Member.allowed(self.clara).values_list('pk', flat=True))
+
+        pks = [m.pk for m in Member.iterAllowed(self.clara, chunkSize=3)]
+        self.assertEquals(sorted(allowed), pks)
+
+        members, cursor = Member.getAllowedPage(self.clara, orderBy='-name', limit=4)
+        self.assertEquals(['n6', 'n5', 'n4', 'n3'], [m.name for m in members])
+        rest = [m.name for m in Member.iterAllowed(self.clara, orderBy='-name', cursor=cursor)
+                if m.name.startswith('n')]
+        self.assertEquals(['n2', 'n1', 'n0'], rest)
+        self.assertRaises(ValueError, Member.getAllowedPage, self.clara, cursor='bogus')
+
+    def test_folderPermissionsTag(self):
+        objects = list(Member.objects.all()) + list(Folder.objects.all())
+        for user in (None, self.bob, self.clara, self.dave):
+            allowed = models.PermissionManager.getAllowedActionsMulti(objects, user)
+            for obj, actions in zip(objects, allowed):
+                for action in Actions.ALL:
+                    self.assertEquals(obj.isAllowed(user, action), action in actions)
+
+        tmpl = Template('{% load folder_permissions %}'
+                        '{% folder_permissions rows user "cd" as perms %}'
+                        '{% for row in rows %}{% with p=perms|permissions_for:row %}'
+                        '{{ row.name }}:{% if p.change %}c{% endif %}{% if "d" in p %}d{% endif %} '
+                        '{% endwith %}{% endfor %}')
+        rows = list(Member.objects.order_by('pk'))
+        expected = ''.join(['foo:%s ' % ('cd' if m.isAllowed(self.bob, Action.CHANGE) else '')
+                            for m in rows])
+        # the query count doesn't depend on the number of rows.  warm
+        # the caches for bob and these actions first, so both measured
+        # renders are warm
+        self.usePrivateCache()
+        tmpl.render(Context({'rows': rows, 'user': self.bob}))
+        with stats.QueryCounter() as many:
+            self.assertEquals(expected, tmpl.render(Context({'rows': rows, 'user': self.bob})))
+        with stats.QueryCounter() as one:
+            tmpl.render(Context({'rows': rows[:1], 'user': self.bob}))
+        self.assertEquals(one.count, many.count)
+
+    def test_listdir(self):
+        sub = self.f1.makeSubFolder('sub')
+        hidden = self.f1.makeSubFolder('hidden')
+        hidden.setPermissions(self.clara, Actions.NONE)
+        a = Member.objects.create(name='a')
+        b = Member.objects.create(name='b')
+        a.folders = [sub, hidden]
+        sub.foldermemberexample_set.add(b)
+
+        self.assertEquals([('hidden', 1), ('sub', 2)],
+                          [(f.name, n) for f, n in self.f1.listdir(self.admin)])
+        self.assertEquals([('sub', 2)], [(f.name, n) for f, n in self.f1.listdir(self.clara)])
+        self.assertEquals([('sub', None)],
+                          [(f.name, n) for f, n in self.f1.listdir(self.clara, withCounts=False)])
+
+        a.folders.remove(sub, hidden)
+        b.delete()
+        self.assertEquals([('hidden', 0), ('sub', 0)],
+                          [(f.name, n) for f, n in self.f1.listdir(self.admin)])
+
     def doTestFor(self, dirDict, requestingUser):
         # changing acl should work on 'all' but not on 'write'
         dirDict['all'].setPermissionsAssertAllowed(requestingUser, self.alice, Actions.READ)
@@ -180,8 +725,356 @@ class FolderTest(TestCase):
         self.assert_(Member.allowed(requestingUser).filter(folders=dirDict['read']).exists())
         self.assertFalse(Member.allowed(requestingUser).filter(folders=dirDict['none']).exists())
 
+    def test_getAcls(self):
+        folders = [self.f1] + self.anyuserDir.values() + self.authuserDir.values()
+        with self.assertNumQueries(2):
+            acls = Folder.getAcls(folders)
+        self.assertEquals({'alice': Actions.ALL, 'bob': Actions.WRITE, 'clara': Actions.READ},
+                          acls[self.f1.id])
+        self.assertEquals({'group:authuser': Actions.WRITE}, acls[self.authuserDir['write'].id])
+
+        pairs = list(Folder.iterAcls(Folder.objects.filter(parent=Folder.getRootFolder()),
+                                     chunkSize=3))
+        self.assertEquals(len(folders), len(pairs))
+        for folder, acl in pairs:
+            self.assertEquals(acls[folder.id], acl)
+
+    def test_getAllowedActions(self):
+        self.assertEquals(Actions.WRITE, self.f1.getAllowedActions(self.bob))
+        self.assertEquals(Actions.NONE, self.f1.getAllowedActions(self.dave))
+        self.assertEquals(Actions.ALL, self.f1.getAllowedActions(self.admin))
+        self.assertEquals('r', self.f1.getAllowedActions(self.clara, 'ri'))
+
+    def test_getAllowedUsers(self):
+        users = [self.admin, self.alice, self.bob, self.clara, self.dave]
+        self.assertEquals(set([self.admin, self.alice, self.bob]),
+                          set(self.f1.getAllowedUsers(Action.INSERT)))
+        self.assertEquals(set(users), set(self.authuserDir['read'].getAllowedUsers(Action.READ)))
+        self.assertEquals(set([self.admin]), set(self.authuserDir['read'].getAllowedUsers(Action.INSERT)))
+        self.assertEquals(['authuser'], [g.name for g in self.authuserDir['read'].getAllowedGroups(Action.READ)])
+
+        self.dave.is_active = False
+        self.dave.save()
+        self.assertFalse(self.dave in self.authuserDir['read'].getAllowedUsers(Action.READ))
+        self.assert_(self.dave in self.anyuserDir['read'].getAllowedUsers(Action.READ))
+
+    def test_getPermissionMatrix(self):
+        if models.numpy is None:
+            self.skipTest('numpy is not installed')
+        crew = Group.objects.create(name='crew')
+        self.clara.groups.add(crew)
+        self.authuserDir['none'].setPermissions(crew, Actions.WRITE)
+        self.assertEquals(set([self.admin, self.clara]),
+                          set(self.authuserDir['none'].getAllowedUsers(Action.INSERT)))
+
+        users = [self.admin, self.alice, self.bob, self.clara, self.dave]
+        folders = [self.f1] + self.anyuserDir.values() + self.authuserDir.values()
+        for action in Actions.ALL:
+            matrix = getPermissionMatrix(users, folders, action)
+            for i, user in enumerate(users):
+                for j, folder in enumerate(folders):
+                    self.assertEquals(folder.isAllowed(user, action), matrix[i, j])
+
     def test_anyuser(self):
         self.doTestFor(self.anyuserDir, None)
 
     def test_authuser(self):
         self.doTestFor(self.authuserDir, self.dave)
+
+
+@override_settings(GEOCAM_FOLDER_FOLDER_CACHE_ENABLED=False,
+                   GEOCAM_FOLDER_API_STREAM_MIN_FOLDERS=5000)
+class ViewsTest(TestCase):
+    urls = 'geocamFolder.urls'
+
+    def setUp(self):
+        # a private cache for the generation and payloads
+        self.siteCache = models.cache
+        models.cache = get_cache('django.core.cache.backends.locmem.LocMemCache',
+                                 LOCATION='geocamFolderViewsTest')
+        models.cache.clear()
+        self.cacheVersion = models.FOLDER_CACHE_VERSION
+        root = Folder.getRootFolder()
+        self.f1 = root.makeSubFolder('f1')
+        self.f1.makeSubFolder('sub')
+        # as if the test's transaction had committed, so the first
+        # request doesn't end with a replay
+        models.replayPendingFlushes()
+
+    def tearDown(self):
+        models.cache = self.siteCache
+        models.FOLDER_CACHE_VERSION = self.cacheVersion
+
+    def test_treeJson(self):
+        response = self.client.get('/tree.json', {'path': '/f1'})
+        self.assertEquals(200, response.status_code)
+        tree = json.loads(response.content)
+        self.assertEquals(['sub'], [f['name'] for f in tree['subFolders']])
+
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get('/tree.json', {'path': '/f1'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(304, response.status_code)
+
+        # any folder or ACL change starts a new generation
+        self.f1.setPermissions('group:anyuser', Actions.NONE)
+        response = self.client.get('/tree.json', {'path': '/f1'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(200, response.status_code)
+        self.assertNotEquals(etag, response['ETag'])
+        self.assertEquals(None, json.loads(response.content)['subFolders'])
+
+        with override_settings(GEOCAM_FOLDER_API_STREAM_MIN_FOLDERS=1):
+            response = self.client.get('/tree.json')
+        self.assert_(response.streaming)
+        tree = json.loads(''.join(response.streaming_content))
+        self.assertEquals(None, [f for f in tree['subFolders'] if f['name'] == 'f1'][0]['subFolders'])
+
+    def test_folderAndAclJson(self):
+        folder = json.loads(self.client.get('/folder.json', {'path': '/f1'}).content)
+        self.assertEquals(('/f1', Actions.READ, ['sub']),
+                          (folder['path'], folder['allowedActions'], folder['subFolders']))
+        self.assertEquals(404, self.client.get('/folder.json', {'path': '/nope'}).status_code)
+        self.assertEquals(403, self.client.get('/acl.json', {'path': '/f1'}).status_code)
+
+    def test_userChangesStartNewETags(self):
+        User.objects.create_superuser('admin', 'admin@example.com', password='12345')
+        self.client.login(username='admin', password='12345')
+        response = self.client.get('/acl.json', {'path': '/f1'})
+        self.assertEquals(200, response.status_code)
+        etag = response['ETag']
+
+        # a demoted user doesn't get the cached payload or a 304
+        User.objects.filter(username='admin').update(is_superuser=False)
+        self.assertEquals(403, self.client.get('/acl.json', {'path': '/f1'}).status_code)
+        response = self.client.get('/acl.json', {'path': '/f1'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(403, response.status_code)
+
+        # nor does one whose group memberships changed
+        alice = User.objects.create_user('alice', 'alice@example.com', password='12345')
+        group = Group.objects.create(name='readers')
+        self.f1.setPermissions(group, Actions.READ)
+        self.client.login(username='alice', password='12345')
+        response = self.client.get('/folder.json', {'path': '/f1'})
+        alice.groups.add(group)
+        response = self.client.get('/folder.json', {'path': '/f1'}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEquals(200, response.status_code)
+
+    def test_flushesRepeatedAfterRequest(self):
+        # TestCase manages the transaction, like TransactionMiddleware
+        self.f1.setPermissions('group:anyuser', Actions.NONE)
+        generation = models.getCacheGeneration()
+        request_finished.send(sender=self.__class__)
+        self.assertNotEquals(generation, models.getCacheGeneration())
+        generation = models.getCacheGeneration()
+        request_finished.send(sender=self.__class__)
+        self.assertEquals(generation, models.getCacheGeneration())
+
+
+class UpgradeIndexesTest(TestCase):
+    def getIndexes(self, table):
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name=%s", [table])
+        return set([row[0] for row in cursor.fetchall()])
+
+    def test_upgradeIndexes(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('index introspection here is sqlite-only')
+        model = models.UserPermission
+        table = model._meta.db_table
+        style = no_style()
+        fields = [model._meta.get_field(name) for name in model._meta.index_together[0]]
+        [composite] = getIndexNames(connection.creation.sql_indexes_for_fields(model, fields, style))
+        current = self.getIndexes(table)
+        self.assert_(composite in current)
+
+        # an index left by an old install
+        field = copy.copy(model._meta.get_field('canRead'))
+        field.db_index = True
+        oldSql = connection.creation.sql_indexes_for_field(model, field, style)
+        [old] = getIndexNames(oldSql)
+        connection.cursor().execute(oldSql[0])
+
+        out = StringIO()
+        call_command('geocamfolder_upgrade_indexes', dry_run=True, stdout=out)
+        self.assert_('DROP INDEX IF EXISTS "%s"' % old in out.getvalue())
+        self.assertEquals(current | set([old]), self.getIndexes(table))
+
+        call_command('geocamfolder_upgrade_indexes', stdout=StringIO())
+        self.assertEquals(current, self.getIndexes(table))
+
+        partial = set(['%s_%s_partial' % (table, model.getActionField(action).lower())
+                       for action in Actions.ALL] + [table + '_user_id_folder'])
+        try:
+            call_command('geocamfolder_upgrade_indexes', partial=True, stdout=StringIO())
+            self.assertEquals(current - set([composite]) | partial, self.getIndexes(table))
+        finally:
+            # sqlite commits schema changes, so put back the standard
+            # indexes for the other tests
+            cursor = connection.cursor()
+            for name in partial:
+                cursor.execute('DROP INDEX IF EXISTS "%s"' % name)
+            call_command('geocamfolder_upgrade_indexes', stdout=StringIO())
+
+
+@override_settings(GEOCAM_FOLDER_FOLDER_CACHE_ENABLED=False,
+                   GEOCAM_FOLDER_SNAPSHOT_CHECK_SECONDS=0)
+class SnapshotTest(TestCase):
+    def setUp(self):
+        # a private cache for the generation
+        self.siteCache = models.cache
+        models.cache = get_cache('django.core.cache.backends.locmem.LocMemCache',
+                                 LOCATION='geocamFolderSnapshotTest')
+        models.cache.clear()
+        self.cacheVersion = models.FOLDER_CACHE_VERSION
+        self.workDir = tempfile.mkdtemp(prefix='geocamFolderSnapshotTest')
+        self.path = os.path.join(self.workDir, 'policy.snapshot')
+
+        self.alice = User.objects.create_user('alice', 'alice@example.com')
+        self.bob = User.objects.create_user('bob', 'bob@example.com')
+        self.team = Group.objects.create(name='team')
+        self.bob.groups.add(self.team)
+        Folder.mkdir('/proj').setPermissions(self.alice, Actions.ALL)
+        Folder.mkdir('/proj/data').setPermissions(self.team, Actions.WRITE)
+        Folder.mkdir('/proj/private').setPermissions('group:anyuser', Actions.NONE)
+
+    def tearDown(self):
+        models.cache = self.siteCache
+        models.FOLDER_CACHE_VERSION = self.cacheVersion
+        snapshot._state.update({'snapshot': None, 'checkedAt': 0})
+        shutil.rmtree(self.workDir)
+
+    def test_snapshot(self):
+        snapshot.compileSnapshot(self.path)
+        snap = snapshot.PolicySnapshot(self.path)
+        data = Folder.getFolder('/proj/data')
+        self.assertEquals('/proj/data', snap.getPath(data.id))
+        for user in (None, self.alice, self.bob):
+            for action in Actions.ALL:
+                allowed = models._getAllowedFoldersNoCache(user, action)
+                self.assertEquals(set(allowed.keys()), snap.getAllowedFolderIds(user, action))
+                for folder in Folder.objects.all():
+                    self.assertEquals(folder.id in allowed, snap.isAllowed(folder.id, user, action))
+
+        with override_settings(GEOCAM_FOLDER_SNAPSHOT_PATH=self.path):
+            with self.assertNumQueries(0):
+                self.assert_(models.isFolderAllowed(data.id, self.bob, Action.INSERT))
+
+            # a stale snapshot is not used until it is recompiled
+            self.bob.groups.remove(self.team)
+            self.assertEquals(None, snapshot.getCurrentSnapshot())
+            self.assertFalse(models.isFolderAllowed(data.id, self.bob, Action.INSERT))
+            snapshot.compileSnapshot(self.path)
+            with self.assertNumQueries(0):
+                self.assertFalse(models.isFolderAllowed(data.id, self.bob, Action.INSERT))
+
+
+@override_settings(GEOCAM_FOLDER_JOURNAL_ENABLED=True,
+                   GEOCAM_FOLDER_JOURNAL_SETTLE_SECONDS=0)
+class JournalTest(TestCase):
+    def getFinalState(self, changes):
+        state = {}
+        for change in changes:
+            state[(change['kind'], change['objectId'])] = (change['op'], change['data'])
+        return state
+
+    def test_journal(self):
+        alice = User.objects.create_user('alice', 'alice@example.com')
+        team = Group.objects.create(name='team')
+        j = Folder.mkdir('/j')
+        j.setPermissions(alice, Actions.WRITE)
+        j.setPermissions(alice, Actions.READ)
+        alice.groups.add(team)
+        Folder.mkdir('/j/k')
+        Folder.rmdir('/j/k')
+
+        changes = models.changesSince(0)
+        self.assertEquals(sorted([c['seq'] for c in changes]), [c['seq'] for c in changes])
+        folderChanges = [(c['op'], c['data'] and c['data']['name'])
+                         for c in changes if c['kind'] == 'folder']
+        self.assertEquals([('save', 'j'), ('save', 'k'), ('delete', None)], folderChanges)
+        self.assertEquals({'groups': [team.id]},
+                          [c['data'] for c in changes if c['kind'] == 'membership'][-1])
+        state = self.getFinalState(changes)
+        self.assert_(('groupPermission', 'save') in
+                     [(c['kind'], c['op']) for c in changes if c['folderId'] == j.id])
+
+        # paging
+        page = models.changesSince(0, limit=3)
+        self.assertEquals(changes[:3], page)
+        self.assertEquals(changes[3:], models.changesSince(page[-1]['seq']))
+
+        # collapsing keeps each object's final state
+        self.assert_(models.FolderChange.collapse() > 0)
+        collapsed = models.changesSince(0)
+        self.assert_(len(collapsed) < len(changes))
+        self.assertEquals(state, self.getFinalState(collapsed))
+
+        lastSeq = collapsed[-1]['seq']
+        models.FolderChange.purge(time.time() + 1)
+        self.assertRaises(ValueError, models.changesSince, 0)
+        self.assertEquals([], models.changesSince(lastSeq))
+        call_command('geocamfolder_compact_journal', purgeDays=1, stdout=StringIO())
+
+
+class FolderTransactionTest(TransactionTestCase):
+    def test_makeSubFolderJoinsCallerTransaction(self):
+        root = Folder.getRootFolder()
+        try:
+            with transaction.commit_on_success():
+                Folder(name='before', parent=root).save()
+                root.makeSubFolder('doomed')
+                raise ValueError('roll back')
+        except ValueError:
+            pass
+        self.assertEquals([], list(Folder.objects.filter(name__in=('before', 'doomed'))))
+
+        # a caller that handles a failed mkdir keeps its own writes
+        root.makeSubFolder('taken')
+        with transaction.commit_on_success():
+            Folder(name='kept', parent=root).save()
+            self.assertRaises(IntegrityError, root.makeSubFolder, 'taken')
+            self.assertEquals(False, root.getOrMakeSubFolder('taken')[1])
+        self.assert_(Folder.objects.filter(name='kept').exists())
+
+    def test_bulkCreateJoinsCallerTransaction(self):
+        admin = User.objects.create_superuser('admin', 'admin@example.com', password='12345')
+        root = Folder.getRootFolder()
+        try:
+            with transaction.commit_on_success():
+                Folder(name='before', parent=root).save()
+                Member.bulkCreateAssertAllowed(admin, [Member(name='bulk')], [root])
+                raise ValueError('roll back')
+        except ValueError:
+            pass
+        self.assertFalse(Folder.objects.filter(name='before').exists())
+        self.assertFalse(Member.objects.filter(name='bulk').exists())
+
+
+@override_settings(GEOCAM_FOLDER_JOURNAL_ENABLED=True,
+                   GEOCAM_FOLDER_JOURNAL_SETTLE_SECONDS=0)
+class JournalTransactionTest(TransactionTestCase):
+    def test_savesJoinCallerTransaction(self):
+        root = Folder.getRootFolder()
+        acl = root.getAcl()
+        try:
+            with transaction.commit_on_success():
+                Folder(name='doomed', parent=root).save()
+                root.setPermissions('group:authuser', Actions.ALL)
+                raise ValueError('roll back')
+        except ValueError:
+            pass
+        self.assertFalse(Folder.objects.filter(name='doomed').exists())
+        self.assertEquals(acl, Folder.getRootFolder().getAcl())
+        self.assertEquals([], models.changesSince(0))
+
+    def test_makeSubFolderIsAtomic(self):
+        def failingBulkCreate(objs, **kwargs):
+            raise ValueError('copying the ACL failed')
+        manager = models.GroupPermission.objects
+        manager.bulk_create = failingBulkCreate
+        try:
+            self.assertRaises(ValueError, Folder.getRootFolder().makeSubFolder, 'noAcl')
+        finally:
+            del manager.bulk_create
+        self.assertFalse(Folder.objects.filter(name='noAcl').exists())
+        self.assertEquals([], models.changesSince(0))
@@ -4,7 +4,12 @@
 # All Rights Reserved.
 # __END_LICENSE__
 
-from django.conf.urls import url
+from django.conf.urls import patterns, url
 
-urlpatterns = [url(r'^$', 'views.index', name='index'),
-               ]
+# all take the folder as a ?path= query parameter
+urlpatterns = patterns(
+    'geocamFolder.views',
+    url(r'^tree\.json$', 'treeJson', name='geocamFolder_treeJson'),
+    url(r'^folder\.json$', 'folderJson', name='geocamFolder_folderJson'),
+    url(r'^acl\.json$', 'aclJson', name='geocamFolder_aclJson'),
+)
@@ -3,3 +3,182 @@
 # the Administrator of the National Aeronautics and Space Administration.
 # All Rights Reserved.
 # __END_LICENSE__
+
+"""
+JSON API for folders and ACLs.  See geocamFolder.urls.
+
+Every response carries an ETag derived from the shared folder/ACL
+cache generation (see models.getCacheGeneration()) and the user's id,
+is_active and is_superuser flags, so a client that polls with
+If-None-Match gets a 304 without the payload being rebuilt until some
+process changes a folder, ACL or group membership, or the user's
+flags change.  For anonymous clients that costs a single cache lookup
+and no db queries; authenticated clients also pay for loading their
+session and user.  Serialized payloads are cached per ETag.  Trees
+larger than GEOCAM_FOLDER_API_STREAM_MIN_FOLDERS are streamed instead
+of cached.
+
+A change saved under TransactionMiddleware starts a new generation
+before it commits, so it starts another when the request finishes
+(see models.replayPendingFlushes()); a payload built from the
+uncommitted state then never outlives the commit.
+"""
+
+import json
+import hashlib
+
+from django.conf import settings
+from django.http import (HttpResponse, HttpResponseNotModified,
+                         StreamingHttpResponse)
+from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
+from django.views.decorators.http import require_GET
+
+from geocamFolder import models, stats
+from geocamFolder.routers import readFromPrimary
+from geocamFolder.models import Action, syncCacheGeneration, getFolderTree, getAllowedFolders
+
+API_CACHE_PREFIX = 'geocamFolder.api.'
+
+
+def _getUser(request):
+    if request.user.is_authenticated():
+        return request.user
+    return None
+
+
+def _getPath(request):
+    path = request.GET.get('path', '/')
+    return '/' + path.strip('/') if path.strip('/') else '/'
+
+
+def _jsonError(status, message):
+    return HttpResponse(json.dumps({'error': message}), status=status,
+                        content_type='application/json')
+
+
+def _getETag(generation, user, viewName, params):
+    # group memberships are covered by the generation, which changes
+    # when they do
+    if user is None:
+        userKey = 'anon'
+    else:
+        userKey = '%s.%d.%d' % (user.id, user.is_active, user.is_superuser)
+    text = '%s.%s.%s.%r' % (generation, userKey, viewName, sorted(params.items()))
+    return '"%s"' % hashlib.md5(text).hexdigest()
+
+
+def _isNotModified(request, etag):
+    ifNoneMatch = request.META.get('HTTP_IF_NONE_MATCH', '')
+    return etag in [tag.strip() for tag in ifNoneMatch.split(',')] or ifNoneMatch.strip() == '*'
+
+
+def _cachedJsonView(viewName, buildFunc, streamFunc=None):
+    """
+    Wraps @buildFunc(request, user, params) -> JSON text in a GET view
+    with ETag handling and per-generation payload caching.  If
+    @streamFunc(request, user, params) returns an iterator of JSON text
+    chunks rather than None, that is streamed instead.
+    """
+    @require_GET
+    def view(request):
+        with stats.timer('api.' + viewName):
+            # catch up with other processes' changes so the cached
+            # lookups used to build the payload match the generation
+            generation = syncCacheGeneration()
+            user = _getUser(request)
+            params = dict(request.GET.items())
+            etag = _getETag(generation, user, viewName, params)
+            if _isNotModified(request, etag):
+                stats.incr('api.%s.notModified' % viewName)
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                return response
+
+            try:
+                chunks = streamFunc(request, user, params) if streamFunc else None
+                if chunks is not None:
+                    response = StreamingHttpResponse(chunks, content_type='application/json')
+                else:
+                    cacheKey = API_CACHE_PREFIX + etag.strip('"')
+                    payload = models.cache.get(cacheKey)
+                    if payload is None:
+                        with readFromPrimary():
+                            payload = buildFunc(request, user, params)
+                        models.cache.set(cacheKey, payload,
+                                         settings.GEOCAM_FOLDER_API_CACHE_TIMEOUT_SECONDS)
+                    response = HttpResponse(payload, content_type='application/json')
+            except PermissionDenied, e:
+                return _jsonError(403, str(e))
+            except ObjectDoesNotExist, e:
+                return _jsonError(404, str(e))
+            response['ETag'] = etag
+            return response
+    view.__name__ = viewName
+    return view
+
+
+def _getFolderDict(folder):
+    return {'id': folder.id, 'name': folder.name, 'path': folder.path}
+
+
+def _iterTreeJson(node, listable):
+    # @listable is None when the user may list everything
+    result = _getFolderDict(node)
+    if listable is not None and node.id not in listable:
+        result['subFolders'] = None
+        yield json.dumps(result)
+        return
+    text = json.dumps(result)
+    yield text[:-1] + ', "subFolders": ['
+    for i, name in enumerate(sorted(node.subFolders.iterkeys())):
+        if i:
+            yield ', '
+        for chunk in _iterTreeJson(node.subFolders[name], listable):
+            yield chunk
+    yield ']}'
+
+
+def _getTreeRoot(request, user):
+    root = models.Folder.getFolderAssertAllowed(user, _getPath(request))
+    if (not settings.GEOCAM_FOLDER_ACCESS_CONTROL_ENABLED
+            or ((user is not None) and user.is_superuser)):
+        listable = None
+    else:
+        listable = getAllowedFolders(user, Action.LIST)
+    return root, listable
+
+
+def _buildTree(request, user, params):
+    root, listable = _getTreeRoot(request, user)
+    return ''.join(_iterTreeJson(root, listable))
+
+
+def _streamTree(request, user, params):
+    if len(getFolderTree().byId) < settings.GEOCAM_FOLDER_API_STREAM_MIN_FOLDERS:
+        return None
+    # check access before the response starts
+    root, listable = _getTreeRoot(request, user)
+    return _iterTreeJson(root, listable)
+
+
+def _buildFolder(request, user, params):
+    folder = models.Folder.getFolderAssertAllowed(user, _getPath(request))
+    result = _getFolderDict(folder)
+    dbFolder = models.Folder.objects.get(id=folder.id)
+    result.update({'uuid': dbFolder.uuid,
+                   'notes': dbFolder.notes,
+                   'allowedActions': folder.getAllowedActions(user)})
+    if folder.isAllowed(user, Action.LIST):
+        result['subFolders'] = sorted(folder.subFolders.iterkeys())
+    return json.dumps(result)
+
+
+def _buildAcl(request, user, params):
+    folder = models.Folder.getFolderAssertAllowed(user, _getPath(request))
+    folder.assertAllowed(user, Action.ADMIN)
+    return json.dumps({'path': folder.path, 'acl': folder.getAcl()})
+
+
+treeJson = _cachedJsonView('treeJson', _buildTree, _streamTree)
+folderJson = _cachedJsonView('folderJson', _buildFolder)
+aclJson = _cachedJsonView('aclJson', _buildAcl)